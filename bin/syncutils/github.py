@@ -0,0 +1,163 @@
+"""A small client for the GitHub API, shared by the sync workers.
+
+All requests go through one pooled ``requests.Session``. When GitHub says
+that the rate limit has been hit, with ``Retry-After`` or
+``X-RateLimit-Remaining: 0``, every thread pauses until it is lifted.
+"""
+
+from requests.adapters import HTTPAdapter
+from requests.auth import HTTPBasicAuth
+from syncutils.orchestrator import TransientError
+import requests
+import threading
+import time
+
+
+def uncached_session():
+    """Make a requests session that isn't served from the requests cache.
+
+    The sync must always see the current state of GitHub, even if
+    requests_cache has been installed, which swaps `requests.Session` for a
+    subclass that caches responses.
+    """
+    session_class = next(c for c in requests.Session.__mro__ if c.__module__ == "requests.sessions")
+    return session_class()
+
+
+class GitHubClient(object):
+    """A pooled, rate limit aware GitHub API client that can be shared between threads.
+
+    Args: - user: GitHub user name
+          - token: GitHub auth token
+          - api_url: Base URL of the API, default is `https://api.github.com`
+          - pool_size: Maximum number of keep-alive connections
+          - retries: Number of times to retry a request that was rate limited or failed with a server error
+          - max_wait: Longest time in seconds to pause for a rate limit before trying again
+    """
+    api_url = "https://api.github.com"
+
+    def __init__(self, user="nf-core", token="", api_url=None, pool_size=10, retries=3, max_wait=900):
+        self.api_url = (api_url or self.api_url).rstrip("/")
+        self.session = uncached_session()
+        if token:
+            self.session.auth = HTTPBasicAuth(user, token)
+        self.session.headers["Accept"] = "application/vnd.github.v3+json"
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+        self.retries = retries
+        self.max_wait = max_wait
+        self.lock = threading.Lock()
+        self.resume_at = 0
+
+    def wait(self):
+        """Sleep until the rate limit allows more requests.
+        """
+        with self.lock:
+            delay = self.resume_at - time.time()
+        if delay > 0:
+            time.sleep(min(delay, self.max_wait))
+
+    def backoff(self, response):
+        """Pause all requests if a response says that the rate limit has been hit.
+
+        Returns: True if the request was refused because of the rate limit
+        """
+        now = time.time()
+        resume_at = None
+        if response.headers.get("Retry-After") is not None:
+            try:
+                resume_at = now + float(response.headers["Retry-After"])
+            except ValueError:
+                resume_at = now + 60
+        elif response.headers.get("X-RateLimit-Remaining") == "0":
+            try:
+                resume_at = float(response.headers["X-RateLimit-Reset"])
+            except (KeyError, ValueError):
+                resume_at = now + 60
+        if resume_at is None:
+            return False
+        with self.lock:
+            self.resume_at = max(self.resume_at, resume_at)
+        return response.status_code in (403, 429)
+
+    def request(self, method, path, **kwargs):
+        """Make an API request, retrying rate limited requests and server errors.
+
+        Returns: An instance of class requests.Response
+        """
+        url = path if path.startswith("http") else self.api_url + path
+        for attempt in range(self.retries + 1):
+            self.wait()
+            response = self.session.request(method, url, **kwargs)
+            rate_limited = self.backoff(response)
+            if not rate_limited and response.status_code < 500:
+                break
+            if not rate_limited and attempt < self.retries:
+                time.sleep(2 ** attempt)
+        return response
+
+    def check(self, response, expected=200):
+        """Raise an error if a response wasn't successful.
+        """
+        if response.status_code == expected:
+            return
+        message = "GitHub returned {} for {} {}: {}".format(
+            response.status_code, response.request.method, response.url, response.content)
+        if response.status_code >= 500 or response.status_code in (403, 429):
+            raise TransientError(message)
+        raise RuntimeError(message)
+
+    def get_all(self, path, params=None):
+        """Get every page of a list from the API.
+
+        Returns: A list of the items from all pages
+        """
+        items = []
+        url = path
+        while url:
+            response = self.request("GET", url, params=params)
+            self.check(response)
+            items.extend(response.json())
+            # The next page link already has the query parameters
+            url = response.links.get("next", {}).get("url")
+            params = None
+        return items
+
+    def find_pull_request(self, repo, head, base):
+        """Find an open pull request between two branches, with one paginated list call.
+
+        Returns: The URL of the pull request, or None if there isn't one
+        """
+        owner = repo.split("/")[0]
+        pulls = self.get_all("/repos/{}/pulls".format(repo), params={
+            "state": "open",
+            "head": "{}:{}".format(owner, head),
+            "base": base,
+            "per_page": 100
+        })
+        for pull in pulls:
+            if pull["head"]["ref"] == head and pull["base"]["ref"] == base:
+                return pull["html_url"]
+
+    def ensure_pull_request(self, repo, head, base, title, body):
+        """Open a pull request, unless one is already open between the branches.
+
+        Returns: The URL of the new or existing pull request
+        """
+        existing = self.find_pull_request(repo, head, base)
+        if existing:
+            return existing
+        response = self.request("POST", "/repos/{}/pulls".format(repo), json={
+            "title": title,
+            "body": body,
+            "head": head,
+            "base": base
+        })
+        if response.status_code == 422:
+            # Opened by someone else since we looked
+            existing = self.find_pull_request(repo, head, base)
+            if existing:
+                return existing
+        self.check(response, 201)
+        return response.json()["html_url"]
@@ -0,0 +1,138 @@
+"""Run the template sync for many pipelines concurrently.
+
+Each pipeline is synced by a task object that has a list of named
+``stages`` (e.g. clone, render, commit, push, pull request), run in order.
+Pipelines are synced by a bounded pool of workers and results are yielded
+as each pipeline finishes. Stages that fail with a transient error
+(network or git remote problems) are retried with an increasing delay.
+"""
+
+from multiprocessing.pool import ThreadPool
+import git
+import requests
+import time
+
+
+class TransientError(Exception):
+    """A failure that is likely to succeed if tried again, e.g. a server error."""
+    pass
+
+
+class SyncResult(object):
+    """The outcome of syncing one pipeline.
+
+    Attributes:
+        pipeline (str): The pipeline name
+        status (str): ``synced``, ``unchanged`` or ``failed``
+        stage (str): The last stage that was run
+        attempts (dict): Number of attempts for each stage that was run
+        error (str): Error message if the sync failed
+        pr_url (str): URL of the pull request, if one was opened
+        duration (float): Wall time in seconds
+    """
+
+    json_fields = ['pipeline', 'status', 'stage', 'attempts', 'error', 'pr_url', 'duration']
+
+    def __init__(self, pipeline):
+        self.pipeline = pipeline
+        self.status = None
+        self.stage = None
+        self.attempts = {}
+        self.error = None
+        self.pr_url = None
+        self.duration = None
+
+    def json_record(self):
+        return dict((field, getattr(self, field)) for field in self.json_fields)
+
+
+class SyncOrchestrator(object):
+    """Sync the template of many pipelines with a bounded pool of workers.
+
+    Args:
+        make_task (callable): Called with a pipeline name, returns a task with
+            a ``stages`` list of method names and a ``cleanup()`` method.
+            A stage returning ``False`` means that there is nothing more to do.
+            A stage returning a string gives the URL of a pull request.
+        max_workers (int): Number of pipelines to sync at the same time
+        retries (int): Number of times to retry a stage after a transient error
+        retry_delay (float): Seconds to wait before the first retry, doubled each time
+    """
+
+    transient_errors = (git.exc.GitCommandError, requests.exceptions.RequestException, TransientError)
+
+    def __init__(self, make_task, max_workers=4, retries=2, retry_delay=10):
+        self.make_task = make_task
+        self.max_workers = max_workers
+        self.retries = retries
+        self.retry_delay = retry_delay
+
+    def run_stage(self, result, name, stage):
+        """Run one stage, retrying transient failures."""
+        delay = self.retry_delay
+        for attempt in range(1, self.retries + 2):
+            result.attempts[name] = attempt
+            try:
+                return stage()
+            except self.transient_errors:
+                if attempt > self.retries:
+                    raise
+            time.sleep(delay)
+            delay *= 2
+
+    def sync_pipeline(self, pipeline):
+        """Run all of the stages for one pipeline.
+
+        Returns: A SyncResult. Exceptions are caught and recorded in the result.
+        """
+        result = SyncResult(pipeline)
+        start = time.time()
+        task = None
+        try:
+            task = self.make_task(pipeline)
+            result.status = 'synced'
+            for name in task.stages:
+                result.stage = name
+                outcome = self.run_stage(result, name, getattr(task, name))
+                if outcome is False:
+                    result.status = 'unchanged'
+                    break
+                if isinstance(outcome, str):
+                    result.pr_url = outcome
+        except Exception as e:
+            result.status = 'failed'
+            result.error = '{}: {}'.format(e.__class__.__name__, e)
+        finally:
+            if task is not None:
+                task.cleanup()
+        result.duration = round(time.time() - start, 2)
+        return result
+
+    def run(self, pipelines):
+        """Sync pipelines concurrently, yielding each SyncResult as it finishes."""
+        if not pipelines:
+            return
+        pool = ThreadPool(min(self.max_workers, len(pipelines)))
+        try:
+            for result in pool.imap_unordered(self.sync_pipeline, pipelines):
+                yield result
+        finally:
+            pool.close()
+            pool.join()
+
+    @staticmethod
+    def summary(results, **kwargs):
+        """Build a machine-readable summary of a sync run.
+
+        Args:
+            results (list): SyncResult objects
+            kwargs: Extra top-level fields, e.g. the release tag
+
+        Returns: A dictionary that can be written as JSON
+        """
+        report = dict(kwargs)
+        report['counts'] = {'synced': 0, 'unchanged': 0, 'failed': 0}
+        for result in results:
+            report['counts'][result.status] += 1
+        report['pipelines'] = [r.json_record() for r in sorted(results, key=lambda r: r.pipeline)]
+        return report
@@ -7,83 +7,189 @@ import shutil
 import nf_core.create
 
 TEMPLATE_BRANCH = "TEMPLATE"
+# Private directory for the bare mirrors, as git runs their hooks and config with the bot's token
+DEFAULT_MIRROR_DIR = os.path.join(os.path.expanduser("~"), ".nfcore", "sync_mirrors")
+
+
+def check_private(path):
+    """Refuse to use a directory that another user owns or can write to.
+    """
+    st = os.stat(path)
+    if hasattr(os, "getuid") and st.st_uid != os.getuid():
+        raise RuntimeError("Refusing to use '{}', as it is not owned by the current user".format(path))
+    if st.st_mode & 0o022:
+        raise RuntimeError("Refusing to use '{}', as other users can write to it".format(path))
 
 
 class NfcoreTemplate:
     """Updates the template content of an nf-core pipeline in
     its `TEMPLATE` branch.
 
+    Each pipeline has a bare mirror repository in a persistent cache, which
+    is brought up to date with an incremental fetch of only the `master` and
+    template branches. The template branch is checked out in a temporary
+    worktree of the mirror, and the pipeline config is read straight from
+    the `master` branch blob without checking it out.
+
+    Before anything is checked out, the git tree hash of the rendered template
+    is compared with the tree of the template branch. If they are the same,
+    the template branch is already up to date and the sync stops there.
+
+    The sync is split in to stages, listed in `stages`, which can each be
+    run again if they fail part way through.
+
     Args: - pipeline: The pipeline name
           - branch: The template branch name, default=`TEMPLATE`
-          - token: GitHub auth token
+          - repo_url: URL to fetch from and push to. Not saved in the mirror, as it may contain a token.
+          - create_pr: Function called with the pipeline name to open a pull request,
+                       returning its URL
+          - mirror_dir: Directory for the bare mirror repositories, default is `~/.nfcore/sync_mirrors`.
+                        It and the mirrors in it must be owned by the current user and not writable by anyone else.
     """
-    def __init__(self, pipeline, branch=TEMPLATE_BRANCH, repo_url=""):
+    stages = ['fetch', 'check_template', 'checkout', 'render', 'commit_changes', 'push_changes', 'pull_request']
+
+    def __init__(self, pipeline, branch=TEMPLATE_BRANCH, repo_url="", create_pr=None, mirror_dir=None):
         """Basic constructor
         """
         self.pipeline = pipeline
         self.repo_url = repo_url
         self.branch = branch
-        self.tmpdir = tempfile.mkdtemp()
-        self.templatedir = tempfile.mkdtemp()
-        self.repo = git.Repo.clone_from(self.repo_url, self.tmpdir)
-        assert self.repo
+        self.create_pr = create_pr
+        self.mirror_dir = mirror_dir or DEFAULT_MIRROR_DIR
+        self.mirror = None
+        self.context = None
+        self.tmpdir = None
+        self.repo = None
 
     def sync(self):
         """Execute the template update.
         """
-        context = self.context_from_nextflow(nf_project_dir=self.tmpdir)
-        self.update_child_template(self.templatedir, self.tmpdir, context=context)
-        self.commit_changes()
-        self.push_changes()
+        for stage in self.stages:
+            if getattr(self, stage)() is False:
+                break
+        self.cleanup()
 
-    def context_from_nextflow(self, nf_project_dir):
-        """Fetch a Nextflow pipeline's config settings.
+    def fetch(self):
+        """Bring the mirror of the pipeline up to date.
+        """
+        self.cleanup()
+        self.update_mirror()
 
-        Returns: A cookiecutter-readable context (Python dictionary)
+    def check_template(self):
+        """Compare the rendered template with the template branch, without writing any files.
+
+        Returns: False if the template branch is already up to date
+        """
+        self.context = self.context_from_nextflow()
+        create_obj = self.pipeline_create(self.context)
+        files = nf_core.create.PipelineTemplate.load().render_files(create_obj.template_context())
+        if utils.git_tree_hash(files) == self.mirror.git.rev_parse("{}^{{tree}}".format(self.branch)):
+            return False
+
+    def checkout(self):
+        """Check out the template branch in a new worktree of the mirror.
+        """
+        self.cleanup()
+        self.tmpdir = tempfile.mkdtemp()
+        # Detached, so that later fetches can update the branch in the mirror
+        self.mirror.git.worktree("add", "--detach", self.tmpdir, self.branch)
+        self.repo = git.Repo(self.tmpdir)
+
+    def update_mirror(self):
+        """Create the bare mirror if needed and fetch the branches that the sync uses.
+        """
+        if not os.path.isdir(self.mirror_dir):
+            os.makedirs(self.mirror_dir)
+            os.chmod(self.mirror_dir, 0o700)
+        check_private(self.mirror_dir)
+        mirror_path = os.path.join(self.mirror_dir, "{}.git".format(self.pipeline))
+        if not os.path.isdir(mirror_path):
+            git.Repo.init(mirror_path, bare=True)
+        check_private(mirror_path)
+        self.mirror = git.Repo(mirror_path)
+        self.mirror.git.worktree("prune")
+        refspecs = ["+refs/heads/{0}:refs/heads/{0}".format(b) for b in ["master", self.branch]]
+        self.mirror.git.fetch("--prune", "--no-tags", self.repo_url, *refspecs)
+
+    def render(self):
+        """Render the template with the pipeline's settings on to the template branch.
         """
-        # Check if we are on "master" (main pipeline code)
-        if self.repo.active_branch.name != "master":
-            self.repo.git.checkout("origin/master", b="master")
+        self.update_child_template(self.tmpdir, context=self.context)
 
-        # Fetch the config variables from the Nextflow pipeline
-        config = utils.fetch_wf_config(wf_path=nf_project_dir)
+    def cleanup(self):
+        """Remove the worktree and temporary directories.
+        """
+        if self.tmpdir is not None:
+            shutil.rmtree(self.tmpdir, ignore_errors=True)
+        if self.mirror is not None:
+            self.mirror.git.worktree("prune")
+        self.tmpdir = None
+        self.repo = None
 
-        # Checkout again to configured template branch
-        self.repo.git.checkout("origin/{branch}".format(branch=self.branch),
-            b="{branch}".format(branch=self.branch))
+    def context_from_nextflow(self):
+        """Read a Nextflow pipeline's config settings from the `master` branch.
 
+        Returns: A cookiecutter-readable context (Python dictionary)
+
+        Raises: ValueError if a setting that the template needs can't be read without running nextflow
+        """
+        config = utils.parse_config(self.mirror.git.show("master:nextflow.config"))
         return utils.create_context(config)
 
-    def update_child_template(self, templatedir, target_dir, context=None):
-        """Apply the changes of the cookiecutter template
-        to the pipelines template branch.
+    def pipeline_create(self, context, outdir=None):
+        """Set up the template for a pipeline from its settings.
+
+        Returns: An instance of class nf_core.create.PipelineCreate
         """
-        # Clear the pipeline's template branch content
-        for f in os.listdir(self.tmpdir):
-            if f == ".git":
-                continue
-            try:
-                shutil.rmtree(os.path.join(target_dir, f))
-            except:
-                os.remove(os.path.join(target_dir, f))
-        print(target_dir)
-        print(context.get('author'))
-        # Create the new template structure
-        nf_core.create.PipelineCreate(
+        return nf_core.create.PipelineCreate(
             name=context.get('pipeline_name'),
             description=context.get('pipeline_short_description'),
             new_version=context.get('version'),
             no_git=True,
             force=True,
-            outdir=target_dir,
+            outdir=outdir,
             author=context.get('author')
-        ).init_pipeline()
+        )
+
+    def update_child_template(self, target_dir, context=None):
+        """Apply the changes of the cookiecutter template
+        to the pipelines template branch.
+        """
+        # Render the new template over the pipeline's template branch content,
+        # only writing files that have changed
+        create_obj = self.pipeline_create(context, outdir=target_dir)
+        create_obj.init_pipeline()
+
+        # Remove files that are no longer part of the template
+        template_files = set(create_obj.template_files)
+        for root, dirs, files in os.walk(target_dir):
+            if root == target_dir:
+                # In a worktree, .git is a file
+                dirs[:] = [d for d in dirs if d != ".git"]
+                files = [f for f in files if f != ".git"]
+            for f in files:
+                path = os.path.join(root, f)
+                if os.path.relpath(path, target_dir) not in template_files:
+                    os.remove(path)
 
     def commit_changes(self):
         """Commits the changes of the new template to the current branch.
+
+        Returns: False if the template branch is already up to date
         """
+        if not self.repo.is_dirty(untracked_files=True):
+            return False
         self.repo.git.add(A=True)
         self.repo.index.commit("Update nf-core pipeline template.")
 
     def push_changes(self):
-        self.repo.git.push()
+        self.repo.git.push(self.repo_url, "HEAD:refs/heads/{}".format(self.branch))
+
+    def pull_request(self):
+        """Open a pull request from the template branch, if there isn't one already.
+
+        Returns: The URL of the pull request
+        """
+        if self.create_pr is None:
+            return
+        return self.create_pr(self.pipeline)
@@ -1,27 +1,86 @@
+import binascii
+import hashlib
 import os
-import subprocess
+import re
+import stat
 
-def fetch_wf_config(wf_path):
+# A config assignment with a plain string, number or boolean value, followed by the end of the statement
+CONFIG_ASSIGNMENT = re.compile(r"""^([\w.]+)\s*=\s*(?:'([^'\\]*)'|"([^"\\$]*)"|(true|false|-?\d[\w.]*))\s*(?=$|//|;|\})""")
+# Any other assignment, with a value that needs Groovy to evaluate
+CONFIG_EXPRESSION = re.compile(r"^([\w.]+)\s*=")
+# The start of a scope block, e.g. `manifest {`
+CONFIG_SCOPE = re.compile(r"""^([^=;{}'"]+?)\s*\{""")
+
+def parse_config(text):
     """
-    Use nextflow to retrieve the nf configuration variables from a workflow
+    Read the simple assignments from the text of a nextflow.config file,
+    without running nextflow
+
+    Scope blocks (e.g. `manifest { name = 'x' }`) are flattened to dotted
+    names (`manifest.name`). Assignments with values that need Groovy to
+    evaluate (e.g. `version = '1.0' + suffix`) are set to None. Included
+    config files are not read.
+
+    Returns: A flat dictionary of config variables, with quotes stripped from values
     """
     config = dict()
-    # Call `nextflow config` and pipe stderr to /dev/null
-    try:
-        with open(os.devnull, 'w') as devnull:
-            nfconfig_raw = subprocess.check_output(['nextflow', 'config', '-flat', wf_path], stderr=devnull)
-    except OSError as e:
-        if e.errno == os.errno.ENOENT:
-            raise AssertionError("It looks like Nextflow is not installed. It is required for most nf-core functions.")
-    except subprocess.CalledProcessError as e:
-        raise AssertionError("`nextflow config` returned non-zero error code: %s,\n   %s", e.returncode, e.output)
-    else:
-        for l in nfconfig_raw.splitlines():
-            ul = l.decode()
-            k, v = ul.split(' = ', 1)
-            config[k] = v.replace("\'", "").replace("\"", "")
+    scopes = []
+    in_comment = False
+    for line in text.splitlines():
+        line = line.strip()
+        if in_comment:
+            in_comment = '*/' not in line
+            continue
+        if line.startswith('/*'):
+            in_comment = '*/' not in line
+            continue
+        while line and not line.startswith('//'):
+            if line.startswith('}') or line.startswith(';'):
+                if line.startswith('}') and scopes:
+                    scopes.pop()
+                line = line[1:].strip()
+                continue
+            match = CONFIG_SCOPE.match(line)
+            if match:
+                scopes.append(match.group(1))
+                line = line[match.end():].strip()
+                continue
+            # Assignments inside closures aren't config settings
+            inside_closure = None in scopes
+            match = CONFIG_ASSIGNMENT.match(line)
+            if match:
+                if not inside_closure:
+                    key = '.'.join(scopes + [match.group(1)])
+                    config[key] = next(v for v in match.groups()[1:] if v is not None)
+                line = line[match.end():].strip()
+                continue
+            match = CONFIG_EXPRESSION.match(line)
+            if match and not inside_closure:
+                config['.'.join(scopes + [match.group(1)])] = None
+            # Can't tell where an expression or other statement ends,
+            # so skip the rest of the line, keeping track of any blocks it opens or closes
+            depth = line.count('{') - line.count('}')
+            if depth > 0:
+                scopes.extend([None] * depth)
+            elif depth < 0:
+                del scopes[depth:]
+            break
     return config
 
+def config_value(config, key, default=None):
+    """Get a plain config value, as read by parse_config().
+
+    Raises: ValueError if the value needs Groovy to evaluate,
+            or if it isn't set and there is no default
+    """
+    if key not in config:
+        if default is None:
+            raise ValueError("{} is not set in nextflow.config, settings from included config files are not read".format(key))
+        return default
+    if config[key] is None:
+        raise ValueError("{} in nextflow.config isn't a plain value, so can't be read without running nextflow".format(key))
+    return config[key]
+
 def create_context(config):
     """Consumes a flat Nextflow config file and will create
     a context dictionary with information for the nf-core template creation.
@@ -32,13 +91,59 @@ def create_context(config):
             'pipeline_short_description': '<parsed_description>'
             'version': '<parsed_version>'
         }
+
+    Raises: ValueError if a setting that the template needs is missing or isn't a plain value
     """
     context = {}
-    context["pipeline_name"] = config.get("manifest.name") if config.get("manifest.name") else get_name_from_url(config.get("manifest.homePage"))
-    context["pipeline_short_description"] = config.get("manifest.description")
-    context["version"] = config.get("manifest.version") if config.get("manifest.version") else config.get("params.version")
-    context["author"] = config.get("manifest.author") if config.get("manifest.author") else "No author provided"
+    if "manifest.name" in config:
+        context["pipeline_name"] = config_value(config, "manifest.name")
+    else:
+        context["pipeline_name"] = get_name_from_url(config_value(config, "manifest.homePage"))
+    context["pipeline_short_description"] = config_value(config, "manifest.description")
+    if "manifest.version" in config:
+        context["version"] = config_value(config, "manifest.version")
+    else:
+        context["version"] = config_value(config, "params.version")
+    context["author"] = config_value(config, "manifest.author", "No author provided")
     return context
 
 def get_name_from_url(url):
     return url.split("/")[-1] if url else ""
+
+def git_object_hash(kind, data):
+    """Hash an object the way that git does, returning the raw SHA-1 digest."""
+    header = "{} {}\0".format(kind, len(data)).encode("utf-8")
+    return hashlib.sha1(header + data).digest()
+
+def git_tree_hash(files):
+    """Work out the git tree hash of a set of files, without a repository.
+
+    Args: - files: Iterable of (relative path, content bytes, mode) tuples.
+                   Entries with no content (directories) are skipped, as git doesn't track them.
+
+    Returns: The hex SHA-1 that `git write-tree` would give for the files
+    """
+    root = {}
+    for path, content, mode in files:
+        if content is None:
+            continue
+        node = root
+        parts = path.split(os.sep)
+        for part in parts[:-1]:
+            node = node.setdefault(part, {})
+        filemode = b"100755" if mode & stat.S_IXUSR else b"100644"
+        node[parts[-1]] = (filemode, git_object_hash("blob", content))
+
+    def tree_hash(tree):
+        # Git sorts tree entries by name, with a trailing slash on directory names
+        entries = []
+        for name, value in tree.items():
+            name = name.encode("utf-8")
+            if isinstance(value, dict):
+                entries.append((name + b"/", b"40000", name, tree_hash(value)))
+            else:
+                entries.append((name, value[0], name, value[1]))
+        data = b"".join(mode + b" " + name + b"\0" + sha for _, mode, name, sha in sorted(entries))
+        return git_object_hash("tree", data)
+
+    return binascii.hexlify(tree_hash(root)).decode("ascii")
@@ -5,10 +5,14 @@ Bumps the version number in all appropriate files for
 a nf-core pipeline
 """
 
+from collections import OrderedDict
+
 import logging
 import os
 import re
+import stat
 import sys
+import tempfile
 
 def bump_pipeline_version(lint_obj, new_version):
     """ Function to bump a pipeline version number. Called by the main script """
@@ -22,11 +26,12 @@ def bump_pipeline_version(lint_obj, new_version):
         logging.error("Could not find config variable manifest.version")
         sys.exit(1)
     logging.info("Changing version number:\n  Current version number is '{}'\n  New version number will be '{}'".format(current_version, new_version))
+    plan = VersionBumpPlan(lint_obj.path)
 
     # Update nextflow.config
     nfconfig_pattern = r"version\s*=\s*[\'\"]?{}[\'\"]?".format(current_version.replace('.',r'\.'))
     nfconfig_newstr = "version = '{}'".format(new_version)
-    update_file_version("nextflow.config", lint_obj, nfconfig_pattern, nfconfig_newstr)
+    plan.add("nextflow.config", nfconfig_pattern, nfconfig_newstr)
 
     # Update container tag
     docker_tag = 'latest'
@@ -36,33 +41,36 @@ def bump_pipeline_version(lint_obj, new_version):
         logging.info("New version contains letters. Setting docker tag to 'latest'")
     nfconfig_pattern = r"container\s*=\s*[\'\"]nfcore/{}:(?:{}|latest)[\'\"]".format(lint_obj.pipeline_name.lower(), current_version.replace('.',r'\.'))
     nfconfig_newstr = "container = 'nfcore/{}:{}'".format(lint_obj.pipeline_name.lower(), docker_tag)
-    update_file_version("nextflow.config", lint_obj, nfconfig_pattern, nfconfig_newstr)
+    plan.add("nextflow.config", nfconfig_pattern, nfconfig_newstr)
 
     # Update travis image tag
     nfconfig_pattern = r"docker tag nfcore/{name}:dev nfcore/{name}:(?:{tag}|latest)".format(name=lint_obj.pipeline_name.lower(), tag=current_version.replace('.',r'\.'))
     nfconfig_newstr = "docker tag nfcore/{name}:dev nfcore/{name}:{tag}".format(name=lint_obj.pipeline_name.lower(), tag=docker_tag)
-    update_file_version(".travis.yml", lint_obj, nfconfig_pattern, nfconfig_newstr)
+    plan.add(".travis.yml", nfconfig_pattern, nfconfig_newstr)
 
     # Update Singularity version name
     nfconfig_pattern = r"VERSION {}".format(current_version.replace('.',r'\.'))
     nfconfig_newstr = "VERSION {}".format(new_version)
-    update_file_version("Singularity", lint_obj, nfconfig_pattern, nfconfig_newstr)
+    plan.add("Singularity", nfconfig_pattern, nfconfig_newstr)
 
     if 'environment.yml' in lint_obj.files:
         # Update conda environment.yml
         nfconfig_pattern = r"name: nf-core-{}-{}".format(lint_obj.pipeline_name.lower(), current_version.replace('.',r'\.'))
         nfconfig_newstr = "name: nf-core-{}-{}".format(lint_obj.pipeline_name.lower(), new_version)
-        update_file_version("environment.yml", lint_obj, nfconfig_pattern, nfconfig_newstr)
+        plan.add("environment.yml", nfconfig_pattern, nfconfig_newstr)
 
         # Update Dockerfile PATH
         nfconfig_pattern = r"PATH\s+/opt/conda/envs/nf-core-{}-{}/bin:\$PATH".format(lint_obj.pipeline_name.lower(), current_version.replace('.',r'\.'))
         nfconfig_newstr = "PATH /opt/conda/envs/nf-core-{}-{}/bin:$PATH".format(lint_obj.pipeline_name.lower(), new_version)
-        update_file_version("Dockerfile", lint_obj, nfconfig_pattern, nfconfig_newstr)
+        plan.add("Dockerfile", nfconfig_pattern, nfconfig_newstr)
 
         # Update Singularity PATH
         nfconfig_pattern = r"PATH=/opt/conda/envs/nf-core-{}-{}/bin:\$PATH".format(lint_obj.pipeline_name.lower(), current_version.replace('.',r'\.'))
         nfconfig_newstr = "PATH=/opt/conda/envs/nf-core-{}-{}/bin:$PATH".format(lint_obj.pipeline_name.lower(), new_version)
-        update_file_version("Singularity", lint_obj, nfconfig_pattern, nfconfig_newstr)
+        plan.add("Singularity", nfconfig_pattern, nfconfig_newstr)
+
+    # Write all of the files, or none of them if a version number wasn't found
+    plan.apply()
 
 def bump_nextflow_version(lint_obj, new_version):
     """ Function to bump the required nextflow version number."""
@@ -75,40 +83,107 @@ def bump_nextflow_version(lint_obj, new_version):
         logging.error("Could not find config variable manifest.nextflowVersion")
         sys.exit(1)
     logging.info("Changing version number:\n  Current version number is '{}'\n  New version number will be '{}'".format(current_version, new_version))
+    plan = VersionBumpPlan(lint_obj.path)
 
     # Update nextflow.config
     nfconfig_pattern = r"nextflowVersion\s*=\s*[\'\"]?>={}[\'\"]?".format(current_version.replace('.',r'\.'))
     nfconfig_newstr = "nextflowVersion = '>={}'".format(new_version)
-    update_file_version("nextflow.config", lint_obj, nfconfig_pattern, nfconfig_newstr)
+    plan.add("nextflow.config", nfconfig_pattern, nfconfig_newstr)
 
     # Update travis config
     nfconfig_pattern = r"NXF_VER=[\'\"]?{}[\'\"]?".format(current_version.replace('.',r'\.'))
     nfconfig_newstr = "NXF_VER='{}'".format(new_version)
-    update_file_version(".travis.yml", lint_obj, nfconfig_pattern, nfconfig_newstr, True)
+    plan.add(".travis.yml", nfconfig_pattern, nfconfig_newstr, True)
 
     # Update README badge
     nfconfig_pattern = r"nextflow-%E2%89%A5{}-brightgreen.svg".format(current_version.replace('.',r'\.'))
     nfconfig_newstr = "nextflow-%E2%89%A5{}-brightgreen.svg".format(new_version)
-    update_file_version("README.md", lint_obj, nfconfig_pattern, nfconfig_newstr, True)
+    plan.add("README.md", nfconfig_pattern, nfconfig_newstr, True)
+
+    # Write all of the files, or none of them if a version number wasn't found
+    plan.apply()
 
 def update_file_version(filename, lint_obj, pattern, newstr, allow_multiple=False):
     """ Update version number in the requested file """
-
-    # Load the file
-    fn = os.path.join(lint_obj.path, filename)
-    content = ''
-    with open(fn, 'r') as fh:
-        content = fh.read()
-
-    # Check that we have exactly one match
-    matches = re.findall(pattern, content)
-    if len(matches) == 0:
-        raise SyntaxError ("Could not find version number in {}: '{}'".format(filename, pattern))
-    if len(matches) > 1 and not allow_multiple:
-        raise SyntaxError ("Found more than one version number in {}: '{}'".format(filename, pattern))
-
-    # Replace the match
-    logging.info("Updating version in {}\n - {}\n + {}".format(filename, matches[0], newstr))
-    new_content = re.sub(pattern, newstr, content)
-    with open(fn, 'w') as fh:
-        fh.write(new_content)
+    plan = VersionBumpPlan(lint_obj.path)
+    plan.add(filename, pattern, newstr, allow_multiple)
+    plan.apply()
+
+class VersionBumpPlan(object):
+    """ A set of version number replacements to make in the files of a pipeline
+
+    Each file is read once, and all of its replacements are made in a single
+    scan by combining their patterns. Every replacement is checked before
+    anything is written. New files are written to temporary files first
+    and then renamed in to place, so that if any version number can't be
+    found, or writing fails, no files are changed.
+
+    Args:
+        path (str): Path to the pipeline directory
+    """
+
+    def __init__(self, path):
+        self.path = path
+        # Replacements for each file: filename -> list of (compiled pattern, new string, allow multiple)
+        self.replacements = OrderedDict()
+
+    def add(self, filename, pattern, newstr, allow_multiple=False):
+        """ Add a replacement to the plan """
+        self.replacements.setdefault(filename, []).append((re.compile(pattern), newstr, allow_multiple))
+
+    def update_content(self, filename, content):
+        """ Make all of the replacements for a file in one scan of its content
+
+        Returns:
+            str: The new file content
+
+        Raises:
+            SyntaxError if a pattern is not found, or found more than once when not allowed
+        """
+        replacements = self.replacements[filename]
+        combined = re.compile('|'.join('(?P<r{}>{})'.format(i, p.pattern) for i, (p, _, _) in enumerate(replacements)))
+        matches = [[] for _ in replacements]
+
+        def replace(m):
+            i = int(m.lastgroup[1:])
+            pattern, newstr, _ = replacements[i]
+            matches[i].append(m.group(0))
+            return pattern.match(m.group(0)).expand(newstr)
+        new_content = combined.sub(replace, content)
+
+        # Check that we have exactly one match for each pattern
+        for (pattern, newstr, allow_multiple), found in zip(replacements, matches):
+            if len(found) == 0:
+                raise SyntaxError ("Could not find version number in {}: '{}'".format(filename, pattern.pattern))
+            if len(found) > 1 and not allow_multiple:
+                raise SyntaxError ("Found more than one version number in {}: '{}'".format(filename, pattern.pattern))
+            logging.info("Updating version in {}\n - {}\n + {}".format(filename, found[0], newstr))
+        return new_content
+
+    def apply(self):
+        """ Make the replacements and write the files, all or nothing """
+
+        # Work out all of the new file contents first
+        new_contents = OrderedDict()
+        for filename in self.replacements:
+            with open(os.path.join(self.path, filename), 'r') as fh:
+                new_contents[filename] = self.update_content(filename, fh.read())
+
+        # Write to temporary files next to the originals
+        tmp_fns = OrderedDict()
+        try:
+            for filename, content in new_contents.items():
+                fn = os.path.join(self.path, filename)
+                fd, tmp_fns[filename] = tempfile.mkstemp(dir=os.path.dirname(fn), prefix='.{}.'.format(os.path.basename(fn)))
+                with os.fdopen(fd, 'w') as fh:
+                    fh.write(content)
+                os.chmod(tmp_fns[filename], stat.S_IMODE(os.stat(fn).st_mode))
+        except (IOError, OSError):
+            for tmp_fn in tmp_fns.values():
+                if os.path.exists(tmp_fn):
+                    os.remove(tmp_fn)
+            raise
+
+        # Move them all in to place
+        for filename, tmp_fn in tmp_fns.items():
+            os.rename(tmp_fn, os.path.join(self.path, filename))
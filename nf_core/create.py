@@ -5,16 +5,29 @@ Creates a nf-core pipeline matching the current
 organization's specification.
 """
 
-import cookiecutter.main, cookiecutter.exceptions
+from collections import OrderedDict
+
+import errno
 import git
+import io
+import jinja2
+import json
 import logging
 import os
-import shutil
 import sys
-import tempfile
 
 import nf_core
 
+try:
+    basestring
+except NameError:
+    basestring = str
+
+TEMPLATE_DIR = os.path.join(os.path.dirname(os.path.realpath(nf_core.__file__)), 'pipeline-template')
+
+# Compiled template bundles, by template directory
+_template_bundles = {}
+
 class PipelineCreate(object):
     """ Object to create a new pipeline """
 
@@ -38,14 +51,14 @@ class PipelineCreate(object):
         """Function to init a new pipeline. Called by the main cli"""
 
         # Make the new pipeline
-        self.run_cookiecutter()
+        self.render_template()
 
         # Init the git repository and make the first commit
         if not self.no_git:
             self.git_init_pipeline()
 
-    def run_cookiecutter(self):
-        """Run cookiecutter to create a new pipeline"""
+    def render_template(self):
+        """Render the pipeline template in to the output directory"""
 
         logging.info("Creating new nf-core pipeline: {}".format(self.name))
 
@@ -60,31 +73,21 @@ class PipelineCreate(object):
         else:
             os.makedirs(self.outdir)
 
-        # Build the template in a temporary directory
-        tmpdir = tempfile.mkdtemp()
-        template = os.path.join(os.path.dirname(os.path.realpath(nf_core.__file__)), 'pipeline-template/')
-        cookiecutter.main.cookiecutter (
-            template,
-            extra_context = {
-                'name':self.name,
-                'description':self.description,
-                'author':self.author,
-                'name_noslash':self.name_noslash,
-                'name_docker':self.name_docker,
-                'version':self.new_version
-            },
-            no_input = True,
-            overwrite_if_exists = self.force,
-            output_dir = tmpdir
-        )
-
-        # Move the template to the output directory
-        for f in os.listdir(os.path.join(tmpdir, self.name_noslash)):
-            shutil.move(os.path.join(tmpdir, self.name_noslash, f), self.outdir)
-
-        # Delete the temporary directory
-        shutil.rmtree(tmpdir)
-
+        # Render the template straight in to the output directory
+        template = PipelineTemplate.load()
+        self.template_files, written = template.render(self.outdir, self.template_context())
+        logging.debug("Wrote {} of {} template files".format(len(written), len(self.template_files)))
+
+    def template_context(self):
+        """The values to render the pipeline template with"""
+        return {
+            'name':self.name,
+            'description':self.description,
+            'author':self.author,
+            'name_noslash':self.name_noslash,
+            'name_docker':self.name_docker,
+            'version':self.new_version
+        }
 
     def git_init_pipeline(self):
         """Initialise the new pipeline as a git repo and make first commit"""
@@ -93,3 +96,155 @@ class PipelineCreate(object):
         repo.git.add(A=True)
         repo.index.commit("initial template build from nf-core/tools, version {}".format(nf_core.__version__))
         logging.info("Done. Remember to add a remote and push to GitHub:\n  cd {}\n  git remote add origin git@github.com:USERNAME/REPO_NAME.git\n  git push".format(self.outdir))
+
+
+class PipelineTemplate(object):
+    """ A compiled bundle of the cookiecutter pipeline template
+
+    The template tree is read and compiled once, then rendered straight in to
+    a destination directory. Files without any Jinja markup, and binary files,
+    are kept verbatim. Use :meth:`load` to reuse a bundle within a process.
+
+    Args:
+        template_dir (str): Path to the cookiecutter template
+    """
+
+    ignore_names = ('__pycache__', '.DS_Store')
+    ignore_extensions = ('.pyc',)
+
+    def __init__(self, template_dir=TEMPLATE_DIR):
+        self.template_dir = template_dir
+        with io.open(os.path.join(template_dir, 'cookiecutter.json'), encoding='utf-8') as fh:
+            self.defaults = json.load(fh, object_pairs_hook=OrderedDict)
+        self.project_dir = [
+            os.path.join(template_dir, d) for d in os.listdir(template_dir)
+            if '{{' in d and os.path.isdir(os.path.join(template_dir, d))
+        ][0]
+        self.env = jinja2.Environment(
+            loader = jinja2.FileSystemLoader(self.project_dir),
+            keep_trailing_newline = True,
+            undefined = jinja2.StrictUndefined
+        )
+        # List of (path template, file template, verbatim content, newline, mode). Directories have no mode.
+        self.entries = []
+        self.compile()
+
+    @classmethod
+    def load(cls, template_dir=TEMPLATE_DIR):
+        """ Get the compiled bundle for a template, compiling it again only if a file has changed """
+        fingerprint = cls.fingerprint(template_dir)
+        if template_dir not in _template_bundles or _template_bundles[template_dir][0] != fingerprint:
+            _template_bundles[template_dir] = (fingerprint, cls(template_dir))
+        return _template_bundles[template_dir][1]
+
+    @classmethod
+    def fingerprint(cls, template_dir):
+        """ The path, size and modification time of every file in a template """
+        stats = []
+        for root, dirs, files in os.walk(template_dir):
+            dirs[:] = sorted(d for d in dirs if d not in cls.ignore_names)
+            for fn in sorted(files):
+                st = os.stat(os.path.join(root, fn))
+                stats.append((os.path.relpath(os.path.join(root, fn), template_dir), st.st_size, st.st_mtime))
+        return tuple(stats)
+
+    def ignored(self, name):
+        return name in self.ignore_names or name.endswith(self.ignore_extensions)
+
+    def compile_path(self, relpath):
+        """ Compile a relative path, if it has Jinja markup """
+        return self.env.from_string(relpath) if '{{' in relpath else relpath
+
+    def compile(self):
+        """ Compile every file in the template """
+        for root, dirs, files in os.walk(self.project_dir):
+            dirs[:] = sorted(d for d in dirs if not self.ignored(d))
+            for d in dirs:
+                relpath = os.path.relpath(os.path.join(root, d), self.project_dir)
+                self.entries.append((self.compile_path(relpath), None, None, None, None))
+            for fn in sorted(files):
+                if self.ignored(fn):
+                    continue
+                path = os.path.join(root, fn)
+                relpath = os.path.relpath(path, self.project_dir)
+                with open(path, 'rb') as fh:
+                    content = fh.read()
+                template = None
+                newline = '\n'
+                try:
+                    text = content.decode('utf-8')
+                except UnicodeDecodeError:
+                    text = None
+                if text is not None and '\0' not in text and ('{{' in text or '{%' in text or '{#' in text):
+                    template = self.env.get_template(relpath.replace(os.sep, '/'))
+                    content = None
+                    if '\r\n' in text:
+                        newline = '\r\n'
+                self.entries.append((self.compile_path(relpath), template, content, newline, os.stat(path).st_mode))
+
+    def context(self, extra_context=None):
+        """ Build the cookiecutter context, rendering defaults in the order they are given """
+        context = OrderedDict()
+        for key, value in self.defaults.items():
+            if extra_context and key in extra_context:
+                value = extra_context[key]
+            if isinstance(value, basestring):
+                value = self.env.from_string(value).render(cookiecutter=context)
+            context[key] = value
+        return context
+
+    def render_files(self, extra_context=None):
+        """ Render the template in memory
+
+        Args:
+            extra_context (dict): Values to use instead of the cookiecutter.json defaults
+
+        Yields:
+            tuple: The relative path, content and mode of each file.
+                Directories are given with a content and mode of None.
+        """
+        context = self.context(extra_context)
+        for path, template, content, newline, mode in self.entries:
+            if not isinstance(path, basestring):
+                path = path.render(cookiecutter=context)
+            if template is not None:
+                rendered = template.render(cookiecutter=context)
+                if newline != '\n':
+                    rendered = rendered.replace('\n', newline)
+                content = rendered.encode('utf-8')
+            yield path, content, mode
+
+    def render(self, outdir, extra_context=None):
+        """ Render the template in to a directory, only writing files that have changed
+
+        Args:
+            outdir (str): Directory to write the pipeline to
+            extra_context (dict): Values to use instead of the cookiecutter.json defaults
+
+        Returns:
+            tuple: Lists of the relative paths of all template files, and of the ones that were written
+        """
+        files = []
+        written = []
+        for path, content, mode in self.render_files(extra_context):
+            out_path = os.path.join(outdir, path)
+            if mode is None:
+                try:
+                    os.makedirs(out_path)
+                except OSError as e:
+                    if e.errno != errno.EEXIST:
+                        raise
+                continue
+            files.append(path)
+            try:
+                with open(out_path, 'rb') as fh:
+                    unchanged = fh.read() == content
+            except IOError:
+                unchanged = False
+            if not unchanged:
+                with open(out_path, 'wb') as fh:
+                    fh.write(content)
+                written.append(path)
+            if os.stat(out_path).st_mode & 0o7777 != mode & 0o7777:
+                os.chmod(out_path, mode & 0o7777)
+        return files, written
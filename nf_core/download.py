@@ -3,29 +3,37 @@
 
 from __future__ import print_function
 
-from io import BytesIO
+from multiprocessing.pool import ThreadPool
 import click
 import logging
 import hashlib
 import os
+import re
 import requests
 import requests_cache
+import shutil
 import subprocess
 import sys
-from zipfile import ZipFile
+import tempfile
+import threading
+from zipfile import BadZipfile, ZipFile
 
 
 import nf_core.list, nf_core.utils
 
 class DownloadWorkflow():
 
-    def __init__(self, pipeline, release=None, singularity=False, outdir=None):
+    def __init__(self, pipeline, release=None, singularity=False, outdir=None, parallel_downloads=4, parallel_builds=1, singularity_cache=None):
         """ Set class variables """
 
         self.pipeline = pipeline
         self.release = release
         self.singularity = singularity
         self.outdir = outdir
+        self.parallel_downloads = parallel_downloads
+        self.parallel_builds = parallel_builds
+        self.progress_bars = None
+        self.singularity_cache = SingularityImageCache(singularity_cache) if singularity_cache else None
 
         self.wf_name = None
         self.wf_sha = None
@@ -54,9 +62,10 @@ class DownloadWorkflow():
             "\n Output directory: {}".format(self.outdir)
         )
 
-        # Download the pipeline files
+        # Download the pipeline files, without the requests cache
         logging.info("Downloading workflow files from GitHub")
-        self.download_wf_files()
+        with requests_cache.disabled():
+            self.download_wf_files()
 
         # Download the singularity images
         if self.singularity:
@@ -67,13 +76,42 @@ class DownloadWorkflow():
             else:
                 os.mkdir(os.path.join(self.outdir, 'singularity-images'))
                 logging.info("Downloading {} singularity container{}".format(len(self.containers), 's' if len(self.containers) > 1 else ''))
-                for container in self.containers:
-                    try:
-                        # Download from singularity hub if we can
-                        self.download_shub_image(container)
-                    except RuntimeWarning:
-                        # Try to build from dockerhub
-                        self.pull_singularity_image(container)
+                self.download_singularity_images()
+
+    def download_singularity_images(self):
+        """ Fetch all singularity images for the workflow, several at a time
+
+        Up to `parallel_downloads` images are downloaded from singularity-hub
+        at once. Images that aren't on singularity-hub are built from dockerhub
+        with `singularity pull`, which is CPU and disk heavy, so these run in a
+        separate pool of `parallel_builds` at a time.
+        """
+        download_pool = ThreadPool(max(1, min(self.parallel_downloads, len(self.containers))))
+        build_pool = ThreadPool(max(1, self.parallel_builds))
+        builds = []
+        self.progress_bars = ProgressBars()
+
+        def fetch_image(container):
+            try:
+                # Download from singularity hub if we can
+                self.download_shub_image(container)
+            except RuntimeWarning:
+                # Try to build from dockerhub
+                builds.append(build_pool.apply_async(self.pull_singularity_image, (container,)))
+
+        # Disable the requests cache for all downloads here, as
+        # switching it on and off in each thread isn't thread-safe
+        with requests_cache.disabled():
+            try:
+                download_pool.map(fetch_image, self.containers)
+                for build in builds:
+                    build.get()
+            finally:
+                download_pool.close()
+                build_pool.close()
+                download_pool.join()
+                build_pool.join()
+                self.progress_bars = None
 
     def fetch_workflow_details(self, wfs):
         """ Fetch details of nf-core workflow to download
@@ -82,7 +120,14 @@ class DownloadWorkflow():
         - wfs   A nf_core.list.Workflows object
         """
         wfs.get_remote_workflows()
+        self.find_workflow_details(wfs)
 
+    def find_workflow_details(self, wfs):
+        """ Find details of nf-core workflow to download, without fetching the list of workflows
+
+        params:
+        - wfs   A nf_core.list.Workflows object, with remote workflows already fetched
+        """
         # Get workflow download details
         for wf in wfs.remote_workflows:
             if wf.full_name == self.pipeline or wf.name == self.pipeline:
@@ -147,14 +192,69 @@ class DownloadWorkflow():
         """ Download workflow files from GitHub - save in outdir """
         logging.debug("Downloading {}".format(self.wf_download_url))
 
-        # Download GitHub zip file into memory and extract
-        url = requests.get(self.wf_download_url)
-        zipfile = ZipFile(BytesIO(url.content))
-        zipfile.extractall(self.outdir)
+        # Stream the GitHub zip file to a temporary file on disk, then extract
+        with tempfile.TemporaryFile() as zip_fh:
+            self.download_file(self.wf_download_url, zip_fh)
+            zip_fh.seek(0)
+            self.extract_wf_files(zip_fh)
+
+    def download_file(self, url, fh, retries=3):
+        """ Stream a download to an open file handle, in chunks
+
+        If the connection drops, the download is resumed from where it
+        stopped using a HTTP Range request, up to `retries` times.
+        The caller disables the requests cache, as that isn't thread-safe.
+        """
+        downloaded = 0
+        for attempt in range(retries + 1):
+            headers = {}
+            if downloaded > 0:
+                headers['Range'] = 'bytes={}-'.format(downloaded)
+            try:
+                response = requests.get(url, headers=headers, stream=True, timeout=30)
+                if downloaded > 0 and response.status_code != 206:
+                    # Server doesn't support resuming, start again
+                    logging.debug("Could not resume download, restarting: {}".format(url))
+                    fh.seek(0)
+                    fh.truncate()
+                    downloaded = 0
+                response.raise_for_status()
+                for chunk in response.iter_content(chunk_size=1024*1024):
+                    if chunk:
+                        fh.write(chunk)
+                        downloaded += len(chunk)
+                return
+            except (requests.exceptions.ConnectionError, requests.exceptions.ChunkedEncodingError, requests.exceptions.Timeout) as e:
+                if attempt == retries:
+                    raise
+                logging.warn("Download interrupted after {} bytes, retrying: {}".format(downloaded, e))
 
-        # Rename the internal directory name to be more friendly
-        gh_name = '{}-{}'.format(self.wf_name, self.wf_sha).split('/')[-1]
-        os.rename(os.path.join(self.outdir, gh_name), os.path.join(self.outdir, 'workflow'))
+    def extract_wf_files(self, zip_fh):
+        """ Extract the workflow files from an open GitHub zip file
+
+        The top level directory in the archive is renamed to
+        `workflow` as it is extracted. Files are streamed out
+        one at a time so that memory use doesn't depend on file sizes.
+        """
+        with ZipFile(zip_fh) as zipfile:
+            for member in zipfile.infolist():
+                # Swap the GitHub directory name for something more friendly
+                path_parts = member.filename.split('/')
+                if len(path_parts) < 2 or '..' in path_parts or member.filename.startswith('/'):
+                    continue
+                out_path = os.path.join(self.outdir, 'workflow', *path_parts[1:])
+                if member.filename.endswith('/'):
+                    if not os.path.isdir(out_path):
+                        os.makedirs(out_path)
+                    continue
+                if not os.path.isdir(os.path.dirname(out_path)):
+                    os.makedirs(os.path.dirname(out_path))
+                with zipfile.open(member) as src, open(out_path, 'wb') as dst:
+                    shutil.copyfileobj(src, dst, 1024*1024)
+                # Keep file permissions (eg. executable scripts in bin/)
+                mode = (member.external_attr >> 16) & 0o777
+                if mode:
+                    os.chmod(out_path, mode)
 
     def find_singularity_images(self):
         """ Find singularity image names for workflow """
@@ -168,9 +268,12 @@ class DownloadWorkflow():
                 self.containers.append(v.strip('"').strip("'"))
 
     def download_shub_image(self, container):
-        """ Download singularity images from singularity-hub """
+        """ Download singularity images from singularity-hub
 
-        out_name = '{}.simg'.format(container.replace('nfcore', 'nf-core').replace('/','-').replace(':', '-'))
+        The caller disables the requests cache, as that isn't thread-safe.
+        """
+
+        out_name = singularity_image_filename(container)
         out_path = os.path.abspath(os.path.join(self.outdir, 'singularity-images', out_name))
         shub_api_url = 'https://www.singularity-hub.org/api/container/{}'.format(container.replace('nfcore', 'nf-core').replace('docker://', ''))
 
@@ -178,33 +281,42 @@ class DownloadWorkflow():
         response = requests.get(shub_api_url, timeout=10)
         if response.status_code == 200:
             shub_response = response.json()
+
+            # Use a copy of the image from a previous download if we have one
+            if self.singularity_cache is not None and self.singularity_cache.get(out_name, shub_response['version'], out_path):
+                logging.info("Using cached singularity image: {}".format(out_name))
+                return
+
             # Stream the download as it's going to be large
             logging.debug("Starting download: {}".format(shub_response['image']))
 
-            # Don't use the requests cache for the download
-            with requests_cache.disabled():
-                dl_request = requests.get(shub_response['image'], stream=True)
-
-                # Check that we got a good response code
-                if dl_request.status_code == 200:
-                    total_size = int(dl_request.headers.get('content-length'))
-                    logging.debug("Total image file size: {} bytes".format(total_size))
-                    dl_label = "{} [{:.2f}MB]".format(out_name, total_size/1024.0/1024)
-                    # Open file in bytes mode
-                    with open(out_path, 'wb') as f:
-                        dl_iter = dl_request.iter_content(1024)
-                        # Use a click progress bar whilst we stream the download
-                        with click.progressbar(dl_iter, length=total_size/1024, label=dl_label, show_pos=True) as pbar:
-                            for chunk in pbar:
-                                if chunk:
-                                    f.write(chunk)
-                                    f.flush()
-
-                    # Check that the downloaded image has the right md5sum hash
-                    self.validate_md5(out_path, shub_response['version'])
-                else:
-                    logging.error("Error with singularity hub API call: {}".format(response.status_code))
-                    raise RuntimeWarning("Error with singularity hub API call: {}".format(response.status_code))
+            dl_request = requests.get(shub_response['image'], stream=True)
+
+            # Check that we got a good response code
+            if dl_request.status_code == 200:
+                total_size = int(dl_request.headers.get('content-length'))
+                logging.debug("Total image file size: {} bytes".format(total_size))
+                dl_label = "{} [{:.2f}MB]".format(out_name, total_size/1024.0/1024)
+                # Open file in bytes mode, hashing the chunks as they are written
+                hash_md5 = hashlib.md5()
+                chunk_size = 1024*1024
+                with open(out_path, 'wb', chunk_size) as f:
+                    dl_iter = dl_request.iter_content(chunk_size)
+                    # Use a click progress bar whilst we stream the download
+                    pbar_file = self.progress_bars.add_bar() if self.progress_bars is not None else None
+                    with click.progressbar(dl_iter, length=-(-total_size // chunk_size), label=dl_label, show_pos=True, file=pbar_file) as pbar:
+                        for chunk in pbar:
+                            if chunk:
+                                f.write(chunk)
+                                hash_md5.update(chunk)
+
+                # Check that the downloaded image has the right md5sum hash
+                self.validate_md5(out_path, shub_response['version'], hash_md5.hexdigest())
+                if self.singularity_cache is not None:
+                    self.singularity_cache.add(out_path, out_name, shub_response['version'])
+            else:
+                logging.error("Error with singularity hub API call: {}".format(response.status_code))
+                raise RuntimeWarning("Error with singularity hub API call: {}".format(response.status_code))
 
         elif response.status_code == 404:
             logging.debug("Singularity image not found on singularity-hub")
@@ -215,16 +327,25 @@ class DownloadWorkflow():
 
     def pull_singularity_image(self, container):
         """ Use a local installation of singularity to pull an image from docker hub """
-        out_name = '{}.simg'.format(container.replace('nfcore', 'nf-core').replace('/','-').replace(':', '-'))
+        out_name = singularity_image_filename(container)
         out_path = os.path.abspath(os.path.join(self.outdir, 'singularity-images', out_name))
         address = 'docker://{}'.format(container.replace('docker://', ''))
+
+        # Images built from mutable tags could change, so are only cached for fixed tags
+        cache_version = None
+        if self.singularity_cache is not None and re.search(r':(?!latest$)[^/:]+$', address):
+            cache_version = 'docker'
+            if self.singularity_cache.get(out_name, cache_version, out_path):
+                logging.info("Using cached singularity image: {}".format(out_name))
+                return
+
         singularity_command = ["singularity", "pull", "--name", out_path, address]
         logging.info("Building singularity image from dockerhub: {}".format(address))
         logging.debug("Singularity command: {}".format(' '.join(singularity_command)))
 
         # Try to use singularity to pull image
         try:
-            subprocess.call(singularity_command)
+            returncode = subprocess.call(singularity_command)
         except OSError as e:
             if e.errno == os.errno.ENOENT:
                 # Singularity is not installed
@@ -232,19 +353,413 @@ class DownloadWorkflow():
             else:
                 # Something else went wrong with singularity command
                 raise e
-
-    def validate_md5(self, fname, expected):
-        """ Calculate the md5sum for a file on the disk and validate with expected """
+        else:
+            if returncode != 0:
+                # Don't leave a partly built image behind
+                logging.error("Singularity pull failed with exit code {}: {}".format(returncode, address))
+                if os.path.isfile(out_path):
+                    os.remove(out_path)
+            elif cache_version is not None and os.path.isfile(out_path):
+                self.singularity_cache.add(out_path, out_name, cache_version)
+
+    def validate_md5(self, fname, expected, file_hash=None):
+        """ Validate the md5sum for a file with expected
+
+        Calculates the md5sum of the file on disk, unless it
+        has already been calculated and is given as file_hash.
+        """
         logging.debug("Validating image hash: {}".format(fname))
 
         # Calculate the md5 for the file on disk
-        hash_md5 = hashlib.md5()
-        with open(fname, "rb") as f:
-            for chunk in iter(lambda: f.read(4096), b""):
-                hash_md5.update(chunk)
-        file_hash = hash_md5.hexdigest()
+        if file_hash is None:
+            hash_md5 = hashlib.md5()
+            with open(fname, "rb") as f:
+                for chunk in iter(lambda: f.read(1024*1024), b""):
+                    hash_md5.update(chunk)
+            file_hash = hash_md5.hexdigest()
 
         if file_hash == expected:
             logging.debug('md5 sum of image matches expected: {}'.format(expected))
         else:
             raise IOError ("{} md5 does not match remote: {} - {}".format(fname, expected, file_hash))
+
+
+class MirrorWorkflows(object):
+    """ Download many nf-core pipelines and releases in one go, eg. for an offline mirror
+
+    The list of nf-core pipelines is fetched once for the whole batch.
+    Releases that have already been downloaded to the mirror directory are
+    skipped, and workflow archives are downloaded several at a time. Each
+    release is downloaded to a `.partial` directory first and only moved in
+    to place once complete, so an interrupted mirror can be re-run.
+
+    With singularity, each distinct container image is only downloaded once
+    for the whole batch, to `<outdir>/singularity-images`. Images are then
+    hardlinked in to the `singularity-images` directory of every release
+    that uses them.
+
+    Args:
+        outdir (str): Mirror directory, with one subdirectory for each release
+        manifest (list): (pipeline, release) pairs to download. A release of None
+            means all releases of that pipeline. If None, all releases of
+            all nf-core pipelines are downloaded.
+    """
+
+    def __init__(self, outdir, manifest=None, singularity=False, parallel_downloads=4, parallel_builds=1, singularity_cache=None):
+        """ Set class variables """
+
+        self.outdir = outdir
+        self.manifest = manifest
+        self.singularity = singularity
+        self.parallel_downloads = parallel_downloads
+        self.parallel_builds = parallel_builds
+        self.singularity_cache = singularity_cache
+
+        self.downloads = list()
+        self.failed = list()
+
+    def mirror_workflows(self):
+        """ Main function to download a batch of nf-core workflows
+
+        Returns:
+            list: DownloadWorkflow objects for releases that could not be downloaded
+        """
+        wfs = nf_core.list.Workflows()
+        wfs.get_remote_workflows()
+        try:
+            self.plan_downloads(wfs)
+        except LookupError:
+            sys.exit(1)
+
+        if len(self.downloads) == 0:
+            logging.info("All releases have already been downloaded to '{}'".format(self.outdir))
+            return self.failed
+        if not os.path.isdir(self.outdir):
+            os.makedirs(self.outdir)
+
+        # Download the workflow files, several archives at a time
+        logging.info("Downloading {} pipeline release{}".format(len(self.downloads), 's' if len(self.downloads) > 1 else ''))
+        pool = ThreadPool(max(1, min(self.parallel_downloads, len(self.downloads))))
+        # Disable the requests cache once for all threads, as it isn't thread-safe
+        with requests_cache.disabled():
+            try:
+                pool.map(self.download_release_files, self.downloads)
+            finally:
+                pool.close()
+                pool.join()
+        self.downloads = [dl for dl in self.downloads if dl not in self.failed]
+
+        # Download the singularity images used by any release
+        if self.singularity:
+            self.download_singularity_images()
+
+        # Move the completed releases in to place
+        for dl in self.downloads:
+            final_outdir = dl.outdir[:-len('.partial')]
+            os.rename(dl.outdir, final_outdir)
+            dl.outdir = final_outdir
+            logging.info("Downloaded {} {}".format(dl.wf_name, dl.release))
+        return self.failed
+
+    def plan_downloads(self, wfs):
+        """ Set up a DownloadWorkflow for every release that is not yet in the mirror
+
+        params:
+        - wfs   A nf_core.list.Workflows object, with remote workflows already fetched
+        """
+        wanted = list()
+        if self.manifest is None:
+            for wf in wfs.remote_workflows:
+                wanted.extend([(wf.full_name, r['tag_name']) for r in wf.releases])
+        else:
+            for pipeline, release in self.manifest:
+                if release is not None:
+                    wanted.append((pipeline, release))
+                    continue
+                for wf in wfs.remote_workflows:
+                    if pipeline in (wf.full_name, wf.name):
+                        if len(wf.releases) == 0:
+                            logging.warn("{} has no releases, skipping".format(wf.full_name))
+                        wanted.extend([(wf.full_name, r['tag_name']) for r in wf.releases])
+                        break
+                else:
+                    logging.error("Not able to find pipeline '{}'".format(pipeline))
+                    raise LookupError("Not able to find pipeline '{}'".format(pipeline))
+
+        planned = set()
+        for pipeline, release in wanted:
+            dl = DownloadWorkflow(
+                pipeline, release, self.singularity,
+                parallel_downloads = self.parallel_downloads,
+                parallel_builds = self.parallel_builds,
+                singularity_cache = self.singularity_cache
+            )
+            dl.find_workflow_details(wfs)
+            final_outdir = os.path.join(self.outdir, dl.outdir)
+            if final_outdir in planned:
+                continue
+            planned.add(final_outdir)
+            if os.path.exists(final_outdir):
+                logging.debug("Already downloaded, skipping: {} {}".format(dl.wf_name, dl.release))
+                continue
+            dl.outdir = '{}.partial'.format(final_outdir)
+            if os.path.exists(dl.outdir):
+                logging.debug("Removing incomplete download: {}".format(dl.outdir))
+                shutil.rmtree(dl.outdir)
+            self.downloads.append(dl)
+
+    def download_release_files(self, dl):
+        """ Download the workflow files for one release, noting any failure """
+        try:
+            dl.download_wf_files()
+        except (requests.exceptions.RequestException, IOError, BadZipfile) as e:
+            logging.error("Could not download {} {}: {}".format(dl.wf_name, dl.release, e))
+            self.failed.append(dl)
+            if os.path.exists(dl.outdir):
+                shutil.rmtree(dl.outdir)
+
+    def download_singularity_images(self):
+        """ Download each distinct singularity image used by the batch once, and link it in to every release """
+
+        images_dir = os.path.join(self.outdir, 'singularity-images')
+        if not os.path.isdir(images_dir):
+            os.mkdir(images_dir)
+
+        # Find every image that isn't already in the mirror
+        containers = list()
+        for dl in self.downloads:
+            logging.debug("Fetching container names for {} {}".format(dl.wf_name, dl.release))
+            dl.find_singularity_images()
+            for container in dl.containers:
+                if container not in containers and not os.path.exists(os.path.join(images_dir, singularity_image_filename(container))):
+                    containers.append(container)
+
+        # Download new images to a temporary directory, so that partial images never end up in the mirror
+        if len(containers) > 0:
+            logging.info("Downloading {} singularity container{}".format(len(containers), 's' if len(containers) > 1 else ''))
+            images_dl = DownloadWorkflow(
+                'mirror', singularity = True,
+                outdir = os.path.join(self.outdir, '.singularity-images.partial'),
+                parallel_downloads = self.parallel_downloads,
+                parallel_builds = self.parallel_builds,
+                singularity_cache = self.singularity_cache
+            )
+            images_dl.containers = containers
+            if os.path.exists(images_dl.outdir):
+                shutil.rmtree(images_dl.outdir)
+            os.makedirs(os.path.join(images_dl.outdir, 'singularity-images'))
+            images_dl.download_singularity_images()
+            for fn in os.listdir(os.path.join(images_dl.outdir, 'singularity-images')):
+                os.rename(os.path.join(images_dl.outdir, 'singularity-images', fn), os.path.join(images_dir, fn))
+            shutil.rmtree(images_dl.outdir)
+
+        # Link the images in to each release
+        for dl in self.downloads:
+            if len(dl.containers) == 0:
+                continue
+            os.mkdir(os.path.join(dl.outdir, 'singularity-images'))
+            for container in set(dl.containers):
+                fn = singularity_image_filename(container)
+                if os.path.isfile(os.path.join(images_dir, fn)):
+                    link_or_copy(os.path.join(images_dir, fn), os.path.join(dl.outdir, 'singularity-images', fn))
+                else:
+                    logging.warn("Singularity image not downloaded for {} {}: {}".format(dl.wf_name, dl.release, container))
+
+
+def read_mirror_manifest(fn):
+    """ Read a list of pipelines and releases to download
+
+    Each line has a pipeline name followed by an optional release,
+    separated by whitespace. If the release is left out, all releases of
+    the pipeline are downloaded. Blank lines and lines starting with # are ignored.
+
+    Returns:
+        list: (pipeline, release) pairs, with a release of None for all releases
+    """
+    manifest = list()
+    with open(fn, 'r') as fh:
+        for line in fh:
+            fields = line.split('#', 1)[0].split()
+            if len(fields) == 0:
+                continue
+            if len(fields) > 2:
+                raise ValueError("Could not parse manifest line: '{}'".format(line.strip()))
+            manifest.append((fields[0], fields[1] if len(fields) == 2 else None))
+    return manifest
+
+
+def singularity_image_filename(container):
+    """ Get the file name to save the singularity image for a container as """
+    return '{}.simg'.format(container.replace('nfcore', 'nf-core').replace('/','-').replace(':', '-'))
+
+class SingularityImageCache(object):
+    """ Local store of singularity images, shared between downloads
+
+    Images are stored by name and version: the md5 hash from singularity-hub,
+    or 'docker' for images built from a fixed dockerhub tag. Images are
+    hardlinked in to the download directory where possible, so that a
+    cached image takes no extra disk space. The modification time of
+    each cached image is updated whenever it is used, so that the
+    least recently used images can be removed with prune().
+
+    Args:
+        cachedir (str): Path to the cache directory, created if needed
+    """
+
+    def __init__(self, cachedir):
+        self.cachedir = os.path.abspath(cachedir)
+        if not os.path.isdir(self.cachedir):
+            os.makedirs(self.cachedir)
+
+    def image_path(self, name, version):
+        """ Get the path to an image in the cache """
+        if name.endswith('.simg'):
+            name = name[:-5]
+        return os.path.join(self.cachedir, '{}.{}.simg'.format(name, version))
+
+    def get(self, name, version, out_path):
+        """ Link a cached image to out_path
+
+        Returns:
+            bool: True if the image was in the cache, False if not
+        """
+        cache_path = self.image_path(name, version)
+        if not os.path.isfile(cache_path):
+            return False
+        logging.debug("Found cached singularity image: {}".format(cache_path))
+        link_or_copy(cache_path, out_path)
+        # Mark as recently used
+        os.utime(cache_path, None)
+        return True
+
+    def add(self, path, name, version):
+        """ Add a downloaded image to the cache """
+        cache_path = self.image_path(name, version)
+        if os.path.isfile(cache_path):
+            return
+        # Link or copy to a temporary name first so that other downloads never see a partial image
+        tmp_path = '{}.{}.tmp'.format(cache_path, os.getpid())
+        try:
+            link_or_copy(path, tmp_path)
+            os.rename(tmp_path, cache_path)
+            logging.debug("Added singularity image to cache: {}".format(cache_path))
+        except (IOError, OSError) as e:
+            logging.warn("Could not add singularity image to cache: {}".format(e))
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+    def images(self):
+        """ Get (path, size, last used time) for each cached image, least recently used first """
+        images = []
+        for fn in os.listdir(self.cachedir):
+            if fn.endswith('.simg'):
+                stat = os.stat(os.path.join(self.cachedir, fn))
+                images.append((os.path.join(self.cachedir, fn), stat.st_size, stat.st_mtime))
+        return sorted(images, key=lambda image: image[2])
+
+    def prune(self, max_size):
+        """ Remove least recently used images until the cache is at most max_size bytes
+
+        Returns:
+            list: Paths of the removed images
+        """
+        images = self.images()
+        total_size = sum(image[1] for image in images)
+        removed = []
+        for path, size, _ in images:
+            if total_size <= max_size:
+                break
+            logging.info("Removing cached singularity image: {}".format(os.path.basename(path)))
+            os.remove(path)
+            total_size -= size
+            removed.append(path)
+        return removed
+
+
+def link_or_copy(src, dst):
+    """ Hardlink src to dst, falling back to a reflink and then a full copy
+
+    Hardlinks only work within a filesystem. Reflinks (copy-on-write copies)
+    are tried next as they are almost as cheap on filesystems that support them.
+    """
+    try:
+        os.link(src, dst)
+        return
+    except OSError as e:
+        logging.debug("Could not hardlink {}: {}".format(src, e))
+    try:
+        with open(os.devnull, 'w') as devnull:
+            if subprocess.call(['cp', '--reflink=always', src, dst], stdout=devnull, stderr=devnull) == 0:
+                return
+    except OSError:
+        pass
+    shutil.copyfile(src, dst)
+
+
+def parse_size(size):
+    """ Parse a size such as '500M' or '20G' to a number of bytes """
+    m = re.match(r'^\s*(\d+(?:\.\d+)?)\s*([KMGT]?)B?\s*$', str(size), re.IGNORECASE)
+    if not m:
+        raise ValueError("Could not parse size: '{}'".format(size))
+    multiplier = 1024 ** ' KMGT'.index(m.group(2).upper() or ' ')
+    return int(float(m.group(1)) * multiplier)
+
+
+class ProgressBars(object):
+    """ Draw several click progress bars at once, one terminal line each
+
+    Each bar is given a file-like object from add_bar() to write to. When
+    writing to a terminal, all bars are redrawn together whenever one of
+    them updates. Otherwise output is passed straight through.
+    """
+
+    def __init__(self, stream=None):
+        self.stream = stream if stream is not None else click.get_text_stream('stdout')
+        self.lines = []
+        self.drawn = 0
+        self.lock = threading.Lock()
+
+    def add_bar(self):
+        """ Get a file-like object for a new progress bar """
+        with self.lock:
+            self.lines.append('')
+            return ProgressBarLine(self, len(self.lines) - 1)
+
+    def isatty(self):
+        try:
+            return self.stream.isatty()
+        except AttributeError:
+            return False
+
+    def write(self, index, text):
+        """ Update a single progress bar and redraw them all """
+        with self.lock:
+            if not self.isatty():
+                self.stream.write(text)
+                return
+            # click redraws each bar on the same line, starting with a carriage return
+            line = re.sub(r'\x1b\[[0-9;?]*[a-zA-Z]', '', self.lines[index] + text)
+            self.lines[index] = line.split('\r')[-1].replace('\n', '')
+            if self.drawn > 0:
+                self.stream.write('\x1b[{}A'.format(self.drawn))
+            for line in self.lines:
+                self.stream.write('\r\x1b[K{}\n'.format(line))
+            self.drawn = len(self.lines)
+            self.stream.flush()
+
+
+class ProgressBarLine(object):
+    """ File-like object for a single progress bar in a ProgressBars group """
+
+    def __init__(self, bars, index):
+        self.bars = bars
+        self.index = index
+
+    def isatty(self):
+        return self.bars.isatty()
+
+    def write(self, text):
+        self.bars.write(self.index, text)
+
+    def flush(self):
+        pass
@@ -2,6 +2,8 @@
 """ List software licences for a given workflow """
 
 from __future__ import print_function
+from collections import OrderedDict
+from multiprocessing.pool import ThreadPool
 
 import logging
 import json
@@ -11,21 +13,122 @@ import sys
 import tabulate
 import yaml
 
-import nf_core.lint
+import nf_core.utils
+
+try:
+    basestring
+except NameError:
+    basestring = str
+
+# Rules to normalise licence names, applied in order: (pattern, replacement)
+LICENCE_NAME_RULES = [
+    (re.compile(r'GNU General Public License v\d \(([^\)]+)\)'), r'\1'),
+    (re.compile(r'GNU GENERAL PUBLIC LICENSE', re.IGNORECASE), 'GPL'),
+    (re.compile(r'GPL-'), 'GPLv'),
+    (re.compile(r'GPL(\d)'), r'GPLv\1'),
+    (re.compile(r'GPL \(([^\)]+)\)'), r'GPL \1'),
+    (re.compile(r'GPL\s*v'), 'GPLv'),
+    (re.compile(r'\s*(>=?)\s*(\d)'), r' \1\2'),
+]
+
+# Rules to find the SPDX identifier for a normalised licence name, the first match is used:
+# (pattern matching the whole name, identifier with {} for the version captured by the pattern)
+LICENCE_SPDX_RULES = [
+    (re.compile(r'GPLv(\d(?:\.\d)?)(?:-only)?', re.IGNORECASE), 'GPL-{}-only'),
+    (re.compile(r'GPLv(\d(?:\.\d)?)(?:\+|-or-later| or later.*)', re.IGNORECASE), 'GPL-{}-or-later'),
+    (re.compile(r'GPL >=(\d(?:\.\d)?)', re.IGNORECASE), 'GPL-{}-or-later'),
+    (re.compile(r'LGPLv(\d(?:\.\d)?)(?:-only)?', re.IGNORECASE), 'LGPL-{}-only'),
+    (re.compile(r'LGPLv(\d(?:\.\d)?)(?:\+|-or-later| or later.*)', re.IGNORECASE), 'LGPL-{}-or-later'),
+    (re.compile(r'LGPL >=(\d(?:\.\d)?)', re.IGNORECASE), 'LGPL-{}-or-later'),
+    (re.compile(r'AGPLv(\d(?:\.\d)?)(?:-only)?', re.IGNORECASE), 'AGPL-{}-only'),
+    (re.compile(r'MIT(?: License)?', re.IGNORECASE), 'MIT'),
+    (re.compile(r'(?:BSD[-_ ]2[-_ ]Clause|2-Clause BSD)', re.IGNORECASE), 'BSD-2-Clause'),
+    (re.compile(r'(?:BSD[-_ ]3[-_ ]Clause|3-Clause BSD)', re.IGNORECASE), 'BSD-3-Clause'),
+    (re.compile(r'Apache(?: Software)?(?: License)?,?(?: Version)?[- ]2(?:\.0)?', re.IGNORECASE), 'Apache-2.0'),
+    (re.compile(r'Artistic(?: License)?[- ](\d(?:\.\d)?)', re.IGNORECASE), 'Artistic-{}'),
+    (re.compile(r'(?:MPL|Mozilla Public License)[- ]2(?:\.0)?(?: \(MPL 2\.0\))?', re.IGNORECASE), 'MPL-2.0'),
+    (re.compile(r'(?:PSF|Python Software Foundation License)', re.IGNORECASE), 'PSF-2.0'),
+    (re.compile(r'(?:BSL-1\.0|Boost Software License 1\.0)', re.IGNORECASE), 'BSL-1.0'),
+    (re.compile(r'ISC', re.IGNORECASE), 'ISC'),
+    (re.compile(r'Zlib', re.IGNORECASE), 'Zlib'),
+    (re.compile(r'CC0(?:-1\.0)?', re.IGNORECASE), 'CC0-1.0'),
+    (re.compile(r'CC[- ]BY[- ](\d(?:\.\d)?)', re.IGNORECASE), 'CC-BY-{}'),
+]
+
+# The same few hundred licence names are used by most packages, so results are remembered
+licence_name_cache = {}
+spdx_id_cache = {}
+
+def clean_licence_name(licence):
+    """ Normalise a licence name using LICENCE_NAME_RULES """
+    try:
+        return licence_name_cache[licence]
+    except KeyError:
+        pass
+    clean = licence
+    for pattern, replacement in LICENCE_NAME_RULES:
+        clean = pattern.sub(replacement, clean)
+    licence_name_cache[licence] = clean
+    return clean
+
+def spdx_licence_id(licence):
+    """
+    Get the SPDX identifier or expression for a normalised licence name
+
+    Alternative licences separated by '|' give an SPDX 'OR' expression,
+    and R style '+ file LICENSE' suffixes are ignored.
+
+    Returns None if there is no rule for the licence, or for any of the alternatives.
+    """
+    try:
+        return spdx_id_cache[licence]
+    except KeyError:
+        pass
+    spdx_ids = []
+    for part in licence.split('|'):
+        part = re.sub(r'\s*\+?\s*file LICEN[CS]E$', '', part.strip())
+        for pattern, spdx_id in LICENCE_SPDX_RULES:
+            m = pattern.match(part)
+            if m and m.end() == len(part):
+                version = m.group(1) if m.groups() else None
+                if version is not None and '.' not in version:
+                    version += '.0'
+                spdx_ids.append(spdx_id.format(version))
+                break
+        else:
+            # Empty parts are left over from eg. 'GPL-3 | file LICENSE'
+            if part:
+                spdx_ids = None
+                break
+    result = ' OR '.join(spdx_ids) if spdx_ids else None
+    spdx_id_cache[licence] = result
+    return result
 
 class WorkflowLicences():
     """ Class to hold all licence info """
 
-    def __init__(self, pipeline, json=False):
+    # Number of Anaconda API requests to make at the same time
+    max_api_connections = 10
+
+    def __init__(self, pipeline, json=False, spdx=False):
         """ Set class variables """
         self.pipeline = pipeline
         if self.pipeline.startswith('nf-core/'):
             self.pipeline = self.pipeline[8:]
         self.json = json
+        self.spdx = spdx
         self.conda_package_licences = {}
+        self.package_store = None
+        self.licence_indexes = {}
 
     def fetch_conda_licences(self):
         """ Get the conda licences """
+        nf_core.utils.setup_requests_cachedir()
+        deps, channels = self.fetch_conda_dependencies()
+        self.resolve_licences(deps, channels)
+
+    def fetch_conda_dependencies(self):
+        """ Get the conda dependencies and channels from the pipeline environment.yml """
         env_url = 'https://raw.githubusercontent.com/nf-core/{}/master/environment.yml'.format(self.pipeline)
         response = requests.get(env_url)
 
@@ -34,48 +137,69 @@ class WorkflowLicences():
             logging.error("Couldn't find pipeline nf-core/{}".format(self.pipeline))
             raise LookupError("Couldn't find pipeline nf-core/{}".format(self.pipeline))
 
-        lint_obj = nf_core.lint.PipelineLint(self.pipeline)
-        lint_obj.conda_config = yaml.load(response.text)
+        conda_config = yaml.safe_load(response.text) or {}
         # Check conda dependency list
-        for dep in lint_obj.conda_config.get('dependencies', []):
-            try:
-                if isinstance(dep, str):
-                    lint_obj.check_anaconda_package(dep)
-                elif isinstance(dep, dict):
-                    lint_obj.check_pip_package(dep)
-            except ValueError:
+        deps = [dep for dep in conda_config.get('dependencies', []) if isinstance(dep, basestring)]
+        return deps, conda_config.get('channels', [])
+
+    def resolve_licences(self, deps, channels, package_info=None):
+        """ Find the licences for conda dependencies
+
+        Metadata for every channel that each dependency could come
+        from is fetched in one concurrent batch, unless it has already
+        been fetched and is given in package_info. The result from the
+        highest priority channel with the package is used.
+        """
+        sources = dict((dep, nf_core.utils.anaconda_package_sources(dep, channels)) for dep in deps)
+        if package_info is None:
+            if self.package_store is None:
+                self.package_store = nf_core.utils.PackageMetadataStore()
+            package_info = self.package_store.get_many([src for dep in deps for src in sources[dep]], self.max_api_connections)
+
+        for dep in deps:
+            depver = dep.split('=', 1)[1] if '=' in dep else None
+            for src in sources[dep]:
+                data = package_info.get(src)
+                if isinstance(data, dict):
+                    licences = self.licence_index(src, data).get(depver or None, set())
+                    # Main licence field
+                    if len(licences) == 0 and isinstance(data.get('license'), basestring):
+                        licences = set([data['license']])
+                    self.conda_package_licences[dep] = self.clean_licence_names(sorted(licences))
+                    break
+                elif data is not None:
+                    # Couldn't reach the API
+                    logging.error("Couldn't get licence information for {}".format(dep))
+                    break
+            else:
                 logging.error("Couldn't get licence information for {}".format(dep))
 
-        for dep, data in lint_obj.conda_package_info.items():
-            try:
-                depname, depver = dep.split('=', 1)
-                licences = set()
-                # Licence for each version
-                for f in data['files']:
-                    if not depver or depver == f.get('version'):
-                        try:
-                            licences.add(f['attrs']['license'])
-                        except KeyError:
-                            pass
-                # Main licence field
-                if len(list(licences)) == 0 and isinstance(data['license'], basestring):
-                    licences.add(data['license'])
-                self.conda_package_licences[dep] = self.clean_licence_names(list(licences))
-            except KeyError:
-                pass
+    def licence_index(self, source, data):
+        """ Get the licences of each version of a package
+
+        The index is built once for each package, as packages can
+        have thousands of files (one for each build).
+
+        Returns:
+            dict: Set of licences for each version, with the key None for all versions
+        """
+        if source not in self.licence_indexes:
+            index = {None: set()}
+            for f in data.get('files', []):
+                try:
+                    licence = f['attrs']['license']
+                except (KeyError, TypeError):
+                    continue
+                index.setdefault(f.get('version'), set()).add(licence)
+                index[None].add(licence)
+            self.licence_indexes[source] = index
+        return self.licence_indexes[source]
 
     def clean_licence_names(self, licences):
-        """ Normalise varying licence names """
-        clean_licences = []
-        for l in licences:
-            l = re.sub(r'GNU General Public License v\d \(([^\)]+)\)', r'\1', l)
-            l = re.sub(r'GNU GENERAL PUBLIC LICENSE', 'GPL', l, flags=re.IGNORECASE)
-            l = l.replace('GPL-', 'GPLv')
-            l = re.sub(r'GPL(\d)', r'GPLv\1', l)
-            l = re.sub(r'GPL \(([^\)]+)\)', r'GPL \1', l)
-            l = re.sub(r'GPL\s*v', 'GPLv', l)
-            l = re.sub(r'\s*(>=?)\s*(\d)', r' \1\2', l)
-            clean_licences.append(l)
+        """ Normalise varying licence names, or convert them to SPDX identifiers if we can """
+        clean_licences = [clean_licence_name(l) for l in licences]
+        if self.spdx:
+            clean_licences = [spdx_licence_id(l) or l for l in clean_licences]
         return clean_licences
 
     def print_licences(self):
@@ -90,7 +214,7 @@ class WorkflowLicences():
         else:
             licence_list = []
             for dep, licences in self.conda_package_licences.items():
-                depname, depver = dep.split('=', 1)
+                depname, _, depver = dep.partition('=')
                 try:
                     depname = depname.split('::')[1]
                 except IndexError:
@@ -102,3 +226,100 @@ class WorkflowLicences():
             print("", file=sys.stderr)
             print(tabulate.tabulate(licence_list, headers=['Package Name', 'Version', 'Licence']))
             print("", file=sys.stderr)
+
+
+class PipelinesLicences():
+    """ Licences of the conda packages used by many pipelines, as one report
+
+    The environment.yml files of all pipelines are fetched concurrently,
+    then the package metadata for every distinct dependency is fetched in
+    a single batch, so packages shared by pipelines are only looked up once.
+
+    Args:
+        pipelines (list): Pipeline names. If None, all nf-core pipelines are used.
+        json (bool): Print the report as JSON
+        spdx (bool): Give licences as SPDX identifiers where possible
+    """
+
+    def __init__(self, pipelines=None, json=False, spdx=False):
+        """ Set class variables """
+        self.pipelines = pipelines
+        self.json = json
+        self.spdx = spdx
+        self.workflow_licences = []
+        self.package_store = None
+
+    def fetch_conda_licences(self):
+        """ Get the conda licences for every pipeline """
+        if self.pipelines is None:
+            remote_workflows = nf_core.utils.PipelineIndex().get().get('remote_workflows', [])
+            self.pipelines = [wf['name'] for wf in remote_workflows if not wf.get('archived')]
+        self.workflow_licences = [WorkflowLicences(pipeline, spdx=self.spdx) for pipeline in self.pipelines]
+        if len(self.workflow_licences) == 0:
+            return
+
+        # Fetch the environment.yml files concurrently
+        def fetch_dependencies(wf_licences):
+            try:
+                return wf_licences.fetch_conda_dependencies()
+            except (LookupError, requests.exceptions.RequestException, yaml.YAMLError) as e:
+                logging.warning("Skipping nf-core/{}: {}".format(wf_licences.pipeline, e))
+                return None
+        pool = ThreadPool(min(WorkflowLicences.max_api_connections, len(self.workflow_licences)))
+        try:
+            dependencies = pool.map(fetch_dependencies, self.workflow_licences)
+        finally:
+            pool.close()
+            pool.join()
+        dependencies = dict((wf_licences.pipeline, deps) for wf_licences, deps in zip(self.workflow_licences, dependencies) if deps is not None)
+        self.workflow_licences = [wf_licences for wf_licences in self.workflow_licences if wf_licences.pipeline in dependencies]
+
+        # Fetch metadata for every distinct package in one batch
+        sources = set()
+        for deps, channels in dependencies.values():
+            for dep in set(deps):
+                sources.update(nf_core.utils.anaconda_package_sources(dep, channels))
+        logging.info("Fetching licences for {} packages used by {} pipelines".format(len(sources), len(dependencies)))
+        self.package_store = nf_core.utils.PackageMetadataStore()
+        package_info = self.package_store.get_many(sources, WorkflowLicences.max_api_connections)
+
+        # Share the licence indexes so that each package is only indexed once
+        licence_indexes = {}
+        for wf_licences in self.workflow_licences:
+            wf_licences.licence_indexes = licence_indexes
+            wf_licences.resolve_licences(dependencies[wf_licences.pipeline][0], dependencies[wf_licences.pipeline][1], package_info)
+
+    def licence_matrix(self):
+        """ Get the pipelines using each package version and its licences
+
+        Returns:
+            list: [package name, version, licences, pipelines] for each distinct package version
+        """
+        matrix = OrderedDict()
+        for wf_licences in self.workflow_licences:
+            for dep, licences in wf_licences.conda_package_licences.items():
+                depname, _, depver = dep.partition('=')
+                depname = depname.split('::')[-1]
+                key = (depname, depver, ', '.join(licences))
+                matrix.setdefault(key, []).append(wf_licences.pipeline)
+        return [[depname, depver, licences, sorted(pipelines)] for (depname, depver, licences), pipelines in matrix.items()]
+
+    def print_licences(self):
+        """ Print the licence report """
+
+        logging.info("""Warning: This tool only prints licence information for the software tools packaged using conda.
+        The pipelines may use other software and dependencies not described here. """)
+
+        if self.json:
+            print(json.dumps(OrderedDict(
+                (wf_licences.pipeline, wf_licences.conda_package_licences) for wf_licences in self.workflow_licences
+            ), indent=4))
+
+        else:
+            licence_list = [[depname, depver, licences, ', '.join(pipelines)] for depname, depver, licences, pipelines in self.licence_matrix()]
+            # Sort by licence, then package name
+            licence_list = sorted(sorted(licence_list), key=lambda x: x[2])
+            # Print summary table
+            print("", file=sys.stderr)
+            print(tabulate.tabulate(licence_list, headers=['Package Name', 'Version', 'Licence', 'Pipelines']))
+            print("", file=sys.stderr)
@@ -5,11 +5,17 @@ Tests Nextflow pipelines to check that they adhere to
 the nf-core community guidelines.
 """
 
+from multiprocessing.pool import ThreadPool
 import logging
 import io
 import os
 import re
 import shlex
+import threading
+try:
+    import queue
+except ImportError:
+    import Queue as queue
 
 import click
 import requests
@@ -17,14 +23,11 @@ import yaml
 
 import nf_core.utils
 
-# Set up local caching for requests to speed up remote queries
-nf_core.utils.setup_requests_cachedir()
-
 # Don't pick up debug logs from the requests package
 logging.getLogger("requests").setLevel(logging.WARNING)
 logging.getLogger("urllib3").setLevel(logging.WARNING)
 
-def run_linting(pipeline_dir, release):
+def run_linting(pipeline_dir, release, keep_going=False):
     """ Run all linting tests. Called by main script. """
 
     # Create the lint object
@@ -32,7 +35,7 @@ def run_linting(pipeline_dir, release):
 
     # Run the linting tests
     try:
-        lint_obj.lint_pipeline(release)
+        lint_obj.lint_pipeline(release, keep_going)
     except AssertionError as e:
         logging.critical("Critical error: {}".format(e))
         logging.info("Stopping tests...")
@@ -52,9 +55,70 @@ def run_linting(pipeline_dir, release):
     return lint_obj
 
 
+class LintResults(object):
+    """ One list of lint results (passed, warned or failed) of a PipelineLint object
+
+    Whilst run_checks() is running a check, results go in to a list for that
+    check only, so that they can be reported in the order that the checks
+    are declared, whatever order they finish in.
+    """
+
+    def __init__(self, name):
+        self.name = name
+
+    def __get__(self, obj, objtype=None):
+        if obj is None:
+            return self
+        check_results = getattr(obj.check_results, 'results', None)
+        if check_results is not None:
+            return check_results[self.name]
+        return obj.__dict__[self.name]
+
+    def __set__(self, obj, value):
+        obj.__dict__[self.name] = value
+
+
 class PipelineLint(object):
     """ Object to hold linting info and results """
 
+    passed = LintResults('passed')
+    warned = LintResults('warned')
+    failed = LintResults('failed')
+
+    # Data loaded by lint checks for use in other checks,
+    # with the check function that loads it
+    lint_data_sources = {
+        'files': 'check_files_exist',
+        'conda_config': 'check_files_exist',
+        'dockerfile': 'check_docker',
+        'singularityfile': 'check_singularity',
+        'config': 'check_nextflow_config'
+    }
+
+    # Data needed by each lint check before it can run.
+    # Everything waits for the file check, as that is what tells us
+    # whether this is a pipeline at all.
+    lint_check_requires = {
+        'check_files_exist': [],
+        'check_licence': ['files'],
+        'check_docker': ['files'],
+        'check_singularity': ['files'],
+        'check_nextflow_config': ['files'],
+        'check_ci_config': ['config'],
+        'check_readme': ['files', 'config'],
+        'check_conda_env_yaml': ['files', 'conda_config', 'config'],
+        'check_conda_dockerfile': ['files', 'conda_config', 'dockerfile'],
+        'check_conda_singularityfile': ['files', 'conda_config', 'singularityfile', 'config'],
+        'check_pipeline_todos': ['files'],
+        'check_version_consistency': ['config']
+    }
+
+    # Maximum number of lint checks to run at the same time
+    max_workers = 8
+
+    # Maximum number of concurrent Anaconda / PyPI API lookups
+    max_api_connections = 10
+
     def __init__(self, pipeline_dir):
         """ Initialise linting object """
         self.releaseMode = False
@@ -67,21 +131,26 @@ class PipelineLint(object):
         self.singularityfile = []
         self.conda_config = {}
         self.conda_package_info = {}
+        self.package_store = None
+        self.check_results = threading.local()
         self.passed = []
         self.warned = []
         self.failed = []
 
-    def lint_pipeline(self, release=False):
+    def lint_pipeline(self, release=False, keep_going=False):
         """ Main linting function.
 
-        Takes the pipeline directory as the primary input and iterates through
-        the different linting checks in order. Collects any warnings or errors
+        Takes the pipeline directory as the primary input and runs the
+        different linting checks. Checks run in parallel as soon as the
+        checks that load the data they need have finished (see
+        `lint_check_requires`). Collects any warnings or errors
         and returns summary at completion. Raises an exception if there is a
         critical error that makes the rest of the tests pointless (eg. no
         pipeline script). Results from this function are printed by the main script.
 
         Args:
             pipeline_dir (str): The path to the pipeline directory
+            keep_going (bool): Keep running checks after a test failure
 
         Returns:
             dict: Summary of test result messages structured as follows:
@@ -115,13 +184,94 @@ class PipelineLint(object):
             check_functions.extend([
                 'check_version_consistency'
             ])
-        with click.progressbar(check_functions, label='Running pipeline tests', item_show_func=repr) as fnames:
-            for fname in fnames:
+        with click.progressbar(length=len(check_functions), label='Running pipeline tests', item_show_func=repr) as pbar:
+            self.run_checks(check_functions, keep_going, pbar)
+
+    def run_checks(self, check_functions, keep_going=False, pbar=None):
+        """ Run lint check functions in a thread pool, respecting their dependencies.
+
+        A check is started once all checks that load the data it needs are
+        complete. Results are reported in the order that the checks are
+        listed, so the output doesn't depend on which checks finish first.
+
+        Unless keep_going is set, results are only reported up to the
+        first check (in listed order) with a failure. Checks listed after
+        it are not started, and the results of any that were already
+        running are thrown away. Exceptions raised by a check are raised
+        again once all running checks have finished.
+        """
+        pending = list(check_functions)
+        running = set()
+        done = set()
+        results = dict()
+        # Index of the first check with a failure, later checks are not started
+        halt_at = len(check_functions)
+        exception = None
+        finished = queue.Queue()
+
+        def run_check(fname):
+            check_results = {'passed': [], 'warned': [], 'failed': []}
+            self.check_results.results = check_results
+            try:
                 getattr(self, fname)()
-                if len(self.failed) > 0:
-                    logging.error("Found test failures in '{}', halting lint run.".format(fname))
+            except Exception as e:
+                finished.put((fname, check_results, e))
+            else:
+                finished.put((fname, check_results, None))
+            finally:
+                self.check_results.results = None
+
+        def dependencies(fname):
+            deps = set()
+            for data in self.lint_check_requires.get(fname, []):
+                source = self.lint_data_sources[data]
+                if source != fname and source in check_functions:
+                    deps.add(source)
+            return deps
+
+        pool = ThreadPool(min(self.max_workers, len(check_functions)))
+        try:
+            while pending or running:
+                # Start every check that has all of the data that it needs
+                for fname in list(pending):
+                    if check_functions.index(fname) < halt_at and dependencies(fname).issubset(done):
+                        pending.remove(fname)
+                        running.add(fname)
+                        pool.apply_async(run_check, (fname,))
+                if not running:
                     break
 
+                # Wait for the next check to finish
+                fname, check_results, e = finished.get()
+                running.remove(fname)
+                done.add(fname)
+                results[fname] = check_results
+                if pbar is not None:
+                    pbar.current_item = fname
+                    pbar.update(1)
+                if e is not None:
+                    if exception is None:
+                        exception = e
+                    halt_at = -1
+                elif len(check_results['failed']) > 0 and not keep_going:
+                    halt_at = min(halt_at, check_functions.index(fname))
+        finally:
+            pool.close()
+            pool.join()
+
+        # Report the results in the order that the checks are listed
+        for fname in check_functions:
+            if fname not in results:
+                continue
+            for name in ['passed', 'warned', 'failed']:
+                getattr(self, name).extend(results[fname][name])
+            if len(results[fname]['failed']) > 0 and not keep_going:
+                logging.error("Found test failures in '{}', halting lint run.".format(fname))
+                break
+
+        if exception is not None:
+            raise exception
+
     def check_files_exist(self):
         """ Check a given pipeline directory for required files.
 
@@ -179,12 +329,15 @@ class PipelineLint(object):
         # Load and parse files for later
         if 'environment.yml' in self.files:
             with open(os.path.join(self.path, 'environment.yml'), 'r') as fh:
-                self.conda_config = yaml.load(fh)
+                self.conda_config = yaml.load(fh) or {}
 
 
     def check_docker(self):
         """ Check that Dockerfile contains the string 'FROM ' """
         fn = os.path.join(self.path, "Dockerfile")
+        if not os.path.isfile(fn):
+            # Already reported by check_files_exist
+            return
         content = ""
         with open(fn, 'r') as fh: content = fh.read()
 
@@ -199,6 +352,9 @@ class PipelineLint(object):
     def check_singularity(self):
         """ Check that Singularity file contains the string 'FROM ' """
         fn = os.path.join(self.path, "Singularity")
+        if not os.path.isfile(fn):
+            # Already reported by check_files_exist
+            return
         content = ""
         with open(fn, 'r') as fh: content = fh.read()
 
@@ -430,7 +586,11 @@ class PipelineLint(object):
 
         Currently just checks the badges at the top of the README
         """
-        with open(os.path.join(self.path, 'README.md'), 'r') as fh:
+        fn = os.path.join(self.path, 'README.md')
+        if not os.path.isfile(fn):
+            # Already reported by check_files_exist
+            return
+        with open(fn, 'r') as fh:
             content = fh.read()
 
         # Check that there is a readme badge showing the minimum required version of Nextflow
@@ -516,12 +676,21 @@ class PipelineLint(object):
 
         # Check that the environment name matches the pipeline name
         pipeline_version = self.config.get('manifest.version', '').strip(' \'"')
-        expected_env_name = 'nf-core-{}-{}'.format(self.pipeline_name.lower(), pipeline_version)
-        if self.conda_config['name'] != expected_env_name:
-            self.failed.append((8, "Conda environment name is incorrect ({}, should be {})".format(self.conda_config['name'], expected_env_name)))
+        expected_env_name = 'nf-core-{}-{}'.format(str(self.pipeline_name).lower(), pipeline_version)
+        if self.conda_config.get('name') != expected_env_name:
+            self.failed.append((8, "Conda environment name is incorrect ({}, should be {})".format(self.conda_config.get('name'), expected_env_name)))
         else:
             self.passed.append((8, "Conda environment name was correct ({})".format(expected_env_name)))
 
+        # Look up all pinned dependencies on the Anaconda and PyPI APIs at once
+        packages = []
+        for dep in self.conda_config.get('dependencies', []):
+            if isinstance(dep, str) and dep.count('=') == 1:
+                packages.extend(nf_core.utils.anaconda_package_sources(dep, self.conda_config.get('channels', [])))
+            elif isinstance(dep, dict):
+                packages.extend([('pypi', d.split('=', 1)[0]) for d in dep.get('pip', []) if d.count('=') == 1])
+        package_info = self.fetch_package_info(packages)
+
         # Check conda dependency list
         for dep in self.conda_config.get('dependencies', []):
             if isinstance(dep, str):
@@ -535,7 +704,7 @@ class PipelineLint(object):
 
                     try:
                         depname, depver = dep.split('=', 1)
-                        self.check_anaconda_package(dep)
+                        self.check_anaconda_package(dep, package_info)
                     except ValueError:
                         pass
                     else:
@@ -562,7 +731,7 @@ class PipelineLint(object):
 
                         try:
                             pip_depname, pip_depver = pip_dep.split('=', 1)
-                            self.check_pip_package(pip_dep)
+                            self.check_pip_package(pip_dep, package_info)
                         except ValueError:
                             pass
                         else:
@@ -576,52 +745,68 @@ class PipelineLint(object):
                             else:
                                 self.passed.append((8, "PyPi package is latest available: {}".format(pip_depver)))
 
-    def check_anaconda_package(self, dep):
-        """ Call the anaconda API to find details about package """
+    def get_package_store(self):
+        """ Get the local store of Anaconda / PyPI package metadata """
+        if self.package_store is None:
+            self.package_store = nf_core.utils.PackageMetadataStore()
+        return self.package_store
+
+    def fetch_package_info(self, packages):
+        """ Get metadata for many Anaconda / PyPI packages concurrently
+
+        Args:
+            packages (list): (channel, package) pairs, with channel 'pypi' for PyPI packages
+
+        Returns:
+            dict: Each (channel, package) pair with the package metadata, None if the
+            package was not found, or the requests exception if the API could not be reached.
+        """
+        return self.get_package_store().get_many(packages, self.max_api_connections)
+
+    def check_anaconda_package(self, dep, package_info=None):
+        """ Call the anaconda API to find details about package
+
+        All channels are queried at once, unless the results have
+        already been fetched and are given in package_info.
+        The result from the highest priority channel is used.
+        """
         # Check if each dependency is the latest available version
-        depname, depver = dep.split('=', 1)
-        dep_channels = self.conda_config.get('channels', [])
-        if '::' in depname:
-            dep_channels = [depname.split('::')[0]]
-            depname = depname.split('::')[1]
-        for ch in reversed(dep_channels):
-            anaconda_api_url = 'https://api.anaconda.org/package/{}/{}'.format(ch, depname)
-            try:
-                response = requests.get(anaconda_api_url, timeout=10)
-            except (requests.exceptions.Timeout):
-                self.warned.append((8, "Anaconda API timed out: {}".format(anaconda_api_url)))
+        sources = nf_core.utils.anaconda_package_sources(dep, self.conda_config.get('channels', []))
+        if package_info is None or not all([src in package_info for src in sources]):
+            package_info = self.fetch_package_info(sources)
+        for src in sources:
+            dep_json = package_info[src]
+            if isinstance(dep_json, requests.exceptions.Timeout):
+                self.warned.append((8, "Anaconda API timed out: {}".format(self.get_package_store().api_url(*src))))
                 raise ValueError
-            except (requests.exceptions.ConnectionError):
-                self.warned.append((8, "Could not connect to Anaconda API"))
+            elif isinstance(dep_json, requests.exceptions.RequestException):
+                self.warned.append((8, "Could not get package details from Anaconda API: {}".format(dep_json)))
                 raise ValueError
-            else:
-                if response.status_code == 200:
-                    dep_json = response.json()
-                    self.conda_package_info[dep] = dep_json
-                    return
+            elif dep_json is not None:
+                self.conda_package_info[dep] = dep_json
+                return
         else:
             self.failed.append((8, "Could not find Conda dependency using the Anaconda API: {}".format(dep)))
             raise ValueError
 
-    def check_pip_package(self, dep):
+    def check_pip_package(self, dep, package_info=None):
         """ Call the PyPI API to find details about package """
-        pip_depname, pip_depver = dep.split('=', 1)
-        pip_api_url = 'https://pypi.python.org/pypi/{}/json'.format(pip_depname)
-        try:
-            response = requests.get(pip_api_url, timeout=10)
-        except (requests.exceptions.Timeout):
+        src = ('pypi', dep.split('=', 1)[0])
+        pip_api_url = self.get_package_store().api_url(*src)
+        if package_info is None or src not in package_info:
+            package_info = self.fetch_package_info([src])
+        pip_dep_json = package_info[src]
+        if isinstance(pip_dep_json, requests.exceptions.Timeout):
             self.warned.append((8, "PyPi API timed out: {}".format(pip_api_url)))
             raise ValueError
-        except (requests.exceptions.ConnectionError):
-            self.warned.append((8, "PyPi API Connection error: {}".format(pip_api_url)))
+        elif isinstance(pip_dep_json, requests.exceptions.RequestException):
+            self.warned.append((8, "PyPi API error for {}: {}".format(pip_api_url, pip_dep_json)))
             raise ValueError
+        elif pip_dep_json is not None:
+            self.conda_package_info[dep] = pip_dep_json
         else:
-            if response.status_code == 200:
-                pip_dep_json = response.json()
-                self.conda_package_info[dep] = pip_dep_json
-            else:
-                self.failed.append((8, "Could not find pip dependency using the PyPi API: {}".format(dep)))
-                raise ValueError
+            self.failed.append((8, "Could not find pip dependency using the PyPi API: {}".format(dep)))
+            raise ValueError
 
     def check_conda_dockerfile(self):
         """ Check that the Docker build file looks right, if working with conda
@@ -637,7 +822,7 @@ class PipelineLint(object):
             'FROM nfcore/base',
             'COPY environment.yml /',
             'RUN conda env create -f /environment.yml && conda clean -a',
-            'ENV PATH /opt/conda/envs/{}/bin:$PATH'.format(self.conda_config['name'])
+            'ENV PATH /opt/conda/envs/{}/bin:$PATH'.format(self.conda_config.get('name'))
         ]
 
         difference = set(expected_strings) - set(self.dockerfile)
@@ -661,7 +846,7 @@ class PipelineLint(object):
             'From:nfcore/base',
             'Bootstrap:docker',
             'VERSION {}'.format(self.config.get('manifest.version', '').strip(' \'"')),
-            'PATH=/opt/conda/envs/{}/bin:$PATH'.format(self.conda_config['name']),
+            'PATH=/opt/conda/envs/{}/bin:$PATH'.format(self.conda_config.get('name')),
             'export PATH',
             'environment.yml /',
             '/opt/conda/bin/conda env create -f /environment.yml',
@@ -699,6 +884,11 @@ class PipelineLint(object):
                             self.warned.append((11, "TODO string found in '{}': {}".format(fname,l)))
 
     def print_results(self):
+        # Checks run in parallel, so sort results by test ID
+        self.passed.sort(key=lambda r: r[0])
+        self.warned.sort(key=lambda r: r[0])
+        self.failed.sort(key=lambda r: r[0])
+
         # Print results
         rl = "\n  Using --release mode linting tests" if self.releaseMode else ''
         logging.info("===========\n LINTING RESULTS\n=================\n" +
@@ -3,7 +3,10 @@
 
 from __future__ import print_function
 from collections import OrderedDict
+from multiprocessing.pool import ThreadPool
 
+import bisect
+import calendar
 import datetime
 import json
 import logging
@@ -11,49 +14,55 @@ import os
 import re
 import subprocess
 import sys
+import time
 
-import git
-import requests
 import tabulate
 
 import nf_core.utils
 
-# Set up local caching for requests to speed up remote queries
-nf_core.utils.setup_requests_cachedir()
-
-def list_workflows(sort='release', json=False, keywords=[]):
+def list_workflows(sort='release', json=False, keywords=[], offline=False, ndjson=False):
     """ Main function to list all nf-core workflows """
-    wfs = Workflows(sort, keywords)
+    wfs = Workflows(sort, keywords, offline)
     wfs.get_remote_workflows()
     wfs.get_local_nf_workflows()
     wfs.compare_remote_local()
-    if json:
-        wfs.print_json()
+    if json or ndjson:
+        wfs.print_json(ndjson)
     else:
         wfs.print_summary()
 
 class Workflows(object):
     """ Class to hold all workflows """
 
-    def __init__(self, sort='release', keywords=[]):
+    # Number of local workflows to inspect at the same time
+    max_workers = 8
+
+    def __init__(self, sort='release', keywords=[], offline=False):
         """ Initialise the class with empty placeholder vars """
         self.remote_workflows = list()
         self.local_workflows = list()
         self.local_unmatched = list()
         self.keyword_filters = keywords
         self.sort_workflows = sort
+        self.keyword_index = None
+        self.keyword_index_keys = None
+        self.offline = offline
+        self.remote_age = None
 
     def get_remote_workflows(self):
         """ Get remote nf-core workflows """
 
-        # List all repositories at nf-core
+        # List all repositories at nf-core, using the local snapshot if it is up to date
         logging.debug("Fetching list of nf-core workflows")
-        nfcore_url = 'http://nf-co.re/pipelines.json'
-        response = requests.get(nfcore_url, timeout=10)
-        if response.status_code == 200:
-            repos = response.json()['remote_workflows']
-            for repo in repos:
-                self.remote_workflows.append(RemoteWorkflow(repo))
+        pipeline_index = nf_core.utils.PipelineIndex()
+        repos = pipeline_index.get(self.offline).get('remote_workflows', [])
+        self.remote_age = pipeline_index.age()
+        if self.remote_age > pipeline_index.ttl:
+            logging.info("Using list of nf-core workflows from {}".format(pretty_date(time.time() - self.remote_age)))
+        for repo in repos:
+            self.remote_workflows.append(RemoteWorkflow(repo))
+        # Rebuild the keyword index when it is next needed
+        self.keyword_index = None
 
     def get_local_nf_workflows(self):
         """ Get local nextflow workflows """
@@ -88,20 +97,87 @@ class Workflows(object):
 
         # Find additional information about each workflow by checking its git history
         logging.debug("Fetching extra info about {} local workflows".format(len(self.local_workflows)))
+        self.find_local_paths()
+        if len(self.local_workflows) > 0:
+            pool = ThreadPool(min(self.max_workers, len(self.local_workflows)))
+            try:
+                pool.map(lambda wf: wf.get_local_nf_workflow_details(), self.local_workflows)
+            finally:
+                pool.close()
+                pool.join()
+
+    def find_local_paths(self):
+        """ Find where each local workflow has been pulled to
+
+        Workflows not in the guessed nextflow assets directory need `nextflow info`,
+        which starts a new JVM each time. So this is only run for the first of them,
+        and the assets directory that it reports is then checked for the rest.
+        """
+        missing = list()
         for wf in self.local_workflows:
-            wf.get_local_nf_workflow_details()
+            if wf.local_path is None:
+                wf.local_path = wf.guess_local_path()
+                if wf.local_path is None:
+                    missing.append(wf)
+        if len(missing) == 0:
+            return
+
+        missing[0].get_nextflow_info()
+        local_path = missing[0].local_path
+        if local_path is None or not local_path.rstrip(os.sep).endswith(missing[0].full_name):
+            return
+        assets_dir = local_path.rstrip(os.sep)[:-len(missing[0].full_name)]
+        logging.debug("Found nextflow assets directory: {}".format(assets_dir))
+        for wf in missing[1:]:
+            if os.path.isdir(os.path.join(assets_dir, wf.full_name)):
+                wf.local_path = os.path.join(assets_dir, wf.full_name)
 
     def compare_remote_local(self):
         """ Match local to remote workflows. """
+        local_index = dict((lwf.full_name, lwf) for lwf in self.local_workflows)
         for rwf in self.remote_workflows:
-            for lwf in self.local_workflows:
-                if rwf.full_name == lwf.full_name:
-                    rwf.local_wf = lwf
-                    if rwf.releases:
-                        if rwf.releases[-1]['tag_sha'] == lwf.commit_sha:
-                            rwf.local_is_latest = True
-                        else:
-                            rwf.local_is_latest = False
+            lwf = local_index.get(rwf.full_name)
+            if lwf is not None:
+                rwf.local_wf = lwf
+                if rwf.releases:
+                    if rwf.releases[-1]['tag_sha'] == lwf.commit_sha:
+                        rwf.local_is_latest = True
+                    else:
+                        rwf.local_is_latest = False
+
+    def build_keyword_index(self):
+        """ Build an index from words in the name, description and topics to remote workflows
+
+        Words are runs of letters and numbers, so every keyword made up only of
+        letters and numbers that is found in a workflow is part of a single word.
+        Every suffix of every word is a key, and the keys are also kept in a
+        sorted list, so that the words containing a keyword can be found with a
+        binary search for the suffixes that start with it.
+        """
+        self.keyword_index = dict()
+        for idx, wf in enumerate(self.remote_workflows):
+            for text in [wf.name or '', wf.description or ''] + list(wf.topics or []):
+                for token in re.findall(r'[^\W_]+', text):
+                    for start in range(len(token)):
+                        self.keyword_index.setdefault(token[start:], set()).add(idx)
+        self.keyword_index_keys = sorted(self.keyword_index)
+
+    def keyword_matches(self, keyword):
+        """ Get the indexes of remote workflows with keyword in their name, description or topics """
+        if re.match(r'^[^\W_]+$', keyword):
+            # Keys starting with the keyword are next to each other in the sorted list
+            matches = set()
+            pos = bisect.bisect_left(self.keyword_index_keys, keyword)
+            while pos < len(self.keyword_index_keys) and self.keyword_index_keys[pos].startswith(keyword):
+                matches.update(self.keyword_index[self.keyword_index_keys[pos]])
+                pos += 1
+            return matches
+        # Keywords with punctuation or spaces could span several words, so check the full text
+        matches = set()
+        for idx, wf in enumerate(self.remote_workflows):
+            if keyword in wf.name or keyword in (wf.description or '') or any([keyword in t for t in wf.topics or []]):
+                matches.add(idx)
+        return matches
 
     def filtered_workflows(self):
         """ Filter remote workflows if keywords supplied """
@@ -109,27 +185,24 @@ class Workflows(object):
         if not self.keyword_filters:
             return self.remote_workflows
 
-        filtered_workflows = []
-        for wf in self.remote_workflows:
-            for k in self.keyword_filters:
-                in_name = k in wf.name
-                in_desc = k in wf.description
-                in_topics = any([ k in t for t in wf.topics])
-                if not in_name and not in_desc and not in_topics:
-                    break
-            else:
-                # We didn't hit a break, so all keywords were found
-                filtered_workflows.append(wf)
-        return filtered_workflows
+        if self.keyword_index is None:
+            self.build_keyword_index()
 
-    def print_summary(self):
-        """ Print summary of all pipelines """
+        # Only keep workflows that match all keywords
+        matches = None
+        for k in self.keyword_filters:
+            k_matches = self.keyword_matches(k)
+            matches = k_matches if matches is None else matches & k_matches
+        return [self.remote_workflows[idx] for idx in sorted(matches)]
+
+    def sort_remote_workflows(self):
+        """ Sort remote workflows in place, as set by sort_workflows """
 
         # Sort by released / dev, then alphabetical
         if self.sort_workflows == 'release':
             self.remote_workflows.sort(
                 key=lambda wf: (
-                    (wf.releases[-1].get('published_at_timestamp', 0) if len(wf.releases) > 0 else 0) * -1,
+                    (wf.releases[-1].get('published_at_timestamp') or 0 if len(wf.releases) > 0 else 0) * -1,
                     wf.full_name.lower()
                 )
             )
@@ -144,6 +217,13 @@ class Workflows(object):
                     wf.full_name.lower()
                 )
             )
+        # Positions in the keyword index have changed
+        self.keyword_index = None
+
+    def print_summary(self):
+        """ Print summary of all pipelines """
+
+        self.sort_remote_workflows()
 
         # Build summary list to print
         summary = list()
@@ -151,7 +231,7 @@ class Workflows(object):
             rowdata = [
                 wf.full_name,
                 wf.releases[-1]['tag_name'] if len(wf.releases) > 0 else 'dev',
-                wf.releases[-1]['published_at_pretty'] if len(wf.releases) > 0 else '-',
+                pretty_date(wf.releases[-1]['published_at_timestamp']) if len(wf.releases) > 0 and wf.releases[-1]['published_at_timestamp'] else '-',
                 wf.local_wf.last_pull_pretty if wf.local_wf is not None else '-',
                 'Yes' if wf.local_is_latest else 'No'
             ]
@@ -167,17 +247,54 @@ class Workflows(object):
         print(tabulate.tabulate(summary, headers=t_headers))
         print("", file=sys.stderr)
 
-    def print_json(self):
-        """ Dump JSON of all parsed information """
-        print(json.dumps({
-            'local_workflows': self.local_workflows,
-            'remote_workflows': self.remote_workflows
-        }, default=lambda o: o.__dict__, indent=4))
+    def print_json(self, ndjson=False, stream=None):
+        """ Write JSON records for the filtered and sorted workflows, one at a time
+
+        Records follow the fields in RemoteWorkflow.json_fields and LocalWorkflow.json_fields.
+        Remote records refer to their local workflow by name. With keyword filters,
+        only local workflows that match a listed remote workflow are included.
+
+        With ndjson, each record is written on its own line with a 'type' of
+        'local' or 'remote'. Otherwise a single JSON object is written, with
+        'local_workflows' and 'remote_workflows' lists.
+        """
+        if stream is None:
+            stream = sys.stdout
+        self.sort_remote_workflows()
+        remote_wfs = self.filtered_workflows()
+        if self.keyword_filters:
+            local_wfs = [wf.local_wf for wf in remote_wfs if wf.local_wf is not None]
+        else:
+            local_wfs = self.local_workflows
+
+        if ndjson:
+            for record_type, wfs in [('local', local_wfs), ('remote', remote_wfs)]:
+                for wf in wfs:
+                    record = OrderedDict([('type', record_type)])
+                    record.update(wf.json_record())
+                    stream.write(json.dumps(record) + '\n')
+                    stream.flush()
+            return
+
+        stream.write('{')
+        for i, (key, wfs) in enumerate([('local_workflows', local_wfs), ('remote_workflows', remote_wfs)]):
+            stream.write('{}\n    "{}": ['.format(',' if i > 0 else '', key))
+            for j, wf in enumerate(wfs):
+                record = json.dumps(wf.json_record(), indent=4, separators=(',', ': ')).replace('\n', '\n        ')
+                stream.write('{}\n        {}'.format(',' if j > 0 else '', record))
+                stream.flush()
+            stream.write('\n    ]' if len(wfs) > 0 else ']')
+        stream.write('\n}\n')
 
 
 class RemoteWorkflow(object):
     """ Class to hold a single workflow """
 
+    __slots__ = (
+        'name', 'full_name', 'description', 'topics', 'archived', 'stargazers_count',
+        'watchers_count', 'forks_count', 'releases', 'local_wf', 'local_is_latest'
+    )
+
     def __init__(self, data):
         """ Initialise a workflow object from the GitHub API object """
 
@@ -198,17 +315,30 @@ class RemoteWorkflow(object):
         self.local_wf = None
         self.local_is_latest = None
 
-        # Beautify date
+        # Parse release dates once, pretty dates are only made for printed rows
         for release in self.releases:
-            release['published_at_pretty'] = pretty_date(
-                datetime.datetime.strptime(release.get('published_at'), "%Y-%m-%dT%H:%M:%SZ")
-            )
-            release['published_at_timestamp'] = int(datetime.datetime.strptime(release.get('published_at'), "%Y-%m-%dT%H:%M:%SZ").strftime("%s"))
+            release['published_at_timestamp'] = github_timestamp(release.get('published_at'))
+
+    # Fields for JSON output
+    json_fields = (
+        'name', 'full_name', 'description', 'topics', 'archived', 'stargazers_count',
+        'watchers_count', 'forks_count', 'releases', 'local_wf', 'local_is_latest'
+    )
+    json_release_fields = ('tag_name', 'tag_sha', 'published_at', 'published_at_timestamp')
+
+    def json_record(self):
+        """ Get the workflow as a dict for JSON output, with the local workflow given by name """
+        record = OrderedDict((k, getattr(self, k)) for k in self.json_fields)
+        record['releases'] = [OrderedDict((k, r.get(k)) for k in self.json_release_fields) for r in self.releases or []]
+        record['local_wf'] = self.local_wf.full_name if self.local_wf is not None else None
+        return record
 
 
 class LocalWorkflow(object):
     """ Class to handle local workflows pulled by nextflow """
 
+    __slots__ = ('full_name', 'repository', 'local_path', 'commit_sha', 'remote_url', 'branch', 'last_pull')
+
     def __init__(self, name):
         """ Initialise the LocalWorkflow object """
         self.full_name = name
@@ -218,52 +348,152 @@ class LocalWorkflow(object):
         self.remote_url = None
         self.branch = None
         self.last_pull = None
-        self.last_pull_date = None
-        self.last_pull_pretty = None
+
+    @property
+    def last_pull_date(self):
+        if self.last_pull is None:
+            return None
+        return datetime.datetime.fromtimestamp(self.last_pull).strftime("%Y-%m-%d %H:%M:%S")
+
+    @property
+    def last_pull_pretty(self):
+        if self.last_pull is None:
+            return None
+        return pretty_date(self.last_pull)
+
+    # Fields for JSON output
+    json_fields = (
+        'full_name', 'repository', 'local_path', 'commit_sha', 'remote_url',
+        'branch', 'last_pull', 'last_pull_date', 'last_pull_pretty'
+    )
+
+    def json_record(self):
+        """ Get the workflow as a dict for JSON output """
+        return OrderedDict((k, getattr(self, k)) for k in self.json_fields)
 
     def get_local_nf_workflow_details(self):
         """ Get full details about a local cached workflow """
 
         if self.local_path is None:
-
-            # Try to guess the local cache directory
-            if os.environ.get('NXF_ASSETS'):
-                nf_wfdir = os.path.join(os.environ.get('NXF_ASSETS'), self.full_name)
-            else:
-                nf_wfdir = os.path.join(os.getenv("HOME"), '.nextflow', 'assets', self.full_name)
-            if os.path.isdir(nf_wfdir):
-                logging.debug("Guessed nextflow assets workflow directory")
-                self.local_path = nf_wfdir
-
-            # Use `nextflow info` to get more details about the workflow
-            else:
-                try:
-                    with open(os.devnull, 'w') as devnull:
-                        nfinfo_raw = subprocess.check_output(['nextflow', 'info', '-d', self.full_name], stderr=devnull)
-                except OSError as e:
-                    if e.errno == os.errno.ENOENT:
-                        raise AssertionError("It looks like Nextflow is not installed. It is required for most nf-core functions.")
-                except subprocess.CalledProcessError as e:
-                    raise AssertionError("`nextflow list` returned non-zero error code: %s,\n   %s", e.returncode, e.output)
-                else:
-                    re_patterns = {
-                        'repository': r"repository\s*: (.*)",
-                        'local_path': r"local path\s*: (.*)"
-                    }
-                    for key, pattern in re_patterns.items():
-                        m = re.search(pattern, nfinfo_raw)
-                        if m:
-                            setattr(self, key, m.group(1))
+            # Try to guess the local cache directory, otherwise ask nextflow
+            self.local_path = self.guess_local_path()
+            if self.local_path is None:
+                self.get_nextflow_info()
 
         # Pull information from the local git repository
         if self.local_path is not None:
-            repo = git.Repo(self.local_path)
-            self.commit_sha = str(repo.head.commit.hexsha)
-            self.remote_url = str(repo.remotes.origin.url)
-            self.branch = str(repo.active_branch)
+            git_details = read_git_details(self.local_path)
+            if git_details is None:
+                # Unusual repository layout - let GitPython work it out
+                import git
+                repo = git.Repo(self.local_path)
+                git_details = (str(repo.head.commit.hexsha), str(repo.active_branch), str(repo.remotes.origin.url))
+            self.commit_sha, self.branch, self.remote_url = git_details
             self.last_pull = os.stat(os.path.join(self.local_path, '.git', 'FETCH_HEAD')).st_mtime
-            self.last_pull_date = datetime.datetime.fromtimestamp(self.last_pull).strftime("%Y-%m-%d %H:%M:%S")
-            self.last_pull_pretty = pretty_date(self.last_pull)
+
+    def guess_local_path(self):
+        """ Guess the local cache directory for the workflow, without calling nextflow
+
+        Returns:
+            str: Path to the workflow, or None if it isn't where we expected
+        """
+        if os.environ.get('NXF_ASSETS'):
+            nf_wfdir = os.path.join(os.environ.get('NXF_ASSETS'), self.full_name)
+        else:
+            nf_wfdir = os.path.join(os.getenv("HOME"), '.nextflow', 'assets', self.full_name)
+        if os.path.isdir(nf_wfdir):
+            logging.debug("Guessed nextflow assets workflow directory")
+            return nf_wfdir
+        return None
+
+    def get_nextflow_info(self):
+        """ Use `nextflow info` to get the repository and local path of the workflow """
+        try:
+            with open(os.devnull, 'w') as devnull:
+                nfinfo_raw = subprocess.check_output(['nextflow', 'info', '-d', self.full_name], stderr=devnull)
+        except OSError as e:
+            if e.errno == os.errno.ENOENT:
+                raise AssertionError("It looks like Nextflow is not installed. It is required for most nf-core functions.")
+        except subprocess.CalledProcessError as e:
+            raise AssertionError("`nextflow list` returned non-zero error code: %s,\n   %s", e.returncode, e.output)
+        else:
+            re_patterns = {
+                'repository': r"repository\s*: (.*)",
+                'local_path': r"local path\s*: (.*)"
+            }
+            for key, pattern in re_patterns.items():
+                m = re.search(pattern, nfinfo_raw.decode('utf-8'))
+                if m:
+                    setattr(self, key, m.group(1).strip())
+
+def read_git_details(repo_path):
+    """
+    Read the HEAD commit, branch and origin URL of a git repository
+    straight from the files in its `.git` directory
+
+    This is much faster than GitPython, which can start `git` subprocesses.
+    Only the common layout is handled: a `.git` directory with HEAD pointing
+    to a branch in `refs/heads/` or `packed-refs`, and an `origin` remote.
+
+    Returns:
+        tuple: (commit sha, branch, remote URL), or None if the repository could not be read
+    """
+    git_dir = os.path.join(repo_path, '.git')
+    try:
+        # Fails if .git is missing or is a file pointing elsewhere (eg. a worktree)
+        with open(os.path.join(git_dir, 'HEAD'), 'r') as fh:
+            head = fh.read().strip()
+        if not head.startswith('ref: refs/heads/'):
+            return None
+        ref = head[5:]
+
+        # Find the commit for the branch, either as a loose ref or packed
+        commit_sha = None
+        try:
+            with open(os.path.join(git_dir, ref), 'r') as fh:
+                commit_sha = fh.read().strip()
+        except (IOError, OSError):
+            with open(os.path.join(git_dir, 'packed-refs'), 'r') as fh:
+                for line in fh:
+                    fields = line.split()
+                    if len(fields) == 2 and fields[1] == ref:
+                        commit_sha = fields[0]
+                        break
+
+        # Find the origin URL in the repository config
+        remote_url = None
+        section = None
+        with open(os.path.join(git_dir, 'config'), 'r') as fh:
+            for line in fh:
+                m = re.match(r'\s*\[(.+)\]', line)
+                if m:
+                    section = m.group(1).strip()
+                    continue
+                m = re.match(r'\s*url\s*=\s*(.*)', line)
+                if m and section == 'remote "origin"':
+                    remote_url = m.group(1).strip()
+    except (IOError, OSError):
+        return None
+
+    if not commit_sha or not re.match(r'^[0-9a-f]{40}$', commit_sha) or remote_url is None:
+        return None
+    return (commit_sha, ref[len('refs/heads/'):], remote_url)
+
+# GitHub API dates, eg. 2018-12-12T10:00:00Z
+GITHUB_DATE_RE = re.compile(r'^(\d{4})-(\d\d)-(\d\d)T(\d\d):(\d\d):(\d\d)Z$')
+
+def github_timestamp(date_string):
+    """
+    Convert a GitHub API date string (always UTC) to an integer epoch timestamp
+
+    Returns None if there is no date.
+    """
+    if date_string is None:
+        return None
+    m = GITHUB_DATE_RE.match(date_string)
+    if not m:
+        raise ValueError("Could not parse date: '{}'".format(date_string))
+    return calendar.timegm(tuple(int(x) for x in m.groups()))
 
 def pretty_date(time):
     """
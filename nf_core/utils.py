@@ -3,17 +3,51 @@
 Common utility functions for the nf-core python package.
 """
 
+from multiprocessing.pool import ThreadPool
+
 import datetime
+import getpass
+import glob
+import hashlib
+import json
+import logging
 import os
+import re
+import sqlite3
+import stat
 import subprocess
 import tempfile
+import threading
+import time
 
-def fetch_wf_config(wf_path):
+def fetch_wf_config(wf_path, cache_config=True):
     """
     Use nextflow to retrieve the nf configuration variables from a workflow
+
+    Parsed configs are cached on disk, keyed by a hash of the workflow config
+    files and the Nextflow version. A cache hit skips `nextflow config` entirely.
+    The cache is kept in the private per-user cache directory, as a planted
+    config could change what the lint tests check.
     """
 
     config = dict()
+    cache_fn = None
+    if cache_config:
+        cache_key = wf_config_cache_key(wf_path)
+        if cache_key is not None:
+            try:
+                cache_fn = os.path.join(get_private_cache_dir('wf_config'), '{}.json'.format(cache_key))
+            except OSError as e:
+                logging.warning("Not caching the workflow config: {}".format(e))
+        if cache_fn is not None:
+            if os.path.isfile(cache_fn):
+                logging.debug("Found a cached workflow config: {}".format(cache_fn))
+                try:
+                    with open(cache_fn, 'r') as fh:
+                        return json.load(fh)
+                except (IOError, ValueError):
+                    logging.debug("Could not read cached workflow config, ignoring: {}".format(cache_fn))
+
     # Call `nextflow config` and pipe stderr to /dev/null
     try:
         with open(os.devnull, 'w') as devnull:
@@ -28,25 +62,456 @@ def fetch_wf_config(wf_path):
             ul = l.decode('utf-8')
             k, v = ul.split(' = ', 1)
             config[k] = v
+
+        # Save the parsed config for next time
+        if cache_fn is not None and config:
+            write_json_atomic(cache_fn, config)
     return config
 
 
+def wf_config_cache_key(wf_path):
+    """
+    Build a cache key for the parsed config of a workflow
+
+    Hashes the absolute workflow path (config values can include `$baseDir`),
+    the Nextflow version and the contents of `nextflow.config` and `conf/*.config`.
+
+    Returns None if the Nextflow version can't be found, as we can't then
+    know whether a cached config is still valid.
+    """
+    nf_version = get_nextflow_version()
+    if nf_version is None:
+        return None
+    wf_path = os.path.abspath(wf_path)
+    config_fns = [os.path.join(wf_path, 'nextflow.config')]
+    config_fns.extend(sorted(glob.glob(os.path.join(wf_path, 'conf', '*.config'))))
+
+    key = hashlib.sha256()
+    key.update(wf_path.encode('utf-8'))
+    key.update(nf_version.encode('utf-8'))
+    for fn in config_fns:
+        if os.path.isfile(fn):
+            key.update(os.path.relpath(fn, wf_path).encode('utf-8'))
+            with open(fn, 'rb') as fh:
+                key.update(hashlib.sha256(fh.read()).digest())
+    return key.hexdigest()
+
+
+def get_nextflow_version():
+    """
+    Find the version of Nextflow that will be run, without starting the JVM
+
+    Uses $NXF_VER if set, otherwise reads the default version from
+    the `nextflow` launcher script. Falls back to the launcher path,
+    size and modification time if no version string can be found.
+
+    Returns None if Nextflow is not installed.
+    """
+    if os.environ.get('NXF_VER'):
+        return os.environ.get('NXF_VER')
+
+    launcher = None
+    for path in os.environ.get('PATH', '').split(os.pathsep):
+        fn = os.path.join(path, 'nextflow')
+        if os.path.isfile(fn) and os.access(fn, os.X_OK):
+            launcher = os.path.realpath(fn)
+            break
+    if launcher is None:
+        return None
+
+    try:
+        with open(launcher, 'rb') as fh:
+            m = re.search(br"NXF_VER=\$\{NXF_VER:-'?([^'}]+)'?\}", fh.read())
+        if m:
+            return m.group(1).decode('utf-8')
+    except IOError:
+        pass
+    st = os.stat(launcher)
+    return '{}:{}:{}'.format(launcher, st.st_size, st.st_mtime)
+
+
+def write_json_atomic(fn, data):
+    """
+    Write data as JSON to a temporary file and move it in to place,
+    so that concurrent readers never see a partly written file.
+    """
+    try:
+        fd, tmp_fn = tempfile.mkstemp(dir=os.path.dirname(fn), suffix='.tmp')
+        with os.fdopen(fd, 'w') as fh:
+            json.dump(data, fh)
+        # Readable by other users, but only writable by the owner, so that others can't poison the cache
+        os.chmod(tmp_fn, 0o644)
+        os.rename(tmp_fn, fn)
+    except (IOError, OSError) as e:
+        logging.debug("Could not write cache file {}: {}".format(fn, e))
+
+
+def get_cache_dir(subdir=None):
+    """
+    Get the path to the nf-core cache directory, creating it if needed
+
+    Defaults to `nfcore_cache` in the system temp directory.
+    Can be set with the `NFCORE_CACHE_DIR` environment variable.
+    """
+    cachedir = os.environ.get('NFCORE_CACHE_DIR', os.path.join(tempfile.gettempdir(), 'nfcore_cache'))
+    if subdir is not None:
+        cachedir = os.path.join(cachedir, subdir)
+    if not os.path.exists(cachedir):
+        try:
+            os.makedirs(cachedir)
+            # Make world-writeable so that multi-user installations work
+            os.chmod(cachedir, 0o777)
+        except OSError:
+            # Probably created by another process in the meantime
+            if not os.path.isdir(cachedir):
+                raise
+    return cachedir
+
+
+def get_private_cache_dir(subdir=None):
+    """
+    Get the path to a cache directory that only the current user can write to, creating it if needed
+
+    The shared cache directory is world-writeable, so anything read back
+    from it could have been planted by another user. Caches that change what
+    nf-core does go in `user-<name>` instead, which is created with mode 0700.
+
+    Raises:
+        OSError if the directory isn't a real directory owned by the current user,
+        or if other users can read or write it
+    """
+    cachedir = os.path.join(get_cache_dir(), 'user-{}'.format(getpass.getuser()))
+    try:
+        os.mkdir(cachedir, 0o700)
+    except OSError:
+        # Already exists, checked below
+        pass
+    # Don't follow symlinks, another user could point one at their own directory
+    st = os.lstat(cachedir)
+    if not stat.S_ISDIR(st.st_mode):
+        raise OSError("Cache directory is not a directory: {}".format(cachedir))
+    if hasattr(os, 'getuid') and st.st_uid != os.getuid():
+        raise OSError("Cache directory is owned by another user: {}".format(cachedir))
+    if st.st_mode & 0o077:
+        raise OSError("Cache directory can be accessed by other users: {}".format(cachedir))
+    if subdir is not None:
+        cachedir = os.path.join(cachedir, subdir)
+        if not os.path.isdir(cachedir):
+            try:
+                os.makedirs(cachedir)
+            except OSError:
+                # Probably created by another process in the meantime
+                if not os.path.isdir(cachedir):
+                    raise
+    return cachedir
+
+
+# Whether setup_requests_cachedir() has installed the requests cache yet
+requests_cache_installed = False
+requests_cache_lock = threading.Lock()
+
 def setup_requests_cachedir():
     """
     Set up local caching for requests to speed up remote queries
+
+    Called just before the first network request is made, so that
+    commands that don't need the network don't pay for setting up the cache.
+    Does nothing if the cache has already been installed.
+    Safe to call from several threads at once.
     """
+    global requests_cache_installed
+    if requests_cache_installed:
+        return
 
-    # Only import it if we need it
-    import requests_cache
+    with requests_cache_lock:
+        if requests_cache_installed:
+            return
 
-    cachedir = os.path.join(tempfile.gettempdir(), 'nfcore_cache')
-    if not os.path.exists(cachedir):
-        os.mkdir(cachedir)
-    requests_cache.install_cache(
-        os.path.join(cachedir, 'nfcore_cache'),
-        expire_after=datetime.timedelta(hours=1),
-        backend='sqlite',
-    )
-    # Make world-writeable so that multi-user installations work
-    os.chmod(cachedir, 0o777)
-    os.chmod(os.path.join(cachedir, 'nfcore_cache.sqlite'), 0o777)
+        # Only import it if we need it
+        import requests_cache
+
+        cachedir = get_cache_dir()
+        requests_cache.install_cache(
+            os.path.join(cachedir, 'nfcore_cache'),
+            expire_after=datetime.timedelta(hours=1),
+            backend='sqlite',
+        )
+        # Make world-writeable so that multi-user installations work
+        os.chmod(cachedir, 0o777)
+        os.chmod(os.path.join(cachedir, 'nfcore_cache.sqlite'), 0o777)
+        requests_cache_installed = True
+
+
+def anaconda_package_sources(dep, channels):
+    """
+    Get the (channel, package) pairs to look up a conda dependency with,
+    in order of channel priority.
+    """
+    depname = dep.split('=', 1)[0]
+    if '::' in depname:
+        channels = [depname.split('::')[0]]
+        depname = depname.split('::')[1]
+    return [(ch, depname) for ch in reversed(channels)]
+
+
+class PackageMetadataStore(object):
+    """
+    Persistent local store of package metadata from the Anaconda and PyPI APIs
+
+    Entries are keyed by (channel, package), using the channel 'pypi'
+    for PyPI packages, so that metadata fetched when linting or listing
+    licences for one pipeline is reused for others. Entries older than
+    `ttl` seconds are revalidated with the API using their ETag /
+    Last-Modified headers. Entries that have not been used for `max_age`
+    seconds are evicted.
+
+    Args:
+        db_path (str): Path to the SQLite database file (default: one per user in the nf-core cache directory)
+        ttl (int): Seconds before an entry is revalidated with the API
+        max_age (int): Seconds since last use before an entry is evicted
+    """
+
+    def __init__(self, db_path=None, ttl=3600, max_age=30*24*3600):
+        self.db_path = db_path
+        if self.db_path is None:
+            # One database per user, so that other users can't write to it
+            self.db_path = os.path.join(get_cache_dir(), 'package_metadata.{}.sqlite'.format(getpass.getuser()))
+        self.ttl = ttl
+        self.max_age = max_age
+        self.session = None
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(self.db_path, timeout=30, check_same_thread=False)
+        with self.lock, self.db:
+            self.db.execute(
+                "CREATE TABLE IF NOT EXISTS packages ("
+                "channel TEXT, package TEXT, data TEXT, etag TEXT, last_modified TEXT, "
+                "fetched REAL, used REAL, PRIMARY KEY (channel, package))"
+            )
+        self.evict()
+
+    def api_url(self, channel, package):
+        """ Get the API URL for a package """
+        if channel == 'pypi':
+            return 'https://pypi.python.org/pypi/{}/json'.format(package)
+        return 'https://api.anaconda.org/package/{}/{}'.format(channel, package)
+
+    def get_session(self):
+        """ Get a requests session with a pool of keep-alive connections, shared by all threads """
+        # Only import it if we need it
+        import requests
+
+        with self.lock:
+            if self.session is None:
+                setup_requests_cachedir()
+                self.session = requests.Session()
+                self.session.mount('https://', requests.adapters.HTTPAdapter(pool_maxsize=20))
+            return self.session
+
+    def get(self, channel, package):
+        """
+        Get the API metadata for a package, using the local store if possible
+
+        Returns:
+            dict: The parsed API response, or None if the package was not found
+
+        Raises:
+            requests.exceptions.RequestException if the API can't be reached,
+            gives a server error or returns invalid JSON
+        """
+        # Only import it if we need it
+        import requests
+
+        now = time.time()
+        with self.lock:
+            row = self.db.execute(
+                "SELECT data, etag, last_modified, fetched FROM packages WHERE channel = ? AND package = ?",
+                (channel, package)
+            ).fetchone()
+
+        # Fresh entry - no need to ask the API
+        if row is not None and now - row[3] < self.ttl:
+            self.touch(channel, package, now)
+            return json.loads(row[0])
+
+        # Ask the API, sending the validators of any stale entry
+        headers = {}
+        if row is not None:
+            if row[1]:
+                headers['If-None-Match'] = row[1]
+            if row[2]:
+                headers['If-Modified-Since'] = row[2]
+        response = self.get_session().get(self.api_url(channel, package), headers=headers, timeout=10)
+
+        if response.status_code == 304 and row is not None:
+            logging.debug("Package metadata not modified: {}/{}".format(channel, package))
+            self.touch(channel, package, now, fetched=True)
+            return json.loads(row[0])
+        if response.status_code >= 500:
+            response.raise_for_status()
+        if response.status_code == 200:
+            try:
+                data = response.json()
+            except ValueError:
+                raise requests.exceptions.RequestException("Invalid JSON from {}".format(response.url), response=response)
+            with self.lock, self.db:
+                self.db.execute(
+                    "INSERT OR REPLACE INTO packages VALUES (?, ?, ?, ?, ?, ?, ?)",
+                    (channel, package, json.dumps(data), response.headers.get('ETag'),
+                     response.headers.get('Last-Modified'), now, now)
+                )
+            return data
+        return None
+
+    def get_many(self, packages, max_workers=10):
+        """
+        Get the API metadata for many packages concurrently
+
+        Args:
+            packages (list): (channel, package) pairs
+            max_workers (int): Maximum number of API requests to make at the same time
+
+        Returns:
+            dict: Each (channel, package) pair with the package metadata, None if the
+            package was not found, or the requests exception if the API could not be reached.
+        """
+        # Only import it if we need it
+        import requests
+
+        def fetch(package):
+            try:
+                return package, self.get(*package)
+            except requests.exceptions.RequestException as e:
+                return package, e
+
+        packages = list(set(packages))
+        if len(packages) == 0:
+            return {}
+        pool = ThreadPool(min(max_workers, len(packages)))
+        try:
+            return dict(pool.map(fetch, packages))
+        finally:
+            pool.close()
+            pool.join()
+
+    def touch(self, channel, package, now, fetched=False):
+        """ Update the last used (and optionally fetched) time of an entry """
+        with self.lock, self.db:
+            if fetched:
+                self.db.execute("UPDATE packages SET used = ?, fetched = ? WHERE channel = ? AND package = ?", (now, now, channel, package))
+            else:
+                self.db.execute("UPDATE packages SET used = ? WHERE channel = ? AND package = ?", (now, channel, package))
+
+    def evict(self):
+        """ Remove entries that have not been used for max_age seconds """
+        with self.lock, self.db:
+            self.db.execute("DELETE FROM packages WHERE used < ?", (time.time() - self.max_age,))
+
+
+class PipelineIndex(object):
+    """
+    Local snapshot of the nf-core pipeline index, `pipelines.json`
+
+    Shared by `nf-core list`, `nf-core download` and the sync bot, so that
+    the index is only downloaded again when it has changed. Once the snapshot
+    is older than `ttl` seconds it is revalidated using its ETag /
+    Last-Modified headers. If the website can't be reached, the snapshot
+    is used instead.
+
+    Args:
+        snapshot_path (str): Path to the snapshot file (default: in the private nf-core cache directory)
+        ttl (int): Seconds before the snapshot is revalidated with the website
+    """
+
+    url = 'http://nf-co.re/pipelines.json'
+
+    def __init__(self, snapshot_path=None, ttl=3600):
+        self.snapshot_path = snapshot_path
+        if self.snapshot_path is None:
+            try:
+                self.snapshot_path = os.path.join(get_private_cache_dir(), 'pipelines.json')
+            except OSError as e:
+                logging.warning("Not keeping a local copy of the nf-core pipeline list: {}".format(e))
+        self.ttl = ttl
+        self.snapshot = None
+        if self.snapshot_path is not None:
+            try:
+                with open(self.snapshot_path, 'r') as fh:
+                    self.snapshot = json.load(fh)
+            except (IOError, ValueError):
+                pass
+
+    def save(self):
+        """ Write the snapshot to disk, if there is somewhere to keep it """
+        if self.snapshot_path is not None:
+            write_json_atomic(self.snapshot_path, self.snapshot)
+
+    def age(self):
+        """ Seconds since the snapshot was last fetched or revalidated, or None if there is no snapshot """
+        if self.snapshot is None:
+            return None
+        return time.time() - self.snapshot['fetched']
+
+    def get(self, offline=False):
+        """
+        Get the pipeline index, from the snapshot if it is fresh enough
+
+        Args:
+            offline (bool): Only use the snapshot, never the network
+
+        Returns:
+            dict: The parsed pipeline index
+
+        Raises:
+            LookupError if offline and there is no snapshot
+            requests.exceptions.RequestException if the index can't be fetched and there is no snapshot
+        """
+        if offline:
+            if self.snapshot is None:
+                raise LookupError("No local copy of the nf-core pipeline list, run once without --offline first")
+            return self.snapshot['data']
+        if self.snapshot is not None and self.age() < self.ttl:
+            return self.snapshot['data']
+
+        # Only import it if we need it
+        import requests
+
+        headers = {}
+        if self.snapshot is not None:
+            if self.snapshot.get('etag'):
+                headers['If-None-Match'] = self.snapshot['etag']
+            if self.snapshot.get('last_modified'):
+                headers['If-Modified-Since'] = self.snapshot['last_modified']
+        try:
+            response = self.fetch(headers)
+            if response.status_code == 304 and self.snapshot is not None:
+                logging.debug("Pipeline list not modified")
+                self.snapshot['fetched'] = time.time()
+                self.save()
+                return self.snapshot['data']
+            response.raise_for_status()
+            data = response.json()
+        except (requests.exceptions.RequestException, ValueError) as e:
+            if self.snapshot is None:
+                raise
+            logging.warning("Could not fetch the nf-core pipeline list, using local copy: {}".format(e))
+            return self.snapshot['data']
+
+        self.snapshot = {
+            'data': data,
+            'etag': response.headers.get('ETag'),
+            'last_modified': response.headers.get('Last-Modified'),
+            'fetched': time.time()
+        }
+        self.save()
+        return data
+
+    def fetch(self, headers):
+        """ Request the pipeline index, bypassing the requests cache """
+        # Only import it if we need it
+        import requests
+
+        if requests_cache_installed:
+            import requests_cache
+            with requests_cache.disabled():
+                return requests.get(self.url, headers=headers, timeout=10)
+        return requests.get(self.url, headers=headers, timeout=10)
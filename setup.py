@@ -24,7 +24,7 @@ setup(
     license = license,
     scripts = ['scripts/nf-core'],
     install_requires = [
-        'cookiecutter',
+        'jinja2',
         'click',
         'GitPython',
         'pyyaml',
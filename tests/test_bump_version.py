@@ -59,4 +59,37 @@ def test_successfull_nextflow_version_bump(datafiles):
     nf_core.bump_version.bump_nextflow_version(lint_obj, '0.40')
     lint_obj_new = nf_core.lint.PipelineLint(str(datafiles))
     lint_obj_new.check_nextflow_config()
-    assert lint_obj_new.config['manifest.nextflowVersion'] == "'>=0.40'"
\ No newline at end of file
+    assert lint_obj_new.config['manifest.nextflowVersion'] == "'>=0.40'"
+
+
+@pytest.mark.datafiles(PATH_WORKING_EXAMPLE)
+def test_pattern_not_found_writes_nothing(datafiles):
+    """ Test that no files are changed if any version number can't be found """
+    lint_obj = nf_core.lint.PipelineLint(str(datafiles))
+    lint_obj.pipeline_name = 'tools'
+    lint_obj.config['manifest.version'] = '0.4'
+    lint_obj.files = ['nextflow.config', 'Dockerfile', 'environment.yml']
+    with open(os.path.join(str(datafiles), 'Singularity'), 'w') as fh:
+        fh.write("Bootstrap: docker\n")
+    with open(os.path.join(str(datafiles), 'nextflow.config')) as fh:
+        nfconfig = fh.read()
+    with pytest.raises(SyntaxError):
+        nf_core.bump_version.bump_pipeline_version(lint_obj, '1.1')
+    with open(os.path.join(str(datafiles), 'nextflow.config')) as fh:
+        assert fh.read() == nfconfig
+    assert sorted(os.listdir(str(datafiles))) == sorted(os.listdir(PATH_WORKING_EXAMPLE))
+
+
+def test_version_bump_plan_single_scan(tmpdir):
+    """ Test that several replacements in a file are made together and the file mode is kept """
+    fn = tmpdir.join('nextflow.config')
+    fn.write("version = '0.4'\ncontainer = 'nfcore/tools:0.4'\nnextflowVersion = '>=0.32.0'\n")
+    fn.chmod(0o640)
+    plan = nf_core.bump_version.VersionBumpPlan(str(tmpdir))
+    plan.add('nextflow.config', r"version = '0\.4'", "version = '1.0'")
+    plan.add('nextflow.config', r"nfcore/tools:(\d+\.\d+)", r"nfcore/tools:1.0")
+    plan.add('nextflow.config', r"nextflowVersion = '>=(\S+)'", r"nextflowVersion = '>=\1'")
+    plan.apply()
+    assert fn.read() == "version = '1.0'\ncontainer = 'nfcore/tools:1.0'\nnextflowVersion = '>=0.32.0'\n"
+    assert fn.stat().mode & 0o777 == 0o640
+    assert os.listdir(str(tmpdir)) == ['nextflow.config']
@@ -35,3 +35,15 @@ class NfcoreCreateTest(unittest.TestCase):
     def test_pipeline_creation_initiation(self):
         self.pipeline.init_pipeline()
         assert (os.path.isdir(os.path.join(self.pipeline.outdir, '.git')))
+
+    def test_template_only_writes_changes(self):
+        """ Test that rendering the template again only writes files that have changed """
+        context = {'name': PIPELINE_NAME, 'name_docker': 'nfcore/test'}
+        files, written = nf_core.create.PipelineTemplate.load().render(self.tmppath, context)
+        assert written == files
+        assert os.path.isfile(os.path.join(self.tmppath, 'main.nf'))
+        with open(os.path.join(self.tmppath, 'main.nf'), 'a') as fh:
+            fh.write('// local change\n')
+        files, written = nf_core.create.PipelineTemplate.load().render(self.tmppath, context)
+        assert written == ['main.nf']
+        assert nf_core.create.PipelineTemplate.load() is nf_core.create.PipelineTemplate.load()
@@ -2,7 +2,7 @@
 """Tests for the download subcommand of nf-core tools
 """
 
-import nf_core.list
+import nf_core.list, nf_core.download
 from nf_core.download import DownloadWorkflow
 
 import hashlib
@@ -13,7 +13,10 @@ import pytest
 import requests
 import shutil
 import tempfile
+import threading
+import time
 import unittest
+import zipfile
 
 class DownloadTest(unittest.TestCase):
 
@@ -113,6 +116,72 @@ class DownloadTest(unittest.TestCase):
         download_obj.wf_download_url = "https://github.com/nf-core/methylseq/archive/1.0.zip"
         download_obj.download_wf_files()
 
+    def mock_zip_response(self, content, status_code=200, fail_after=None):
+        """ Build a streamed response, optionally dropping the connection part way """
+        class MockRaw(io.BytesIO):
+            def read(self, size=-1):
+                if fail_after is not None and self.tell() >= fail_after:
+                    raise requests.exceptions.ConnectionError("Connection dropped")
+                return io.BytesIO.read(self, min(size, fail_after - self.tell()) if fail_after else size)
+        response = requests.Response()
+        response.status_code = status_code
+        response.raw = MockRaw(content)
+        return response
+
+    def make_wf_zip(self):
+        """ Make a GitHub-style workflow zip file """
+        zip_content = io.BytesIO()
+        with zipfile.ZipFile(zip_content, 'w') as zf:
+            zf.writestr('methylseq-1.0/', '')
+            zf.writestr('methylseq-1.0/main.nf', 'println "hello"')
+            script = zipfile.ZipInfo('methylseq-1.0/bin/script.py')
+            script.external_attr = 0o755 << 16
+            zf.writestr(script, 'print("hello")')
+        return zip_content.getvalue()
+
+    @mock.patch('requests.get')
+    def test_download_wf_files_streamed(self, mock_request):
+        """ Test that the workflow zip is extracted with the top directory renamed """
+        mock_request.side_effect = [self.mock_zip_response(self.make_wf_zip())]
+        download_obj = DownloadWorkflow(pipeline = "dummy", outdir = tempfile.mkdtemp())
+        download_obj.wf_name = "nf-core/methylseq"
+        download_obj.wf_sha = "1.0"
+        download_obj.wf_download_url = "https://github.com/nf-core/methylseq/archive/1.0.zip"
+        download_obj.download_wf_files()
+        assert sorted(os.listdir(download_obj.outdir)) == ['workflow']
+        assert os.path.isfile(os.path.join(download_obj.outdir, 'workflow', 'main.nf'))
+        assert os.access(os.path.join(download_obj.outdir, 'workflow', 'bin', 'script.py'), os.X_OK)
+        shutil.rmtree(download_obj.outdir)
+
+    @mock.patch('requests.get')
+    def test_download_file_resume(self, mock_request):
+        """ Test that an interrupted download is resumed with a Range request """
+        content = b"0123456789" * 100
+        mock_request.side_effect = [
+            self.mock_zip_response(content, fail_after=300),
+            self.mock_zip_response(content[300:], status_code=206)
+        ]
+        download_obj = DownloadWorkflow(pipeline = "dummy")
+        with tempfile.TemporaryFile() as fh:
+            download_obj.download_file("https://github.com/nf-core/methylseq/archive/1.0.zip", fh)
+            fh.seek(0)
+            assert fh.read() == content
+        assert mock_request.call_args[1]['headers'] == {'Range': 'bytes=300-'}
+
+    @mock.patch('requests.get')
+    def test_download_file_restart(self, mock_request):
+        """ Test that a download restarts if the server ignores the Range request """
+        content = b"0123456789" * 100
+        mock_request.side_effect = [
+            self.mock_zip_response(content, fail_after=300),
+            self.mock_zip_response(content)
+        ]
+        download_obj = DownloadWorkflow(pipeline = "dummy")
+        with tempfile.TemporaryFile() as fh:
+            download_obj.download_file("https://github.com/nf-core/methylseq/archive/1.0.zip", fh)
+            fh.seek(0)
+            assert fh.read() == content
+
     #
     # Tests for 'find_singularity_images'
     #
@@ -172,6 +241,85 @@ class DownloadTest(unittest.TestCase):
         # Clean up
         shutil.rmtree(tmp_dir)
 
+    def mock_shub_responses(self, content, version):
+        """ Build the shub API response and the image download stream """
+        resp_shub = requests.Response()
+        resp_shub.status_code = 200
+        resp_shub._content = '{{"image": "my-container", "version": "{}"}}'.format(version).encode('utf-8')
+        resp_download = requests.Response()
+        resp_download.status_code = 200
+        resp_download.headers = {'content-length': len(content)}
+        resp_download.raw = io.BytesIO(content)
+        return [resp_shub, resp_download]
+
+    @mock.patch('requests.get')
+    def test_download_shub_image_hashed_while_streaming(self, mock_request):
+        """ Test that the image md5 is calculated from the download stream """
+        tmp_dir = tempfile.mkdtemp()
+        os.mkdir(os.path.join(tmp_dir, 'singularity-images'))
+        download_obj = DownloadWorkflow(pipeline = "dummy", outdir = tmp_dir)
+        content = os.urandom(3 * 1024 * 1024 + 7)
+        mock_request.side_effect = self.mock_shub_responses(content, hashlib.md5(content).hexdigest())
+        with mock.patch.object(download_obj, 'validate_md5', wraps=download_obj.validate_md5) as mock_md5:
+            download_obj.download_shub_image("awesome-container")
+            assert mock_md5.call_args[0][2] == hashlib.md5(content).hexdigest()
+        with open(os.path.join(tmp_dir, 'singularity-images', 'awesome-container.simg'), 'rb') as fh:
+            assert fh.read() == content
+        shutil.rmtree(tmp_dir)
+
+    @mock.patch('requests.get')
+    @pytest.mark.xfail(raises=IOError)
+    def test_download_shub_image_hash_mismatch(self, mock_request):
+        """ Test that a corrupt image download is detected """
+        tmp_dir = tempfile.mkdtemp()
+        os.mkdir(os.path.join(tmp_dir, 'singularity-images'))
+        download_obj = DownloadWorkflow(pipeline = "dummy", outdir = tmp_dir)
+        mock_request.side_effect = self.mock_shub_responses(b"corrupted", hashlib.md5(b"image").hexdigest())
+        download_obj.download_shub_image("awesome-container")
+
+    @mock.patch('requests.get')
+    def test_download_shub_image_cached(self, mock_request):
+        """ Test that a second download of an image is linked from the shared cache """
+        cache_dir = tempfile.mkdtemp()
+        content = os.urandom(1024)
+        md5 = hashlib.md5(content).hexdigest()
+        for _ in range(2):
+            tmp_dir = tempfile.mkdtemp()
+            os.mkdir(os.path.join(tmp_dir, 'singularity-images'))
+            download_obj = DownloadWorkflow(pipeline = "dummy", outdir = tmp_dir, singularity_cache = cache_dir)
+            mock_request.side_effect = self.mock_shub_responses(content, md5)
+            download_obj.download_shub_image("awesome-container")
+            with open(os.path.join(tmp_dir, 'singularity-images', 'awesome-container.simg'), 'rb') as fh:
+                assert fh.read() == content
+            shutil.rmtree(tmp_dir)
+        # API call and download the first time, only the API call the second time
+        assert mock_request.call_count == 3
+        assert os.listdir(cache_dir) == ['awesome-container.{}.simg'.format(md5)]
+        shutil.rmtree(cache_dir)
+
+    def test_singularity_cache_prune(self):
+        """ Test that the least recently used images are removed from the cache """
+        cache_dir = tempfile.mkdtemp()
+        cache = nf_core.download.SingularityImageCache(cache_dir)
+        for i, name in enumerate(['one', 'two', 'three']):
+            path = cache.image_path(name, 'abc')
+            with open(path, 'wb') as fh:
+                fh.write(b'x' * 100)
+            os.utime(path, (1000 + i, 1000 + i))
+        # Using an image moves it to the back of the queue
+        cache.get('one', 'abc', os.path.join(cache_dir, 'out.img'))
+        removed = cache.prune(150)
+        assert [os.path.basename(p) for p in removed] == ['two.abc.simg', 'three.abc.simg']
+        assert cache.prune(nf_core.download.parse_size('1K')) == []
+        shutil.rmtree(cache_dir)
+
+    def test_parse_size(self):
+        assert nf_core.download.parse_size('100') == 100
+        assert nf_core.download.parse_size('1.5K') == 1536
+        assert nf_core.download.parse_size('20GB') == 20 * 1024**3
+        with pytest.raises(ValueError):
+            nf_core.download.parse_size('lots')
+
     @mock.patch('requests.get')
     @pytest.mark.xfail(raises=RuntimeWarning)
     def test_download_image_shub_without_hit(self,
@@ -310,6 +458,148 @@ class DownloadTest(unittest.TestCase):
         # Clean up
         shutil.rmtree(tmp_dir)
 
+    @mock.patch('subprocess.call')
+    def test_pull_singularity_image_failed(self, mock_call):
+        """ Test that a partly built image is removed and not cached when singularity fails """
+        tmp_dir = tempfile.mkdtemp()
+        cache_dir = tempfile.mkdtemp()
+        os.mkdir(os.path.join(tmp_dir, 'singularity-images'))
+        download_obj = DownloadWorkflow(pipeline = "dummy", outdir = tmp_dir, singularity_cache = cache_dir)
+        def failed_pull(command):
+            with open(command[3], 'w') as fh:
+                fh.write('partial image')
+            return 255
+        mock_call.side_effect = failed_pull
+        download_obj.pull_singularity_image("nfcore/tools:1.0")
+        assert os.listdir(os.path.join(tmp_dir, 'singularity-images')) == []
+        assert os.listdir(cache_dir) == []
+
+        # Clean up
+        shutil.rmtree(tmp_dir)
+        shutil.rmtree(cache_dir)
+
+    #
+    # Tests for 'download_singularity_images'
+    #
+    @mock.patch('nf_core.download.DownloadWorkflow.pull_singularity_image')
+    @mock.patch('nf_core.download.DownloadWorkflow.download_shub_image')
+    def test_download_singularity_images_parallel(self,
+        mock_download_shub,
+        mock_pull_image):
+
+        download_obj = DownloadWorkflow(
+            pipeline = "dummy",
+            parallel_downloads = 3,
+            parallel_builds = 2)
+        download_obj.containers = ['container-{}'.format(i) for i in range(8)]
+
+        # Track how many downloads and builds run at the same time
+        lock = threading.Lock()
+        running = {'download': 0, 'build': 0}
+        max_running = {'download': 0, 'build': 0}
+        def track(kind, fail=False):
+            with lock:
+                running[kind] += 1
+                max_running[kind] = max(max_running[kind], running[kind])
+            time.sleep(0.05)
+            with lock:
+                running[kind] -= 1
+            if fail:
+                raise RuntimeWarning()
+        mock_download_shub.side_effect = lambda c: track('download', fail=c.endswith(('1', '3', '5', '7')))
+        mock_pull_image.side_effect = lambda c: track('build')
+
+        download_obj.download_singularity_images()
+
+        assert mock_download_shub.call_count == 8
+        assert sorted([c[0][0] for c in mock_pull_image.call_args_list]) == ['container-1', 'container-3', 'container-5', 'container-7']
+        assert max_running['download'] <= 3
+        assert max_running['build'] <= 2
+
+    def test_progress_bars(self):
+        """ Test that several progress bars are drawn on their own lines """
+        stream = io.StringIO()
+        stream.isatty = lambda: True
+        bars = nf_core.download.ProgressBars(stream)
+        bar_one = bars.add_bar()
+        bar_two = bars.add_bar()
+        bar_one.write(u'\rone [#--]')
+        bar_two.write(u'\rtwo [##-]')
+        bar_one.write(u'\rone [###]')
+        bar_one.write(u'\n')
+        assert bars.lines == [u'one [###]', u'two [##-]']
+
+    #
+    # Tests for downloading a batch of workflows with 'MirrorWorkflows'
+    #
+    def mock_remote_workflows(self):
+        wfs = nf_core.list.Workflows()
+        wfs.remote_workflows = [
+            nf_core.list.RemoteWorkflow({'name': 'one', 'full_name': 'nf-core/one', 'releases': [
+                {'tag_name': '1.1', 'tag_sha': 'aaa', 'published_at': '2018-12-12T10:00:00Z'},
+                {'tag_name': '1.0', 'tag_sha': 'bbb', 'published_at': '2018-12-12T10:00:00Z'}]}),
+            nf_core.list.RemoteWorkflow({'name': 'two', 'full_name': 'nf-core/two', 'releases': [
+                {'tag_name': '2.0', 'tag_sha': 'ccc', 'published_at': '2018-12-12T10:00:00Z'}]}),
+            nf_core.list.RemoteWorkflow({'name': 'dev', 'full_name': 'nf-core/dev', 'releases': []})
+        ]
+        return wfs
+
+    @mock.patch('nf_core.download.DownloadWorkflow.download_shub_image')
+    @mock.patch('nf_core.download.DownloadWorkflow.find_singularity_images', autospec=True)
+    @mock.patch('nf_core.download.DownloadWorkflow.download_wf_files', autospec=True)
+    @mock.patch('nf_core.list.Workflows')
+    def test_mirror_workflows(self, mock_workflows, mock_download_files, mock_find_images, mock_download_shub):
+        """ Test that a batch of releases is downloaded, skipping existing releases and sharing images """
+        mock_workflows.return_value = self.mock_remote_workflows()
+        outdir = tempfile.mkdtemp()
+        os.mkdir(os.path.join(outdir, 'nf-core-one-1.0'))
+
+        def download_files(dl):
+            os.makedirs(os.path.join(dl.outdir, 'workflow'))
+        mock_download_files.side_effect = download_files
+        def find_images(dl):
+            dl.containers = ['nfcore/shared:1.0', 'nfcore/{}:1.0'.format(dl.wf_name)]
+        mock_find_images.side_effect = find_images
+        def download_shub(container):
+            with open(os.path.join(outdir, '.singularity-images.partial', 'singularity-images', nf_core.download.singularity_image_filename(container)), 'w') as fh:
+                fh.write(container)
+        mock_download_shub.side_effect = download_shub
+
+        mirror = nf_core.download.MirrorWorkflows(outdir, singularity=True)
+        assert mirror.mirror_workflows() == []
+
+        assert sorted(os.listdir(outdir)) == ['nf-core-one-1.0', 'nf-core-one-1.1', 'nf-core-two-2.0', 'singularity-images']
+        assert sorted([c[0][0] for c in mock_download_shub.call_args_list]) == ['nfcore/one:1.0', 'nfcore/shared:1.0', 'nfcore/two:1.0']
+        shared_one = os.path.join(outdir, 'nf-core-one-1.1', 'singularity-images', 'nf-core-shared-1.0.simg')
+        shared_two = os.path.join(outdir, 'nf-core-two-2.0', 'singularity-images', 'nf-core-shared-1.0.simg')
+        assert os.path.samefile(shared_one, shared_two)
+
+        # Nothing left to do the second time
+        mock_download_files.reset_mock()
+        nf_core.download.MirrorWorkflows(outdir, singularity=True).mirror_workflows()
+        assert mock_download_files.call_count == 0
+        shutil.rmtree(outdir)
+
+    @mock.patch('nf_core.list.Workflows.get_remote_workflows')
+    def test_mirror_plan_manifest(self, mock_get_remote):
+        """ Test that a manifest is expanded to releases, ignoring duplicates """
+        wfs = self.mock_remote_workflows()
+        mirror = nf_core.download.MirrorWorkflows('mirror', [('one', None), ('nf-core/one', '1.1'), ('dev', None), ('two', '2.0')])
+        mirror.plan_downloads(wfs)
+        assert [(dl.wf_name, dl.release, dl.outdir) for dl in mirror.downloads] == [
+            ('one', '1.1', os.path.join('mirror', 'nf-core-one-1.1.partial')),
+            ('one', '1.0', os.path.join('mirror', 'nf-core-one-1.0.partial')),
+            ('two', '2.0', os.path.join('mirror', 'nf-core-two-2.0.partial'))
+        ]
+        assert mock_get_remote.call_count == 0
+
+    def test_read_mirror_manifest(self):
+        tmp_fn = tempfile.mktemp()
+        with open(tmp_fn, 'w') as fh:
+            fh.write("# Pipelines to mirror\nrnaseq 1.2\n\nnf-core/methylseq  # all releases\n")
+        assert nf_core.download.read_mirror_manifest(tmp_fn) == [('rnaseq', '1.2'), ('nf-core/methylseq', None)]
+        os.remove(tmp_fn)
+
     #
     # Tests for the main entry method 'download_workflow'
     #
@@ -1,14 +1,19 @@
 #!/usr/bin/env python
 """Some tests covering the pipeline creation sub command.
 """
+import json
+import mock
 import os
+import requests
 import pytest
-import nf_core.lint, nf_core.licences
+import shutil
+import nf_core.lint, nf_core.licences, nf_core.utils
 import tempfile
 import unittest
 
 
 PL_WITH_LICENSES = 'nf-core/hlatyping'
+LICENCE_CORPUS = os.path.join(os.path.dirname(__file__), 'licence_corpus.json')
 
 class WorkflowLicensesTest(unittest.TestCase):
     """ A class that performs tests on the workflow license
@@ -28,4 +33,78 @@ class WorkflowLicensesTest(unittest.TestCase):
     def test_errorness_pipeline_name(self):
         self.license_obj.pipeline = 'notpresent'
         self.license_obj.fetch_conda_licences()
-        self.license_obj.print_licences()
\ No newline at end of file
+        self.license_obj.print_licences()
+
+    @mock.patch('nf_core.utils.PackageMetadataStore.get_many')
+    def test_resolve_licences(self, mock_get_many):
+        """ Test that licences are found for the requested version from the highest priority channel """
+        mock_get_many.return_value = {
+            ('bioconda', 'fastqc'): {'license': 'GPL', 'files': [
+                {'version': '0.11.7', 'attrs': {'license': 'GPL >=3'}},
+                {'version': '0.11.8', 'attrs': {'license': 'GPL-3'}},
+                {'version': '0.11.8', 'attrs': {}}
+            ]},
+            ('conda-forge', 'fastqc'): None,
+            ('bioconda', 'multiqc'): {'license': 'GPLv3', 'files': []},
+            ('conda-forge', 'multiqc'): None,
+            ('bioconda', 'notapackage'): None,
+            ('conda-forge', 'notapackage'): requests.exceptions.ConnectionError()
+        }
+        self.license_obj.package_store = nf_core.utils.PackageMetadataStore(db_path=':memory:')
+        self.license_obj.resolve_licences(['fastqc=0.11.8', 'fastqc=0.11.7', 'multiqc=1.6', 'notapackage=1.0'], ['conda-forge', 'bioconda'])
+        assert mock_get_many.call_count == 1
+        assert self.license_obj.conda_package_licences == {
+            'fastqc=0.11.8': ['GPLv3'],
+            'fastqc=0.11.7': ['GPL >=3'],
+            'multiqc=1.6': ['GPLv3']
+        }
+        # The licence index is only built once for each package
+        assert list(self.license_obj.licence_indexes.keys()) == [('bioconda', 'fastqc'), ('bioconda', 'multiqc')]
+
+    @mock.patch('nf_core.utils.PackageMetadataStore.get_many')
+    @mock.patch('requests.get')
+    def test_pipelines_licence_matrix(self, mock_get, mock_get_many):
+        """ Test that packages shared by several pipelines are looked up once and reported together """
+        env_files = {
+            'rnaseq': "channels:\n  - bioconda\ndependencies:\n  - fastqc=0.11.8\n  - multiqc=1.6\n",
+            'methylseq': "channels:\n  - bioconda\ndependencies:\n  - fastqc=0.11.8\n  - bismark=0.20.0\n"
+        }
+        def get_env(url):
+            response = requests.Response()
+            pipeline = url.split('/')[4]
+            response.status_code = 200 if pipeline in env_files else 404
+            response._content = env_files.get(pipeline, '').encode('utf-8')
+            return response
+        mock_get.side_effect = get_env
+        mock_get_many.return_value = {
+            ('bioconda', 'fastqc'): {'license': 'GPL >=3', 'files': []},
+            ('bioconda', 'multiqc'): {'license': 'GPLv3', 'files': []},
+            ('bioconda', 'bismark'): {'license': 'GPLv3', 'files': []}
+        }
+        cachedir = tempfile.mkdtemp()
+        with mock.patch.dict(os.environ, {'NFCORE_CACHE_DIR': cachedir}):
+            lic = nf_core.licences.PipelinesLicences(['rnaseq', 'nf-core/methylseq', 'notapipeline'])
+            lic.fetch_conda_licences()
+        assert mock_get_many.call_count == 1
+        assert sorted(mock_get_many.call_args[0][0]) == [('bioconda', 'bismark'), ('bioconda', 'fastqc'), ('bioconda', 'multiqc')]
+        assert sorted(lic.licence_matrix()) == [
+            ['bismark', '0.20.0', 'GPLv3', ['methylseq']],
+            ['fastqc', '0.11.8', 'GPL >=3', ['methylseq', 'rnaseq']],
+            ['multiqc', '1.6', 'GPLv3', ['rnaseq']]
+        ]
+        shutil.rmtree(cachedir)
+
+    def test_licence_corpus(self):
+        """ Test licence name normalisation and SPDX identifiers against the corpus of known licence names """
+        with open(LICENCE_CORPUS, 'r') as fh:
+            corpus = json.load(fh)
+        for entry in corpus:
+            assert nf_core.licences.clean_licence_name(entry['licence']) == entry['clean'], entry
+            assert nf_core.licences.spdx_licence_id(entry['clean']) == entry['spdx'], entry
+        # Results are remembered
+        assert nf_core.licences.licence_name_cache['GPL-3'] == 'GPLv3'
+
+    def test_clean_licence_names_spdx(self):
+        """ Test that licences are given as SPDX identifiers where known """
+        self.license_obj.spdx = True
+        assert self.license_obj.clean_licence_names(['GPL (>= 2)', 'MIT + file LICENSE', 'Custom']) == ['GPL-2.0-or-later', 'MIT', 'Custom']
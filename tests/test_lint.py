@@ -15,6 +15,9 @@ import os
 import yaml
 import requests
 import pytest
+import shutil
+import tempfile
+import time
 import unittest
 import mock
 import nf_core.lint
@@ -45,6 +48,16 @@ ADD_PASS_RELEASE = 1
 class TestLint(unittest.TestCase):
     """Class for lint tests"""
 
+    def setUp(self):
+        # Don't share cached package metadata between tests
+        self.cachedir = tempfile.mkdtemp()
+        self.env = mock.patch.dict(os.environ, {'NFCORE_CACHE_DIR': self.cachedir})
+        self.env.start()
+
+    def tearDown(self):
+        self.env.stop()
+        shutil.rmtree(self.cachedir)
+
     def assess_lint_status(self, lint_obj, **expected):
         """Little helper function for assessing the lint
         object status lists"""
@@ -76,6 +89,63 @@ class TestLint(unittest.TestCase):
         expectations = {"failed": 0, "warned": 3, "passed": MAX_PASS_CHECKS + ADD_PASS_RELEASE}
         self.assess_lint_status(lint_obj, **expectations)
 
+    def mock_lint_checks(self, lint_obj, failing=None, delays=None):
+        """Replace the lint check functions with stubs that record the run order"""
+        run_order = []
+        def check(fname):
+            run_order.append(fname)
+            time.sleep((delays or {}).get(fname, 0))
+            if fname in (failing or []):
+                lint_obj.failed.append((1, "Mock failure: {}".format(fname)))
+            else:
+                lint_obj.passed.append((1, "Mock pass: {}".format(fname)))
+        for fname in lint_obj.lint_check_requires:
+            setattr(lint_obj, fname, lambda fname=fname: check(fname))
+        return run_order
+
+    def test_lint_checks_dependency_order(self):
+        """Tests that lint checks only start once the data they need is loaded"""
+        lint_obj = nf_core.lint.PipelineLint(PATH_WORKING_EXAMPLE)
+        run_order = self.mock_lint_checks(lint_obj)
+        lint_obj.run_checks(list(lint_obj.lint_check_requires.keys()))
+        assert sorted(run_order) == sorted(lint_obj.lint_check_requires.keys())
+        assert run_order[0] == 'check_files_exist'
+        for fname in ['check_ci_config', 'check_readme', 'check_conda_env_yaml', 'check_version_consistency']:
+            assert run_order.index('check_nextflow_config') < run_order.index(fname)
+        assert run_order.index('check_docker') < run_order.index('check_conda_dockerfile')
+        assert run_order.index('check_singularity') < run_order.index('check_conda_singularityfile')
+
+    def test_lint_checks_halt_on_failure(self):
+        """Tests that no new lint checks are started after a failure"""
+        lint_obj = nf_core.lint.PipelineLint(PATH_WORKING_EXAMPLE)
+        run_order = self.mock_lint_checks(lint_obj, failing=['check_files_exist'])
+        lint_obj.run_checks(list(lint_obj.lint_check_requires.keys()))
+        assert run_order == ['check_files_exist']
+
+    def test_lint_checks_halt_results_in_order(self):
+        """Tests that results are reported up to the first failure in listed order, whichever check finishes first"""
+        check_functions = ['check_files_exist', 'check_licence', 'check_docker', 'check_singularity', 'check_pipeline_todos']
+        for delays in [{'check_licence': 0.1}, {'check_docker': 0.1}]:
+            lint_obj = nf_core.lint.PipelineLint(PATH_WORKING_EXAMPLE)
+            self.mock_lint_checks(lint_obj, failing=['check_docker', 'check_singularity'], delays=delays)
+            lint_obj.run_checks(check_functions)
+            assert lint_obj.passed == [(1, "Mock pass: check_files_exist"), (1, "Mock pass: check_licence")]
+            assert lint_obj.failed == [(1, "Mock failure: check_docker")]
+
+    def test_lint_checks_keep_going(self):
+        """Tests that all lint checks run after a failure with keep_going"""
+        lint_obj = nf_core.lint.PipelineLint(PATH_WORKING_EXAMPLE)
+        run_order = self.mock_lint_checks(lint_obj, failing=['check_files_exist', 'check_nextflow_config'])
+        lint_obj.run_checks(list(lint_obj.lint_check_requires.keys()), keep_going=True)
+        assert len(run_order) == len(lint_obj.lint_check_requires)
+        self.assess_lint_status(lint_obj, failed=2)
+
+    @pytest.mark.xfail(raises=AssertionError)
+    def test_lint_checks_critical_error(self):
+        """Tests that critical errors in a lint check are raised"""
+        lint_obj = nf_core.lint.PipelineLint(PATH_CRITICAL_EXAMPLE)
+        lint_obj.run_checks(['check_files_exist', 'check_licence'], keep_going=True)
+
     def test_failing_dockerfile_example(self):
         """Tests for empty Dockerfile"""
         lint_obj = nf_core.lint.PipelineLint(PATH_FAILING_EXAMPLE)
@@ -280,7 +350,7 @@ class TestLint(unittest.TestCase):
         expectations = {"failed": 3, "warned": 1, "passed": 2}
         self.assess_lint_status(lint_obj, **expectations)
 
-    @mock.patch('requests.get')
+    @mock.patch('requests.Session.request')
     @pytest.mark.xfail(raises=ValueError)
     def test_conda_env_timeout(self, mock_get):
         """ Tests the conda environment handles API timeouts """
@@ -291,6 +361,21 @@ class TestLint(unittest.TestCase):
         lint_obj.conda_config['channels'] = ['bioconda']
         lint_obj.check_anaconda_package('multiqc=1.6')
 
+    @mock.patch('requests.Session.request')
+    def test_conda_channel_priority(self, mock_request):
+        """ Tests that all channels are queried and the highest priority result is used """
+        def api_response(method, url, **kwargs):
+            response = requests.Response()
+            response.status_code = 200
+            response._content = '{{"url": "{}"}}'.format(url).encode('utf-8')
+            return response
+        mock_request.side_effect = api_response
+        lint_obj = nf_core.lint.PipelineLint(PATH_WORKING_EXAMPLE)
+        lint_obj.conda_config['channels'] = ['defaults', 'conda-forge', 'bioconda']
+        lint_obj.check_anaconda_package('multiqc=1.6')
+        assert mock_request.call_count == 3
+        assert lint_obj.conda_package_info['multiqc=1.6']['url'] == 'https://api.anaconda.org/package/bioconda/multiqc'
+
     def test_conda_env_skip(self):
         """ Tests the conda environment config is skipped when not needed """
         lint_obj = nf_core.lint.PipelineLint(PATH_WORKING_EXAMPLE)
@@ -348,7 +433,7 @@ class TestLint(unittest.TestCase):
         expectations = {"failed": 0, "warned": 1, "passed": 2}
         self.assess_lint_status(lint_obj, **expectations)
 
-    @mock.patch('requests.get')
+    @mock.patch('requests.Session.request')
     def test_pypi_timeout_warn(self, mock_get):
         """ Tests the PyPi connection and simulates a request timeout, which should
         return in an addiional warning in the linting """
@@ -364,7 +449,7 @@ class TestLint(unittest.TestCase):
         expectations = {"failed": 0, "warned": 1, "passed": 2}
         self.assess_lint_status(lint_obj, **expectations)
 
-    @mock.patch('requests.get')
+    @mock.patch('requests.Session.request')
     def test_pypi_connection_error_warn(self, mock_get):
         """ Tests the PyPi connection and simulates a connection error, which should
         result in an additional warning, as we cannot test if dependent module is latest """
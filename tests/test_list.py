@@ -4,10 +4,14 @@
 
 import nf_core.list
 
+import io
+import json
 import mock
 import os
 import git
 import pytest
+import shutil
+import tempfile
 import time
 import unittest
 
@@ -38,6 +42,26 @@ class TestLint(unittest.TestCase):
         now_ts = time.mktime(now.timetuple())
         nf_core.list.pretty_date(now_ts)
 
+    def test_github_timestamp(self):
+        """ Test that GitHub dates are parsed as UTC """
+        assert nf_core.list.github_timestamp('2018-12-12T10:00:00Z') == 1544608800
+        assert nf_core.list.github_timestamp(None) is None
+        with pytest.raises(ValueError):
+            nf_core.list.github_timestamp('12/12/2018')
+        rwf = nf_core.list.RemoteWorkflow({'releases': [{'published_at': '1970-01-01T00:01:00Z'}]})
+        assert rwf.releases[0]['published_at_timestamp'] == 60
+        assert 'published_at_pretty' not in rwf.releases[0]
+
+    def test_local_workflow_pretty_dates(self):
+        """ Test that local workflow dates are formatted when needed """
+        lwf = nf_core.list.LocalWorkflow('nf-core/dummy')
+        assert lwf.last_pull_pretty is None
+        lwf.last_pull = time.time() - 7200
+        assert lwf.last_pull_pretty == '2 hours ago'
+        assert lwf.json_record()['last_pull_pretty'] == '2 hours ago'
+        with pytest.raises(AttributeError):
+            lwf.not_an_attribute = True
+
     @raises(AssertionError)
     def test_local_workflows_and_fail(self):
         """ Test the local workflow class and try to get local
@@ -65,7 +89,6 @@ class TestLint(unittest.TestCase):
         }
 
         rwf_ex = nf_core.list.RemoteWorkflow(remote)
-        rwf_ex.commit_sha = "aw3s0meh1sh"
         rwf_ex.releases = [{'tag_sha': "aw3s0meh1sh"}]
     
 
@@ -123,3 +146,88 @@ class TestLint(unittest.TestCase):
         local_wf.get_local_nf_workflow_details()
     
 
+    @mock.patch('subprocess.check_output')
+    def test_find_local_paths_batched(self, mock_subprocess):
+        """ Test that `nextflow info` is only run once to find several local workflows """
+        assets_dir = tempfile.mkdtemp()
+        for wf_name in ['one', 'two']:
+            os.makedirs(os.path.join(assets_dir, 'nf-core', wf_name))
+        mock_subprocess.return_value = "local path : {}\n".format(os.path.join(assets_dir, 'nf-core', 'one')).encode('utf-8')
+        wfs = nf_core.list.Workflows()
+        wfs.local_workflows = [nf_core.list.LocalWorkflow('nf-core/one'), nf_core.list.LocalWorkflow('nf-core/two')]
+        with mock.patch.dict(os.environ, {'NXF_ASSETS': tempfile.gettempdir()}):
+            wfs.find_local_paths()
+        assert mock_subprocess.call_count == 1
+        assert [wf.local_path for wf in wfs.local_workflows] == [os.path.join(assets_dir, 'nf-core', wf_name) for wf_name in ['one', 'two']]
+        shutil.rmtree(assets_dir)
+
+    def test_read_git_details(self):
+        """ Test that git details read from the .git directory match GitPython """
+        repo_path = tempfile.mkdtemp()
+        repo = git.Repo.init(repo_path)
+        with open(os.path.join(repo_path, 'main.nf'), 'w') as fh:
+            fh.write('dummy')
+        repo.index.add(['main.nf'])
+        repo.index.commit('Initial commit')
+        repo.git.checkout('-b', 'dev')
+        repo.create_remote('origin', 'https://github.com/nf-core/dummy.git')
+        expected = (repo.head.commit.hexsha, 'dev', 'https://github.com/nf-core/dummy.git')
+        assert nf_core.list.read_git_details(repo_path) == expected
+        repo.git.pack_refs('--all')
+        assert not os.path.exists(os.path.join(repo_path, '.git', 'refs', 'heads', 'dev'))
+        assert nf_core.list.read_git_details(repo_path) == expected
+        # Detached HEAD is left to GitPython
+        repo.git.checkout(repo.head.commit.hexsha)
+        assert nf_core.list.read_git_details(repo_path) is None
+        shutil.rmtree(repo_path)
+
+    def test_keyword_filter_index(self):
+        """ Test that keyword filtering with the index matches a full text search """
+        wfs = nf_core.list.Workflows()
+        for name, description, topics in [
+            ('rnaseq', 'RNA sequencing analysis pipeline', ['rna-seq', 'nextflow']),
+            ('methylseq', 'Methylation (Bisulfite-Sequencing) pipeline', ['bisulfite-sequencing', 'methylation']),
+            ('hlatyping', 'Precision HLA typing from NGS data', []),
+            ('deepvariant', None, ['variant_calling'])
+        ]:
+            wfs.remote_workflows.append(nf_core.list.RemoteWorkflow({'name': name, 'description': description, 'topics': topics, 'releases': []}))
+        for keywords in [['seq'], ['rna', 'seq'], ['RNA'], ['-seq'], ['RNA seq'], ['Bisulfite-Seq'], ['a'], ['_call'], ['nomatch'], ['seq', 'nomatch']]:
+            wfs.keyword_filters = keywords
+            expected = [wf for wf in wfs.remote_workflows if all([
+                k in wf.name or k in (wf.description or '') or any([k in t for t in wf.topics]) for k in keywords])]
+            assert wfs.filtered_workflows() == expected, keywords
+
+    def mock_json_workflows(self):
+        wfs = nf_core.list.Workflows(sort='name')
+        for name in ['rnaseq', 'methylseq', 'atacseq']:
+            wfs.remote_workflows.append(nf_core.list.RemoteWorkflow({
+                'name': name, 'full_name': 'nf-core/{}'.format(name), 'description': '{} pipeline'.format(name),
+                'releases': [{'tag_name': '1.0', 'tag_sha': 'abc', 'published_at': '2018-12-12T10:00:00Z', 'published_at_pretty': 'ignored'}]
+            }))
+        lwf = nf_core.list.LocalWorkflow('nf-core/rnaseq')
+        lwf.commit_sha = 'abc'
+        wfs.local_workflows.append(lwf)
+        wfs.compare_remote_local()
+        return wfs
+
+    def test_print_json(self):
+        """ Test that JSON output is sorted, with the local workflow given by name """
+        wfs = self.mock_json_workflows()
+        stream = io.StringIO()
+        wfs.print_json(stream=stream)
+        output = json.loads(stream.getvalue())
+        assert [wf['name'] for wf in output['remote_workflows']] == ['atacseq', 'methylseq', 'rnaseq']
+        assert output['remote_workflows'][2]['local_wf'] == 'nf-core/rnaseq'
+        assert output['remote_workflows'][2]['local_is_latest'] is True
+        assert list(output['remote_workflows'][0]['releases'][0].keys()) == ['tag_name', 'tag_sha', 'published_at', 'published_at_timestamp']
+        assert list(output['local_workflows'][0].keys()) == list(nf_core.list.LocalWorkflow.json_fields)
+
+    def test_print_ndjson_filtered(self):
+        """ Test that NDJSON output has one line per workflow, respecting keyword filters """
+        wfs = self.mock_json_workflows()
+        wfs.keyword_filters = ['seq', 'a']
+        stream = io.StringIO()
+        wfs.print_json(ndjson=True, stream=stream)
+        records = [json.loads(line) for line in stream.getvalue().splitlines()]
+        assert [(r['type'], r['full_name']) for r in records] == [
+            ('local', 'nf-core/rnaseq'), ('remote', 'nf-core/atacseq'), ('remote', 'nf-core/rnaseq')]
@@ -0,0 +1,388 @@
+#!/usr/bin/env python
+""" Tests covering the template sync bot in bin/sync.
+"""
+
+from multiprocessing.pool import ThreadPool
+import git
+import json
+import mock
+import os
+import requests
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import unittest
+
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+    from urllib.parse import urlparse, parse_qs
+except ImportError:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+    from urlparse import urlparse, parse_qs
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'bin'))
+import syncutils.github
+import syncutils.orchestrator
+import syncutils.template
+import syncutils.utils
+
+import nf_core.create
+
+NEXTFLOW_CONFIG = """
+/*
+ * A test pipeline config
+ */
+params {
+  outdir = './results'
+  help = false // Show the help
+}
+manifest {
+  name = 'nf-core/testpipeline'
+  description = "A test pipeline"
+  homePage = 'https://github.com/nf-core/testpipeline'
+  version = '1.0dev'
+}
+manifest.author = 'Chuck Norris'
+profiles {
+  docker { docker.enabled = true }
+  test { includeConfig 'conf/test.config' }
+}
+"""
+
+
+class FakeTask(object):
+    """ A sync task that records which stages were run """
+    stages = ['clone', 'render', 'pull_request']
+    running = 0
+    max_running = 0
+    lock = threading.Lock()
+
+    def __init__(self, pipeline, failures=None, unchanged=False):
+        self.pipeline = pipeline
+        self.failures = list(failures or [])
+        self.unchanged = unchanged
+        self.cleaned = False
+
+    def clone(self):
+        with self.lock:
+            FakeTask.running += 1
+            FakeTask.max_running = max(FakeTask.max_running, FakeTask.running)
+        time.sleep(0.05)
+        with self.lock:
+            FakeTask.running -= 1
+        if self.failures:
+            raise self.failures.pop(0)
+
+    def render(self):
+        return False if self.unchanged else None
+
+    def pull_request(self):
+        return 'https://github.com/nf-core/{}/pull/1'.format(self.pipeline)
+
+    def cleanup(self):
+        self.cleaned = True
+
+
+class TestSyncOrchestrator(unittest.TestCase):
+    """ Tests for running the sync stages of many pipelines """
+
+    def setUp(self):
+        FakeTask.running = 0
+        FakeTask.max_running = 0
+        self.tasks = {}
+
+    def run_sync(self, pipelines, **kwargs):
+        def make_task(pipeline):
+            self.tasks[pipeline] = FakeTask(pipeline, **pipelines[pipeline])
+            return self.tasks[pipeline]
+        orchestrator = syncutils.orchestrator.SyncOrchestrator(make_task, retry_delay=0, **kwargs)
+        return dict((r.pipeline, r) for r in orchestrator.run(sorted(pipelines)))
+
+    def test_bounded_workers(self):
+        """ Test that all pipelines are synced, with no more than max_workers at once """
+        results = self.run_sync(dict(('pipeline{}'.format(i), {}) for i in range(8)), max_workers=3)
+        assert len(results) == 8
+        assert all(r.status == 'synced' for r in results.values())
+        assert results['pipeline0'].pr_url == 'https://github.com/nf-core/pipeline0/pull/1'
+        assert 1 < FakeTask.max_running <= 3
+        assert all(t.cleaned for t in self.tasks.values())
+
+    def test_retry_transient(self):
+        """ Test that transient errors are retried and other errors are not """
+        results = self.run_sync({
+            'flaky': {'failures': [requests.exceptions.ConnectionError(), syncutils.orchestrator.TransientError()]},
+            'broken': {'failures': [ValueError('bad config')]},
+            'down': {'failures': [requests.exceptions.ConnectionError()] * 3},
+            'same': {'unchanged': True}
+        }, retries=2)
+        assert results['flaky'].status == 'synced'
+        assert results['flaky'].attempts == {'clone': 3, 'render': 1, 'pull_request': 1}
+        assert results['broken'].status == 'failed'
+        assert results['broken'].attempts == {'clone': 1}
+        assert results['broken'].error == 'ValueError: bad config'
+        assert results['down'].status == 'failed'
+        assert results['down'].stage == 'clone'
+        assert results['same'].status == 'unchanged'
+        assert results['same'].pr_url is None
+
+        report = syncutils.orchestrator.SyncOrchestrator.summary(results.values(), tag='1.5')
+        assert report['tag'] == '1.5'
+        assert report['counts'] == {'synced': 1, 'unchanged': 1, 'failed': 2}
+        assert [p['pipeline'] for p in report['pipelines']] == ['broken', 'down', 'flaky', 'same']
+
+
+class TestNfcoreTemplate(unittest.TestCase):
+    """ Tests for syncing the template branch of a pipeline repository """
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.remote = os.path.join(self.tmpdir, 'remote.git')
+        self.mirror_dir = os.path.join(self.tmpdir, 'mirrors')
+        git.Repo.init(self.remote, bare=True)
+        work = git.Repo.clone_from(self.remote, os.path.join(self.tmpdir, 'work'))
+        with open(os.path.join(work.working_dir, 'main.nf'), 'w') as fh:
+            fh.write('// pipeline\n')
+        work.git.add(A=True)
+        work.index.commit('Initial commit')
+        work.git.push('origin', 'HEAD:TEMPLATE')
+        with open(os.path.join(work.working_dir, 'nextflow.config'), 'w') as fh:
+            fh.write(NEXTFLOW_CONFIG)
+        work.git.add(A=True)
+        work.index.commit('Add config')
+        work.git.push('origin', 'HEAD:master')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_parse_config(self):
+        """ Test that simple config assignments are read without nextflow """
+        config = syncutils.utils.parse_config(NEXTFLOW_CONFIG)
+        assert config['manifest.name'] == 'nf-core/testpipeline'
+        assert config['manifest.description'] == 'A test pipeline'
+        assert config['manifest.author'] == 'Chuck Norris'
+        assert config['params.help'] == 'false'
+        assert config['params.outdir'] == './results'
+        assert config['profiles.docker.docker.enabled'] == 'true'
+        assert 'profiles.test.includeConfig' not in config
+        assert syncutils.utils.create_context(config)['version'] == '1.0dev'
+
+        # One line blocks
+        config = syncutils.utils.parse_config("manifest { name = 'nf-core/x'; version = '1.0' }\nparams.a = 1")
+        assert config == {'manifest.name': 'nf-core/x', 'manifest.version': '1.0', 'params.a': '1'}
+
+        # Values that need Groovy to evaluate can't be read
+        config = syncutils.utils.parse_config(
+            "manifest {\n  name = 'nf-core/x'\n  description = \"Pipeline ${x}\"\n  version = '1.0' + suffix\n}\n"
+            "process {\n  cpus = {\n    check_max(2)\n  }\n}\nparams.outdir = params.base"
+        )
+        assert config == {
+            'manifest.name': 'nf-core/x',
+            'manifest.description': None,
+            'manifest.version': None,
+            'process.cpus': None,
+            'params.outdir': None
+        }
+        with self.assertRaises(ValueError):
+            syncutils.utils.create_context(config)
+
+        # Settings that are missing, e.g. because they are in an included file
+        config = syncutils.utils.parse_config("includeConfig 'conf/manifest.config'\nparams.outdir = './results'")
+        assert config == {'params.outdir': './results'}
+        with self.assertRaises(ValueError):
+            syncutils.utils.create_context(config)
+
+    def test_sync_template_branch(self):
+        """ Test that the template is committed to the template branch once """
+        responses = []
+        def create_pr(pipeline):
+            responses.append(pipeline)
+            return 'https://github.com/nf-core/testpipeline/pull/1'
+
+        sync = syncutils.template.NfcoreTemplate('testpipeline', repo_url=self.remote, create_pr=create_pr, mirror_dir=self.mirror_dir)
+        results = [getattr(sync, stage)() for stage in sync.stages]
+        assert results[-1] == 'https://github.com/nf-core/testpipeline/pull/1'
+        assert responses == ['testpipeline']
+        template_files = git.Repo(self.remote).git.ls_tree('-r', '--name-only', 'TEMPLATE').split()
+        assert 'nextflow.config' in template_files
+        assert 'main.nf' in template_files
+
+        # The template branch was never checked out from master
+        assert 'nextflow.config' not in git.Repo(self.remote).git.ls_tree('-r', '--name-only', 'TEMPLATE~1').split()
+
+        # The mirror is reused, and the unchanged template is spotted before anything is checked out
+        sync.cleanup()
+        assert sync.tmpdir is None
+        sync = syncutils.template.NfcoreTemplate('testpipeline', repo_url=self.remote, create_pr=create_pr, mirror_dir=self.mirror_dir)
+        sync.fetch()
+        assert sync.mirror.git.rev_parse('TEMPLATE') == git.Repo(self.remote).git.rev_parse('TEMPLATE')
+        assert sync.check_template() is False
+        assert sync.tmpdir is None
+        sync.sync()
+        assert responses == ['testpipeline']
+        assert os.listdir(self.mirror_dir) == ['testpipeline.git']
+        assert sync.mirror.git.worktree('list').count('\n') == 0
+
+        # A changed template branch is synced again
+        sync.checkout()
+        os.remove(os.path.join(sync.tmpdir, 'main.nf'))
+        sync.commit_changes()
+        sync.push_changes()
+        sync.fetch()
+        assert sync.check_template() is None
+
+    def test_shared_mirror_refused(self):
+        """ Test that mirrors are not used from a directory that other users can write to """
+        os.makedirs(self.mirror_dir)
+        os.chmod(self.mirror_dir, 0o777)
+        sync = syncutils.template.NfcoreTemplate('testpipeline', repo_url=self.remote, mirror_dir=self.mirror_dir)
+        with self.assertRaises(RuntimeError):
+            sync.fetch()
+        assert os.listdir(self.mirror_dir) == []
+
+    def test_git_tree_hash(self):
+        """ Test that the tree hash of the rendered template matches git's """
+        files = list(nf_core.create.PipelineTemplate.load().render_files({'name': 'nf-core/test', 'name_docker': 'nfcore/test'}))
+        repo = git.Repo.init(os.path.join(self.tmpdir, 'rendered'))
+        nf_core.create.PipelineTemplate.load().render(repo.working_dir, {'name': 'nf-core/test', 'name_docker': 'nfcore/test'})
+        repo.git.add(A=True)
+        assert syncutils.utils.git_tree_hash(files) == repo.git.write_tree()
+
+
+class MockGitHubServer(ThreadingMixIn, HTTPServer):
+    """ A local stand in for the GitHub pulls API """
+    daemon_threads = True
+
+    def __init__(self):
+        HTTPServer.__init__(self, ('127.0.0.1', 0), MockGitHubHandler)
+        self.lock = threading.Lock()
+        self.pulls = {}
+        self.requests = []
+        self.rate_limited = set()
+
+    @property
+    def url(self):
+        return 'http://127.0.0.1:{}'.format(self.server_address[1])
+
+
+class MockGitHubHandler(BaseHTTPRequestHandler):
+    """ Lists open pull requests in pages of two, and opens new ones """
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args):
+        pass
+
+    def send_json(self, status, data, headers={}):
+        content = json.dumps(data).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(content)))
+        for key, value in headers.items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(content)
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        repo = url.path.split('/')[2:4]
+        page = int(parse_qs(url.query).get('page', ['1'])[0])
+        with self.server.lock:
+            self.server.requests.append(('GET', '/'.join(repo), page))
+            pulls = self.server.pulls.get('/'.join(repo), [])
+        headers = {}
+        if len(pulls) > page * 2:
+            headers['Link'] = '<{}{}?state=open&page={}>; rel="next"'.format(self.server.url, url.path, page + 1)
+        self.send_json(200, pulls[(page - 1) * 2:page * 2], headers)
+
+    def do_POST(self):
+        repo = '/'.join(self.path.split('/')[2:4])
+        data = json.loads(self.rfile.read(int(self.headers['Content-Length'])).decode('utf-8'))
+        with self.server.lock:
+            self.server.requests.append(('POST', repo, None))
+            if repo in self.server.rate_limited:
+                self.server.rate_limited.remove(repo)
+                return self.send_json(403, {'message': 'secondary rate limit'}, {'Retry-After': '7'})
+            pull = {
+                'html_url': 'https://github.com/{}/pull/{}'.format(repo, len(self.server.pulls.get(repo, [])) + 1),
+                'head': {'ref': data['head']},
+                'base': {'ref': data['base']}
+            }
+            self.server.pulls.setdefault(repo, []).append(pull)
+        self.send_json(201, pull, {'X-RateLimit-Remaining': '4999'})
+
+
+class TestGitHubClient(unittest.TestCase):
+    """ Tests for the pooled GitHub client, against a local mock server """
+
+    def setUp(self):
+        self.server = MockGitHubServer()
+        self.thread = threading.Thread(target=self.server.serve_forever, kwargs={'poll_interval': 0.05})
+        self.thread.daemon = True
+        self.thread.start()
+        self.client = syncutils.github.GitHubClient(token='abc', api_url=self.server.url)
+        self.sleep = mock.patch('syncutils.github.time.sleep')
+        self.mock_sleep = self.sleep.start()
+
+    def tearDown(self):
+        self.sleep.stop()
+        self.server.shutdown()
+        self.server.server_close()
+
+    def ensure(self, repo):
+        return self.client.ensure_pull_request(repo, head='TEMPLATE', base='dev', title='Template update', body='')
+
+    def test_existing_pull_request(self):
+        """ Test that an open pull request is found on a later page and not opened again """
+        self.server.pulls['nf-core/busy'] = [
+            {'html_url': 'https://github.com/nf-core/busy/pull/{}'.format(i), 'head': {'ref': 'feature'}, 'base': {'ref': 'dev'}}
+            for i in range(1, 5)
+        ] + [{'html_url': 'https://github.com/nf-core/busy/pull/5', 'head': {'ref': 'TEMPLATE'}, 'base': {'ref': 'dev'}}]
+        assert self.ensure('nf-core/busy') == 'https://github.com/nf-core/busy/pull/5'
+        assert self.server.requests == [('GET', 'nf-core/busy', 1), ('GET', 'nf-core/busy', 2), ('GET', 'nf-core/busy', 3)]
+
+    def test_concurrent_pull_requests(self):
+        """ Test that pull requests are opened concurrently, waiting out a rate limit """
+        repos = ['nf-core/pipeline{}'.format(i) for i in range(10)]
+        self.server.rate_limited.add('nf-core/pipeline3')
+        pool = ThreadPool(4)
+        urls = pool.map(self.ensure, repos)
+        pool.close()
+        assert urls == ['https://github.com/{}/pull/1'.format(repo) for repo in repos]
+        assert len([r for r in self.server.requests if r[0] == 'GET']) == 10
+        assert len([r for r in self.server.requests if r[0] == 'POST']) == 11
+        assert max(call[0][0] for call in self.mock_sleep.call_args_list) > 6
+
+        # Opening them again finds the existing pull requests
+        assert self.ensure('nf-core/pipeline3') == 'https://github.com/nf-core/pipeline3/pull/1'
+        assert len([r for r in self.server.requests if r[0] == 'POST']) == 11
+
+    def test_rate_limit_exhausted(self):
+        """ Test that hitting the rate limit pauses requests until it resets """
+        response = requests.Response()
+        response.status_code = 200
+        response.headers.update({'X-RateLimit-Remaining': '0', 'X-RateLimit-Reset': str(time.time() + 120)})
+        assert self.client.backoff(response) is False
+        self.client.wait()
+        assert self.mock_sleep.call_args[0][0] > 100
+        response.status_code = 403
+        assert self.client.backoff(response) is True
+
+    def test_uncached_session(self):
+        """ Test that API requests skip the requests cache """
+        import requests_cache
+        cache_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, cache_dir)
+
+        # Swap in a caching session class, as requests_cache.install_cache() does, but only for this test
+        class CachedSession(requests_cache.CachedSession):
+            def __init__(self):
+                requests_cache.CachedSession.__init__(self, os.path.join(cache_dir, 'requests_cache'), backend='sqlite')
+        with mock.patch('requests.Session', CachedSession), mock.patch('requests.sessions.Session', CachedSession):
+            client = syncutils.github.GitHubClient(api_url=self.server.url)
+            assert not hasattr(client.session, 'cache')
+            client.get_all('/repos/nf-core/tools/pulls')
+            client.get_all('/repos/nf-core/tools/pulls')
+        assert len(self.server.requests) == 2
@@ -0,0 +1,214 @@
+#!/usr/bin/env python
+""" Tests covering the utility functions.
+"""
+
+import nf_core.utils
+
+from multiprocessing.pool import ThreadPool
+import getpass
+import mock
+import os
+import requests
+import requests_cache  # Imported before any test patches requests.Session, which it subclasses
+import shutil
+import tempfile
+import time
+import unittest
+
+WD = os.path.dirname(__file__)
+PATH_WORKING_EXAMPLE = os.path.join(WD, 'lint_examples/minimal_working_example')
+
+class TestUtils(unittest.TestCase):
+    """Class for utils tests"""
+
+    def setUp(self):
+        self.cachedir = tempfile.mkdtemp()
+        self.wf_path = os.path.join(tempfile.mkdtemp(), 'workflow')
+        shutil.copytree(PATH_WORKING_EXAMPLE, self.wf_path)
+        self.env = mock.patch.dict(os.environ, {'NFCORE_CACHE_DIR': self.cachedir, 'NXF_VER': '0.32.0'})
+        self.env.start()
+
+    def tearDown(self):
+        self.env.stop()
+        shutil.rmtree(self.cachedir)
+        shutil.rmtree(os.path.dirname(self.wf_path))
+
+    @mock.patch('subprocess.check_output')
+    def test_fetch_wf_config_cached(self, mock_subprocess):
+        """ Test that a second config fetch is read from the cache """
+        mock_subprocess.return_value = b"manifest.name = 'nf-core/tools'\nparams.outdir = './results'"
+        config = nf_core.utils.fetch_wf_config(self.wf_path)
+        assert config['manifest.name'] == "'nf-core/tools'"
+        cached_config = nf_core.utils.fetch_wf_config(self.wf_path)
+        assert cached_config == config
+        assert mock_subprocess.call_count == 1
+        cache_dir = nf_core.utils.get_private_cache_dir('wf_config')
+        assert os.path.dirname(cache_dir) == os.path.join(self.cachedir, 'user-{}'.format(getpass.getuser()))
+        assert os.stat(os.path.dirname(cache_dir)).st_mode & 0o777 == 0o700
+        cache_fn = os.path.join(cache_dir, os.listdir(cache_dir)[0])
+        assert os.stat(cache_fn).st_mode & 0o777 == 0o644
+
+    @mock.patch('subprocess.check_output')
+    def test_fetch_wf_config_shared_cache_refused(self, mock_subprocess):
+        """ Test that a cache directory other users can write to is not used """
+        mock_subprocess.return_value = b"manifest.name = 'nf-core/tools'"
+        private_dir = os.path.join(self.cachedir, 'user-{}'.format(getpass.getuser()))
+        os.makedirs(os.path.join(private_dir, 'wf_config'))
+        os.chmod(private_dir, 0o777)
+        with self.assertRaises(OSError):
+            nf_core.utils.get_private_cache_dir()
+        nf_core.utils.fetch_wf_config(self.wf_path)
+        nf_core.utils.fetch_wf_config(self.wf_path)
+        assert mock_subprocess.call_count == 2
+        assert os.listdir(os.path.join(private_dir, 'wf_config')) == []
+
+    @mock.patch('subprocess.check_output')
+    def test_fetch_wf_config_cache_invalidated(self, mock_subprocess):
+        """ Test that changing a config file or the Nextflow version invalidates the cache """
+        mock_subprocess.return_value = b"manifest.name = 'nf-core/tools'"
+        nf_core.utils.fetch_wf_config(self.wf_path)
+        with open(os.path.join(self.wf_path, 'conf', 'base.config'), 'a') as fh:
+            fh.write("\nparams.foo = 'bar'\n")
+        nf_core.utils.fetch_wf_config(self.wf_path)
+        assert mock_subprocess.call_count == 2
+        os.environ['NXF_VER'] = '19.01.0'
+        nf_core.utils.fetch_wf_config(self.wf_path)
+        assert mock_subprocess.call_count == 3
+
+    @mock.patch('subprocess.check_output')
+    def test_fetch_wf_config_no_cache(self, mock_subprocess):
+        """ Test that the config cache can be skipped """
+        mock_subprocess.return_value = b"manifest.name = 'nf-core/tools'"
+        nf_core.utils.fetch_wf_config(self.wf_path, cache_config=False)
+        nf_core.utils.fetch_wf_config(self.wf_path, cache_config=False)
+        assert mock_subprocess.call_count == 2
+        assert not os.path.exists(os.path.join(self.cachedir, 'user-{}'.format(getpass.getuser()), 'wf_config'))
+
+    def test_nextflow_version_from_launcher(self):
+        """ Test that the Nextflow version is read from the launcher script """
+        del os.environ['NXF_VER']
+        bindir = tempfile.mkdtemp()
+        launcher = os.path.join(bindir, 'nextflow')
+        with open(launcher, 'w') as fh:
+            fh.write("#!/usr/bin/env bash\nNXF_VER=${NXF_VER:-'19.01.0'}\n")
+        os.chmod(launcher, 0o755)
+        with mock.patch.dict(os.environ, {'PATH': bindir}):
+            assert nf_core.utils.get_nextflow_version() == '19.01.0'
+        shutil.rmtree(bindir)
+
+    def mock_api_response(self, status_code, data=None, headers={}):
+        response = requests.Response()
+        response.status_code = status_code
+        response._content = (data or '').encode('utf-8')
+        response.headers.update(headers)
+        return response
+
+    @mock.patch('requests.Session.request')
+    def test_package_store_fresh_entry(self, mock_request):
+        """ Test that fresh package metadata is reused without asking the API """
+        mock_request.return_value = self.mock_api_response(200, '{"name": "multiqc"}')
+        store = nf_core.utils.PackageMetadataStore()
+        assert store.get('bioconda', 'multiqc') == {'name': 'multiqc'}
+        assert nf_core.utils.PackageMetadataStore().get('bioconda', 'multiqc') == {'name': 'multiqc'}
+        assert mock_request.call_count == 1
+
+    @mock.patch('requests.Session.request')
+    def test_package_store_revalidate(self, mock_request):
+        """ Test that stale package metadata is revalidated with its ETag """
+        mock_request.side_effect = [
+            self.mock_api_response(200, '{"name": "multiqc"}', {'ETag': '"abc"'}),
+            self.mock_api_response(304)
+        ]
+        store = nf_core.utils.PackageMetadataStore(ttl=0)
+        store.get('pypi', 'multiqc')
+        assert store.get('pypi', 'multiqc') == {'name': 'multiqc'}
+        assert mock_request.call_args[1]['headers'] == {'If-None-Match': '"abc"'}
+        assert mock_request.call_args[0][1] == 'https://pypi.python.org/pypi/multiqc/json'
+
+    @mock.patch('requests.Session.request')
+    def test_package_store_not_found(self, mock_request):
+        """ Test that missing packages are not stored """
+        mock_request.return_value = self.mock_api_response(404)
+        store = nf_core.utils.PackageMetadataStore()
+        assert store.get('bioconda', 'notapackage') is None
+        assert store.get('bioconda', 'notapackage') is None
+        assert mock_request.call_count == 2
+
+    @mock.patch('requests.Session.request')
+    def test_package_store_api_errors(self, mock_request):
+        """ Test that server errors and invalid JSON are API errors, not missing packages """
+        mock_request.side_effect = [
+            self.mock_api_response(502),
+            self.mock_api_response(200, '<html>Bad gateway</html>'),
+            self.mock_api_response(200, '{"name": "multiqc"}')
+        ]
+        store = nf_core.utils.PackageMetadataStore()
+        with self.assertRaises(requests.exceptions.HTTPError):
+            store.get('bioconda', 'multiqc')
+        results = store.get_many([('bioconda', 'multiqc'), ('pypi', 'multiqc')], max_workers=1)
+        assert sorted(type(r).__name__ for r in results.values()) == ['RequestException', 'dict']
+
+    @mock.patch('requests.Session.request')
+    def test_package_store_evict(self, mock_request):
+        """ Test that unused package metadata is evicted """
+        mock_request.return_value = self.mock_api_response(200, '{"name": "multiqc"}')
+        store = nf_core.utils.PackageMetadataStore()
+        store.get('bioconda', 'multiqc')
+        store.touch('bioconda', 'multiqc', time.time() - store.max_age - 1)
+        store.evict()
+        store.get('bioconda', 'multiqc')
+        assert mock_request.call_count == 2
+
+    @mock.patch('requests_cache.install_cache')
+    @mock.patch('requests.Session')
+    def test_package_store_one_session(self, mock_session, mock_install_cache):
+        """ Test that threads asking for a session at the same time share one session and cache """
+        def slow_install_cache(cache_name, **kwargs):
+            time.sleep(0.05)
+            open(cache_name + '.sqlite', 'a').close()
+        mock_install_cache.side_effect = slow_install_cache
+        mock_session.side_effect = lambda: time.sleep(0.05) or mock.MagicMock()
+        store = nf_core.utils.PackageMetadataStore()
+        with mock.patch('nf_core.utils.requests_cache_installed', False):
+            pool = ThreadPool(10)
+            sessions = pool.map(lambda i: store.get_session(), range(10))
+            pool.close()
+        assert len(set(id(session) for session in sessions)) == 1
+        assert mock_session.call_count == 1
+        assert mock_install_cache.call_count == 1
+
+    def test_anaconda_package_sources(self):
+        """ Test that conda channels are searched in order of priority """
+        assert nf_core.utils.anaconda_package_sources('multiqc=1.6', ['conda-forge', 'bioconda']) == [('bioconda', 'multiqc'), ('conda-forge', 'multiqc')]
+        assert nf_core.utils.anaconda_package_sources('conda-forge::openjdk=8', ['bioconda']) == [('conda-forge', 'openjdk')]
+
+    @mock.patch('requests.get')
+    def test_pipeline_index_snapshot(self, mock_get):
+        """ Test that the pipeline index is saved and revalidated with its ETag """
+        mock_get.side_effect = [
+            self.mock_api_response(200, '{"remote_workflows": [{"name": "rnaseq"}]}', {'ETag': '"abc"'}),
+            self.mock_api_response(304)
+        ]
+        index = nf_core.utils.PipelineIndex()
+        assert index.get() == {'remote_workflows': [{'name': 'rnaseq'}]}
+        assert index.snapshot_path == os.path.join(nf_core.utils.get_private_cache_dir(), 'pipelines.json')
+        # Fresh snapshot is used without asking the website
+        assert nf_core.utils.PipelineIndex().get() == {'remote_workflows': [{'name': 'rnaseq'}]}
+        assert mock_get.call_count == 1
+        # Stale snapshot is revalidated
+        index = nf_core.utils.PipelineIndex(ttl=0)
+        assert index.get() == {'remote_workflows': [{'name': 'rnaseq'}]}
+        assert mock_get.call_args[1]['headers'] == {'If-None-Match': '"abc"'}
+        assert index.age() < 60
+
+    @mock.patch('requests.get')
+    def test_pipeline_index_offline(self, mock_get):
+        """ Test that the pipeline index snapshot is used when offline or the website is down """
+        with self.assertRaises(LookupError):
+            nf_core.utils.PipelineIndex().get(offline=True)
+        mock_get.return_value = self.mock_api_response(200, '{"remote_workflows": []}')
+        nf_core.utils.PipelineIndex().get()
+        assert nf_core.utils.PipelineIndex().get(offline=True) == {'remote_workflows': []}
+        mock_get.side_effect = requests.exceptions.ConnectionError()
+        assert nf_core.utils.PipelineIndex(ttl=0).get() == {'remote_workflows': []}
+        assert mock_get.call_count == 2